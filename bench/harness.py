@@ -0,0 +1,419 @@
+"""
+Нагрузочный стенд без внешних сервисов.
+
+Поднимает локальные заглушки (bench/stubs.py — OpenAI, FAISS, Messenger), DynamoDB
+(moto server или DynamoDB Local по --dynamodb-endpoint), само приложение и гоняет сценарии
+с заданной конкурентностью. Для каждого сценария — RPS, p50/p95/p99 и разбивка по этапам
+из /metrics (среднее время этапа и число вызовов за прогон).
+
+Пример:
+    python -m bench.harness --requests 300 --concurrency 20 --llm-latency-ms 300 --output bench.json
+    # сравнение с прошлым прогоном: код возврата 1, если p95 вырос больше чем на 20%
+    python -m bench.harness --baseline bench.json --max-regression 20
+
+Нужен moto (pip install "moto[server]"), если не указан --dynamodb-endpoint.
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+import boto3
+import httpx
+
+from bench.process_question_latency import percentile
+
+
+SCENARIOS = ("process_question", "scenario", "users", "welcome")
+QUESTIONS = [
+    "Что делать при головной боли?",
+    "Как снизить давление?",
+    "Чем лечить простуду?",
+    "Сколько нужно спать?",
+    "Какие витамины пить зимой?",
+]
+STAGE_LINE = re.compile(r'^med_bot_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$')
+
+
+# --- процессы стенда ---
+
+def start_process(name: str, cmd: list[str], env: dict, log_dir: str) -> subprocess.Popen:
+    log = open(os.path.join(log_dir, f"{name}.log"), "w")
+    return subprocess.Popen(cmd, env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} не поднялся за {timeout} с")
+
+
+def dynamodb_client(endpoint: str):
+    return boto3.client(
+        "dynamodb", endpoint_url=endpoint, region_name="us-west-2",
+        aws_access_key_id="dummy", aws_secret_access_key="dummy",
+    )
+
+
+def seed_tables(endpoint: str, users: int, diary_chars: int) -> None:
+    """Создаёт Users и WelcomeQueue (остальное приложение создаёт само) и заполняет пользователей."""
+    client = dynamodb_client(endpoint)
+    existing = client.list_tables()["TableNames"]
+    for table in ("Users", "WelcomeQueue"):
+        if table not in existing:
+            client.create_table(
+                TableName=table,
+                KeySchema=[{"AttributeName": "user_id", "KeyType": "HASH"}],
+                AttributeDefinitions=[{"AttributeName": "user_id", "AttributeType": "S"}],
+                BillingMode="PAY_PER_REQUEST",
+            )
+
+    diary = ("Давление в норме, сон 7 часов, лёгкая головная боль к вечеру. " * (diary_chars // 60 + 1))[:diary_chars]
+    items = [
+        {"PutRequest": {"Item": {
+            "user_id": {"S": f"bench_user_{idx}"},
+            "name": {"S": f"Пользователь {idx}"},
+            "birthday": {"S": "1990-01-01"},
+            "health_diary": {"S": diary},
+        }}}
+        for idx in range(users)
+    ]
+    for start in range(0, len(items), 25):
+        client.batch_write_item(RequestItems={"Users": items[start:start + 25]})
+
+
+# --- замеры ---
+
+def parse_stage_metrics(text: str) -> dict:
+    stages = {}
+    for line in text.splitlines():
+        match = STAGE_LINE.match(line)
+        if match:
+            kind, stage, value = match.groups()
+            stages.setdefault(stage, {"sum": 0.0, "count": 0})[kind] = float(value)
+    return stages
+
+
+def stage_breakdown(before: dict, after: dict) -> dict:
+    """Среднее время этапа (мс) и число вызовов за прогон — разница двух снимков /metrics."""
+    result = {}
+    for stage, values in after.items():
+        prev = before.get(stage, {"sum": 0.0, "count": 0})
+        count = int(values["count"] - prev["count"])
+        if count:
+            result[stage] = {
+                "calls": count,
+                "mean_ms": round((values["sum"] - prev["sum"]) / count * 1000, 2),
+            }
+    return dict(sorted(result.items()))
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    total = len(latencies)
+    return {
+        "requests": total,
+        "errors": errors,
+        "rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(statistics.fmean(latencies), 2) if latencies else 0.0,
+    }
+
+
+async def drive(total: int, concurrency: int, make_request) -> dict:
+    """Выполняет total вызовов make_request(i) не более чем concurrency одновременно."""
+    latencies = []
+    errors = 0
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        nonlocal errors
+        async with sem:
+            started = time.perf_counter()
+            try:
+                ok = await make_request(i)
+                if not ok:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started_all = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return summarize(latencies, errors, time.perf_counter() - started_all)
+
+
+# --- сценарии ---
+
+async def run_process_question(client: httpx.AsyncClient, args) -> dict:
+    async def request(i: int) -> bool:
+        resp = await client.post("/process_question", json={
+            "user_id": f"bench_user_{i % args.users}",
+            "question": QUESTIONS[i % len(QUESTIONS)],
+            "use_anamnesis": True,
+            "use_knowledge_base": True,
+            "use_conversation_history": True,
+        })
+        return resp.status_code == 200
+
+    return await drive(args.requests, args.concurrency, request)
+
+
+async def run_scenario(client: httpx.AsyncClient, args) -> dict:
+    # Каждый пользователь проходит сценарий по первой кнопке; в конце — заново
+    positions = {}
+
+    async def request(i: int) -> bool:
+        user_id = f"bench_user_{i % args.users}"
+        user_answer = positions.get(user_id, {})
+        resp = await client.post("/scenario/execute", json={
+            "scenarioFileName": args.scenario_file,
+            "metadata": {"userId": user_id},
+            "userAnswer": user_answer,
+        })
+        if resp.status_code != 200:
+            return False
+        body = resp.json()
+        buttons = (body.get("step") or {}).get("buttons") or []
+        if body.get("scenarioFinished") or not buttons:
+            positions.pop(user_id, None)
+        else:
+            positions[user_id] = {"stepId": body["nextStepId"], "selectedButtonId": buttons[0]["id"]}
+        return True
+
+    return await drive(args.requests, args.concurrency, request)
+
+
+async def run_users(client: httpx.AsyncClient, args) -> dict:
+    async def request(i: int) -> bool:
+        # Тело читается целиком: страница отдаётся потоком
+        resp = await client.get("/users", params={"limit": args.users_page_size}, follow_redirects=False)
+        return resp.status_code == 200
+
+    return await drive(args.requests, args.concurrency, request)
+
+
+async def run_welcome(args, env: dict) -> tuple[dict, dict]:
+    """
+    WelcomeScheduler в процессе стенда (одна реплика, все шарды): в очередь кладётся
+    --welcome-items просроченных записей, затем один опрос и пачки fire_due (захват + отправка),
+    пока срок не наступил ни у одной записи.
+    """
+    # Шарды в таблице аренд приложения заняты его воркером — у планировщика стенда своя таблица
+    os.environ.update({**env, "WELCOME_LEASE_TABLE": "WelcomeLeasesBench"})
+    from src.db_manager import init_dynamodb, close_dynamodb, batch_write
+    from src.http_clients import init_http_clients, close_http_clients
+    from src.metrics import render_metrics
+    from src import welcome
+    from src.welcome_scheduler import WelcomeScheduler, ensure_lease_table
+
+    await init_dynamodb()
+    await init_http_clients()
+    scheduler = None
+    try:
+        await welcome.ensure_welcome_index()
+        await ensure_lease_table()
+        created_at = int(time.time()) - 3600
+        await batch_write(welcome.WELCOME_TABLE, [
+            {"PutRequest": {"Item": welcome.welcome_queue_item(f"welcome_user_{idx}", created_at)}}
+            for idx in range(args.welcome_items)
+        ])
+
+        scheduler = WelcomeScheduler()
+        await scheduler.heartbeat()
+
+        before = parse_stage_metrics(render_metrics())
+        cycles = []
+        processed = 0
+        started_all = time.perf_counter()
+        await scheduler.poll()
+        while True:
+            started = time.perf_counter()
+            stats = await scheduler.fire_due()
+            if stats is None:
+                break
+            # Здесь «цикл» — одна пачка таймеров (захват + process_due_items)
+            cycles.append((time.perf_counter() - started) * 1000)
+            processed += stats["sent"] + stats["skipped"]
+        elapsed = time.perf_counter() - started_all
+
+        summary = summarize(cycles, 0, elapsed)
+        summary = {"cycles": summary.pop("requests"), **summary, "items": processed,
+                   "items_per_s": round(processed / elapsed, 1) if elapsed else 0.0,
+                   "claim_conflicts": scheduler.stats["claim_conflicts"]}
+        summary.pop("rps")
+        return summary, stage_breakdown(before, parse_stage_metrics(render_metrics()))
+    finally:
+        if scheduler is not None:
+            await scheduler.release_all()
+        await close_http_clients()
+        await close_dynamodb()
+
+
+async def run_http_scenario(name: str, app_url: str, args) -> tuple[dict, dict]:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=app_url, limits=limits, timeout=120) as client:
+        before = parse_stage_metrics((await client.get("/metrics")).text)
+        runner = {"process_question": run_process_question, "scenario": run_scenario, "users": run_users}[name]
+        summary = await runner(client, args)
+        after = parse_stage_metrics((await client.get("/metrics")).text)
+    return summary, stage_breakdown(before, after)
+
+
+# --- отчёт ---
+
+def print_report(results: dict) -> None:
+    for name, result in results.items():
+        summary = result["summary"]
+        print(f"\n=== {name} ===")
+        print("  " + "  ".join(f"{key}={value}" for key, value in summary.items()))
+        for stage, values in result["stages"].items():
+            print(f"    {stage:<34} calls={values['calls']:<6} mean={values['mean_ms']} ms")
+
+
+def compare_with_baseline(results: dict, baseline_path: str, max_regression: float) -> list[str]:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name, {}).get("summary", {}).get("p95_ms")
+        new = result["summary"]["p95_ms"]
+        if old and new > old * (1 + max_regression / 100):
+            regressions.append(f"{name}: p95 {old} → {new} ms (+{round((new / old - 1) * 100, 1)}%)")
+    return regressions
+
+
+async def run_all(args, app_url: str, app_env: dict) -> dict:
+    results = {}
+    for name in args.scenarios:
+        print(f"Сценарий {name}...", flush=True)
+        if name == "welcome":
+            summary, stages = await run_welcome(args, app_env)
+        else:
+            summary, stages = await run_http_scenario(name, app_url, args)
+        results[name] = {"summary": summary, "stages": stages}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд med_bot с локальными заглушками")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"через запятую из: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200, help="запросов на HTTP-сценарий")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=100, help="сколько пользователей создать")
+    parser.add_argument("--diary-chars", type=int, default=4000, help="длина health_diary у пользователей")
+    parser.add_argument("--users-page-size", type=int, default=50)
+    parser.add_argument("--welcome-items", type=int, default=500)
+    parser.add_argument("--scenario-file", default="health_ai_assistant_scenario.json")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--faiss-latency-ms", type=float, default=30)
+    parser.add_argument("--messenger-latency-ms", type=float, default=20)
+    parser.add_argument("--dynamodb-endpoint", default=None,
+                        help="готовый DynamoDB Local; по умолчанию запускается moto server")
+    parser.add_argument("--app-port", type=int, default=8180)
+    parser.add_argument("--stub-port", type=int, default=8190)
+    parser.add_argument("--dynamodb-port", type=int, default=8101)
+    parser.add_argument("--log-dir", default=None, help="логи процессов стенда (по умолчанию — временный каталог)")
+    parser.add_argument("--output", default=None, help="сохранить результаты в JSON")
+    parser.add_argument("--baseline", default=None, help="JSON прошлого прогона для сравнения p95")
+    parser.add_argument("--max-regression", type=float, default=20.0, help="допустимый рост p95, %%")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix="med_bot_bench_")
+    os.makedirs(log_dir, exist_ok=True)
+    processes = []
+    try:
+        dynamodb_endpoint = args.dynamodb_endpoint
+        if dynamodb_endpoint is None:
+            dynamodb_endpoint = f"http://127.0.0.1:{args.dynamodb_port}"
+            processes.append(start_process(
+                "dynamodb", [sys.executable, "-m", "moto.server", "-p", str(args.dynamodb_port)], {}, log_dir
+            ))
+
+        stub_url = f"http://127.0.0.1:{args.stub_port}"
+        processes.append(start_process(
+            "stubs",
+            [sys.executable, "-m", "uvicorn", "bench.stubs:app", "--port", str(args.stub_port), "--log-level", "warning"],
+            {
+                "BENCH_LLM_LATENCY_MS": str(args.llm_latency_ms),
+                "BENCH_FAISS_LATENCY_MS": str(args.faiss_latency_ms),
+                "BENCH_MESSENGER_LATENCY_MS": str(args.messenger_latency_ms),
+            },
+            log_dir,
+        ))
+        wait_ready(dynamodb_endpoint)
+        wait_ready(stub_url + "/stub_stats")
+        seed_tables(dynamodb_endpoint, args.users, args.diary_chars)
+
+        app_env = {
+            "DYNAMODB_ENDPOINT": dynamodb_endpoint,
+            "AWS_ACCESS_KEY_ID": "dummy",
+            "AWS_SECRET_ACCESS_KEY": "dummy",
+            "AWS_REGION": "us-west-2",
+            "OPENAI_API_KEY": "sk-bench",
+            "OPENAI_BASE_URL": stub_url + "/v1",
+            "FAISS_SERVICE_URL": stub_url + "/search",
+            "MESSENGER_BASE_URL": stub_url,
+            # Воркер приложения не должен разбирать очередь, которую гоняет сценарий welcome
+            "WELCOME_CHECK_INTERVAL": "86400",
+            "WELCOME_DELAY_MINUTES": "0",
+            "WRITE_BEHIND_SPOOL": os.path.join(log_dir, "write_behind.jsonl"),
+            "REDIS_URL": "",
+            # Стенд меряет пропускную способность, а не лимиты отдельных пользователей
+            "LLM_USER_RATE_PER_MIN": "0",
+        }
+        app_url = f"http://127.0.0.1:{args.app_port}"
+        processes.append(start_process(
+            "app",
+            [sys.executable, "-m", "uvicorn", "src.main:app", "--port", str(args.app_port), "--log-level", "warning"],
+            app_env,
+            log_dir,
+        ))
+        wait_ready(app_url + "/stats")
+
+        results = asyncio.run(run_all(args, app_url, app_env))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    print_report(results)
+    print(f"\nЛоги процессов: {log_dir}")
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "results": results}, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.max_regression)
+        if regressions:
+            print("\nРегрессии относительно базового прогона:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nРегрессий p95 нет")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Сравнение поиска по базе знаний: FAISS-сервис (KB_BACKEND=remote) и встроенный индекс
+(KB_BACKEND=embedded, src/vector_index.py). Кэш базы знаний не участвует — меряется сам поиск.
+
+Для встроенного индекса по умолчанию меряется только поиск по матрице (вектор запроса — случайный);
+с --embed — вместе с эмбеддингом запроса через OpenAI (OPENAI_BASE_URL, подойдёт bench/stubs.py;
+для синтетического индекса --dim должен совпадать с BENCH_EMBEDDING_DIM заглушки).
+
+Пример:
+    # синтетический индекс на 50 000 фрагментов против заглушки FAISS
+    python -m bench.kb_search --synthetic 50000 --dim 1536 --faiss-url http://localhost:8090/search
+    # собранный индекс (scripts/build_kb_index.py) против настоящего сервиса
+    python -m bench.kb_search --index-dir kb_index --faiss-url http://172.17.0.1:8010/search --embed
+"""
+import os
+import time
+import asyncio
+import argparse
+import statistics
+import tempfile
+
+import httpx
+import numpy as np
+
+from bench.harness import QUESTIONS
+from bench.process_question_latency import percentile
+from src.llm import init_llm, close_llm, embed_texts
+from src.vector_index import VectorIndex, write_index
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.fmean(latencies), 3) if latencies else 0.0,
+    }
+
+
+async def drive(total: int, concurrency: int, request) -> dict:
+    latencies = []
+    errors = 0
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        nonlocal errors
+        async with sem:
+            started = time.perf_counter()
+            try:
+                if not await request(i):
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started_all = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return summarize(latencies, errors, time.perf_counter() - started_all)
+
+
+async def bench_remote(args) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        async def request(i: int) -> bool:
+            resp = await client.post(args.faiss_url, json={
+                "db_name": args.db_name, "query": f"{QUESTIONS[i % len(QUESTIONS)]} #{i}", "top_k": args.top_k,
+            })
+            return resp.status_code == 200 and len(resp.json().get("results", [])) > 0
+        return await drive(args.requests, args.concurrency, request)
+
+
+async def bench_embedded(args, index_dir: str) -> dict:
+    index = VectorIndex(os.path.join(index_dir, args.db_name))
+    if args.embed:
+        # Как search_embedded: эмбеддинг запроса моделью индекса, затем поиск
+        init_llm()
+        try:
+            async def request(i: int) -> bool:
+                vector = (await embed_texts([f"{QUESTIONS[i % len(QUESTIONS)]} #{i}"], index.model))[0]
+                return bool(await index.search_async(vector, args.top_k))
+            return await drive(args.requests, args.concurrency, request)
+        finally:
+            await close_llm()
+
+    vectors = np.random.default_rng(1).standard_normal((args.requests, index.dim)).astype(np.float32)
+
+    async def request(i: int) -> bool:
+        return bool(await index.search_async(vectors[i], args.top_k))
+    return await drive(args.requests, args.concurrency, request)
+
+
+def build_synthetic(path: str, db_name: str, size: int, dim: int) -> None:
+    embeddings = np.random.default_rng(0).standard_normal((size, dim)).astype(np.float32)
+    texts = [f"Фрагмент {i} базы {db_name}. " * 10 for i in range(size)]
+    write_index(os.path.join(path, db_name), embeddings, texts, "synthetic")
+
+
+def print_report(results: dict) -> None:
+    print(f"{'backend':<10} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for name, row in results.items():
+        print(f"{name:<10} {row['rps']:>9} {row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9} {row['errors']:>7}")
+
+
+async def run(args) -> dict:
+    results = {}
+    if args.faiss_url:
+        results["remote"] = await bench_remote(args)
+
+    if args.synthetic:
+        with tempfile.TemporaryDirectory() as tmp:
+            started = time.perf_counter()
+            build_synthetic(tmp, args.db_name, args.synthetic, args.dim)
+            print(f"Синтетический индекс {args.synthetic}x{args.dim} собран за {time.perf_counter() - started:.1f} с")
+            results["embedded"] = await bench_embedded(args, tmp)
+    elif args.index_dir:
+        results["embedded"] = await bench_embedded(args, args.index_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FAISS-сервис против встроенного индекса")
+    parser.add_argument("--faiss-url", default=None, help="URL FAISS /search; без него remote не меряется")
+    parser.add_argument("--index-dir", default=None, help="Каталог индексов (KB_INDEX_DIR)")
+    parser.add_argument("--synthetic", type=int, default=0, help="Собрать синтетический индекс на N фрагментов")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--db-name", default="db_diseases")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--embed", action="store_true", help="Встроенный индекс — вместе с эмбеддингом запроса")
+    args = parser.parse_args()
+    if not args.faiss_url and not args.index_dir and not args.synthetic:
+        parser.error("нужен хотя бы один из --faiss-url, --index-dir, --synthetic")
+    print_report(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
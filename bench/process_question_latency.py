@@ -0,0 +1,80 @@
+"""
+Замер задержки POST /process_question на уже запущенном приложении.
+
+Пример:
+    python -m bench.process_question_latency --url http://localhost:8080 --user-id bench_user \
+        --requests 500 --concurrency 20
+"""
+import argparse
+import asyncio
+import math
+import statistics
+import time
+
+import httpx
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[idx]
+
+
+async def run(url: str, user_id: str, total: int, concurrency: int, payload_extra: dict) -> dict:
+    latencies = []
+    errors = 0
+    sem = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        async def one(i: int):
+            nonlocal errors
+            payload = {"user_id": user_id, "question": f"Вопрос #{i % 10}", **payload_extra}
+            async with sem:
+                started = time.perf_counter()
+                try:
+                    resp = await client.post("/process_question", json=payload)
+                    if resp.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started_all = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - started_all
+
+    return {
+        "requests": total,
+        "errors": errors,
+        "rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(statistics.fmean(latencies), 2) if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="p50/p99 для /process_question")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--user-id", default="bench_user")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--use-anamnesis", action="store_true")
+    parser.add_argument("--use-history", action="store_true")
+    args = parser.parse_args()
+
+    extra = {
+        "use_anamnesis": args.use_anamnesis,
+        "use_conversation_history": args.use_history,
+    }
+    result = asyncio.run(run(args.url, args.user_id, args.requests, args.concurrency, extra))
+    for key, value in result.items():
+        print(f"{key:>10}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Локальные заглушки внешних сервисов для нагрузочных замеров:
+OpenAI (chat.completions, обычный и потоковый режим, embeddings), FAISS /search и Messenger.
+
+Задержки настраиваются переменными окружения (миллисекунды):
+    BENCH_LLM_LATENCY_MS       — время до ответа OpenAI (в потоке — до первого чанка), по умолчанию 300
+    BENCH_LLM_STREAM_CHUNKS    — число чанков потокового ответа, по умолчанию 20
+    BENCH_LLM_CHUNK_MS         — пауза между чанками, по умолчанию 10
+    BENCH_EMBEDDING_LATENCY_MS — задержка embeddings, по умолчанию 20
+    BENCH_EMBEDDING_DIM        — размерность векторов embeddings, по умолчанию 256
+    BENCH_FAISS_LATENCY_MS     — задержка /search, по умолчанию 30
+    BENCH_MESSENGER_LATENCY_MS — задержка Messenger, по умолчанию 20
+    BENCH_MESSENGER_REPLIED_RATE — доля чатов, где пользователь уже писал (welcome не нужен), по умолчанию 0.2
+    BENCH_MESSENGER_OMIT_CHAT_ID — не отдавать chatId в last-messages-by-chat (проверка запасного пути)
+    BENCH_LLM_429_RATE         — доля ответов OpenAI 429 с Retry-After (проверка повторов), по умолчанию 0
+
+Запуск:
+    python -m uvicorn bench.stubs:app --port 8090
+"""
+import os
+import json
+import time
+import asyncio
+import random
+import hashlib
+import zlib
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+LLM_LATENCY = float(os.getenv("BENCH_LLM_LATENCY_MS", "300")) / 1000
+LLM_STREAM_CHUNKS = int(os.getenv("BENCH_LLM_STREAM_CHUNKS", "20"))
+LLM_CHUNK_DELAY = float(os.getenv("BENCH_LLM_CHUNK_MS", "10")) / 1000
+EMBEDDING_LATENCY = float(os.getenv("BENCH_EMBEDDING_LATENCY_MS", "20")) / 1000
+EMBEDDING_DIM = int(os.getenv("BENCH_EMBEDDING_DIM", "256"))
+FAISS_LATENCY = float(os.getenv("BENCH_FAISS_LATENCY_MS", "30")) / 1000
+MESSENGER_LATENCY = float(os.getenv("BENCH_MESSENGER_LATENCY_MS", "20")) / 1000
+MESSENGER_REPLIED_RATE = float(os.getenv("BENCH_MESSENGER_REPLIED_RATE", "0.2"))
+MESSENGER_OMIT_CHAT_ID = os.getenv("BENCH_MESSENGER_OMIT_CHAT_ID", "false").lower() == "true"
+LLM_429_RATE = float(os.getenv("BENCH_LLM_429_RATE", "0"))
+
+ANSWER_WORDS = ["Рекомендуется", "обратиться", "к", "врачу", "и", "соблюдать", "режим", "сна", "и", "питания."]
+
+app = FastAPI()
+stub_stats = {"llm": 0, "llm_429": 0, "embeddings": 0, "faiss": 0, "messenger_batch": 0, "messenger_send": 0}
+
+
+def _jitter(seconds: float) -> float:
+    return seconds * random.uniform(0.8, 1.2)
+
+
+def _chunk(model: str, delta: dict = None, usage: dict = None) -> str:
+    payload = {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": None}],
+    }
+    if usage is not None:
+        payload["usage"] = usage
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stub_stats["llm"] += 1
+    if LLM_429_RATE and random.random() < LLM_429_RATE:
+        stub_stats["llm_429"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429, headers={"Retry-After": "0.1"}
+        )
+    model = body.get("model", "bench")
+    # Входные токены — грубо по длине промпта, чтобы метрики токенов были правдоподобными
+    prompt_tokens = sum(len(message.get("content") or "") for message in body.get("messages", [])) // 3
+    await asyncio.sleep(_jitter(LLM_LATENCY))
+
+    if body.get("stream"):
+        async def stream():
+            for idx in range(LLM_STREAM_CHUNKS):
+                yield _chunk(model, {"content": ANSWER_WORDS[idx % len(ANSWER_WORDS)] + " "})
+                await asyncio.sleep(LLM_CHUNK_DELAY)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": LLM_STREAM_CHUNKS,
+                     "total_tokens": prompt_tokens + LLM_STREAM_CHUNKS}
+            yield _chunk(model, usage=usage)
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    answer = " ".join(ANSWER_WORDS)
+    return {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(ANSWER_WORDS),
+                  "total_tokens": prompt_tokens + len(ANSWER_WORDS)},
+    }
+
+
+def _embedding(text: str) -> list[float]:
+    # Детерминированный вектор: одинаковый текст — одинаковый вектор
+    rnd = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    return [rnd.gauss(0, 1) for _ in range(EMBEDDING_DIM)]
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    stub_stats["embeddings"] += 1
+    await asyncio.sleep(_jitter(EMBEDDING_LATENCY))
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    return {
+        "object": "list",
+        "data": [{"object": "embedding", "index": i, "embedding": _embedding(text)} for i, text in enumerate(texts)],
+        "model": body.get("model", "text-embedding-bench"),
+        "usage": {"prompt_tokens": sum(len(text.split()) for text in texts),
+                  "total_tokens": sum(len(text.split()) for text in texts)},
+    }
+
+
+@app.post("/search")
+async def search(request: Request):
+    body = await request.json()
+    stub_stats["faiss"] += 1
+    await asyncio.sleep(_jitter(FAISS_LATENCY))
+    top_k = body.get("top_k", 3)
+    return {"results": [
+        {"text": f"Фрагмент {idx + 1} базы {body.get('db_name')} по запросу «{body.get('query')}». " * 5,
+         "score": 1.0 - idx * 0.1}
+        for idx in range(top_k)
+    ]}
+
+
+def _chat_replied(chat_id: str) -> bool:
+    # Детерминированно: один и тот же чат «ответил» и в пачке, и в запросе по одному чату
+    return zlib.crc32(chat_id.encode("utf-8")) % 1000 < MESSENGER_REPLIED_RATE * 1000
+
+
+@app.post("/internal/messenger/last-messages-by-chat")
+async def last_messages_by_chat(request: Request):
+    body = await request.json()
+    stub_stats["messenger_batch"] += 1
+    await asyncio.sleep(_jitter(MESSENGER_LATENCY))
+    data = []
+    for chat_id in body.get("chatIds", []):
+        # chatId вида sup:<user_id>; в «ответивших» чатах последнее сообщение — от пользователя
+        sender = chat_id.split(":", 1)[-1] if _chat_replied(chat_id) else "support"
+        item = {"lastMessage": {"senderId": sender, "text": "Привет", "time": int(time.time() * 1000)}}
+        if not MESSENGER_OMIT_CHAT_ID:
+            item["chatId"] = chat_id
+        data.append(item)
+    return {"data": data}
+
+
+@app.post("/internal/messenger")
+async def send_message(request: Request):
+    await request.json()
+    stub_stats["messenger_send"] += 1
+    await asyncio.sleep(_jitter(MESSENGER_LATENCY))
+    return {"ok": True}
+
+
+@app.get("/stub_stats")
+async def get_stub_stats():
+    return stub_stats
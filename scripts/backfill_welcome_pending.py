@@ -0,0 +1,86 @@
+"""
+Проставляет атрибут pending (номер шарда) необработанным записям WelcomeQueue, созданным
+до разреженного индекса pending-created_at-index: без него они в индекс не попадут
+и welcome им не уйдёт. Запускается один раз после деплоя, а не каждой репликой при старте.
+
+Пример:
+    python -m scripts.backfill_welcome_pending            # проставить
+    python -m scripts.backfill_welcome_pending --dry-run  # только посчитать
+"""
+import argparse
+import asyncio
+import logging
+
+from botocore.exceptions import ClientError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from src.db_manager import init_dynamodb, close_dynamodb, get_dynamodb  # noqa: E402
+from src.welcome import WELCOME_TABLE, shard_for  # noqa: E402
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logging.getLogger("botocore").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+
+async def backfill_item(user_id: str, dry_run: bool) -> bool:
+    if dry_run:
+        return True
+    try:
+        await get_dynamodb().update_item(
+            TableName=WELCOME_TABLE,
+            Key={"user_id": {"S": user_id}},
+            UpdateExpression="SET #pending = :p",
+            # Запись могли обработать, пока шла миграция
+            ConditionExpression="#processed = :f AND attribute_not_exists(#pending)",
+            ExpressionAttributeNames={"#processed": "processed", "#pending": "pending"},
+            ExpressionAttributeValues={":p": {"S": shard_for(user_id)}, ":f": {"BOOL": False}},
+        )
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return False
+    return True
+
+
+async def main(dry_run: bool, concurrency: int) -> None:
+    await init_dynamodb()
+    try:
+        sem = asyncio.Semaphore(concurrency)
+        found = 0
+        updated = 0
+
+        async def run(user_id):
+            async with sem:
+                return await backfill_item(user_id, dry_run)
+
+        kwargs = {
+            "TableName": WELCOME_TABLE,
+            "FilterExpression": "#processed = :f AND attribute_not_exists(#pending)",
+            "ExpressionAttributeNames": {"#processed": "processed", "#pending": "pending"},
+            "ExpressionAttributeValues": {":f": {"BOOL": False}},
+            "ProjectionExpression": "user_id",
+        }
+        while True:
+            resp = await get_dynamodb().scan(**kwargs)
+            user_ids = [item["user_id"]["S"] for item in resp.get("Items", [])]
+            found += len(user_ids)
+            updated += sum(await asyncio.gather(*(run(user_id) for user_id in user_ids)))
+            last_key = resp.get("LastEvaluatedKey")
+            if not last_key:
+                break
+            kwargs["ExclusiveStartKey"] = last_key
+
+        logger.info(f"Готово: записей без pending {found}, проставлено {updated}{' (dry-run)' if dry_run else ''}")
+    finally:
+        await close_dynamodb()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pending для старых записей WelcomeQueue")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+    asyncio.run(main(args.dry_run, args.concurrency))
@@ -0,0 +1,113 @@
+"""
+Сборка встроенного индекса базы знаний (src/vector_index.py) для KB_BACKEND=embedded.
+
+Источники:
+  --input chunks.jsonl — по строке на фрагмент: {"text": "...", "embedding": [...]};
+                         без "embedding" векторы считаются через OpenAI (--model);
+  --faiss-dir DIR      — выгрузка из индекса LangChain FAISS (index.faiss + index.pkl),
+                         которым пользуется FAISS-сервис; нужны faiss-cpu и langchain-community.
+
+Пример:
+    python -m scripts.build_kb_index --db-name db_diseases --input db_diseases.jsonl
+    python -m scripts.build_kb_index --db-name db_diseases --faiss-dir /data/faiss/db_diseases \\
+        --model text-embedding-3-small
+
+После пересборки на работающем приложении: POST /internal/kb/invalidate {"db_name": "db_diseases"}.
+"""
+import os
+import json
+import asyncio
+import argparse
+import logging
+import pickle
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from src.llm import init_llm, close_llm, embed_texts  # noqa: E402
+from src.vector_index import write_index, VectorIndex, KB_INDEX_DIR, KB_EMBEDDING_MODEL  # noqa: E402
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+
+def read_jsonl(path: str) -> tuple[list[str], list]:
+    texts, embeddings = [], []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            text = (record.get("text") or "").strip()
+            if not text:
+                logger.warning(f"{path}:{line_no}: пустой text, пропускаем")
+                continue
+            texts.append(text)
+            embeddings.append(record.get("embedding"))
+    return texts, embeddings
+
+
+def read_faiss_dir(path: str) -> tuple[list[str], list]:
+    """Векторы и тексты из сохранённого LangChain FAISS (FAISS.save_local)."""
+    try:
+        import faiss
+    except ImportError:
+        raise SystemExit("Для --faiss-dir нужен пакет faiss-cpu")
+
+    index = faiss.read_index(os.path.join(path, "index.faiss"))
+    # index.pkl — (docstore, index_to_docstore_id); для распаковки нужен langchain-community
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_id = pickle.load(f)
+    vectors = index.reconstruct_n(0, index.ntotal)
+    texts = [docstore.search(index_to_id[i]).page_content for i in range(index.ntotal)]
+    return texts, list(vectors)
+
+
+async def fill_embeddings(texts: list[str], embeddings: list, model: str, batch_size: int) -> None:
+    missing = [i for i, vector in enumerate(embeddings) if vector is None]
+    if not missing:
+        return
+    logger.info(f"Считаем эмбеддинги: {len(missing)} фрагментов, модель {model}")
+    init_llm()
+    try:
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            vectors = await embed_texts([texts[i] for i in batch], model)
+            for i, vector in zip(batch, vectors):
+                embeddings[i] = vector
+            logger.info(f"  {min(start + batch_size, len(missing))}/{len(missing)}")
+    finally:
+        await close_llm()
+
+
+async def main(args) -> None:
+    if args.faiss_dir:
+        texts, embeddings = read_faiss_dir(args.faiss_dir)
+    else:
+        texts, embeddings = read_jsonl(args.input)
+    if not texts:
+        raise SystemExit("Нет фрагментов для индекса")
+
+    await fill_embeddings(texts, embeddings, args.model, args.batch_size)
+
+    path = os.path.join(args.output_dir, args.db_name)
+    os.makedirs(args.output_dir, exist_ok=True)
+    write_index(path, embeddings, texts, args.model)
+    index = VectorIndex(path)
+    logger.info(f"Индекс {path}: {index.size} фрагментов, dim={index.dim}, модель {index.model}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сборка встроенного индекса базы знаний")
+    parser.add_argument("--db-name", default="db_diseases")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="JSONL с полями text и (необязательно) embedding")
+    source.add_argument("--faiss-dir", help="Каталог LangChain FAISS (index.faiss, index.pkl)")
+    parser.add_argument("--output-dir", default=KB_INDEX_DIR)
+    parser.add_argument("--model", default=KB_EMBEDDING_MODEL,
+                        help="Модель эмбеддингов; запросы к индексу считаются ею же")
+    parser.add_argument("--batch-size", type=int, default=256)
+    asyncio.run(main(parser.parse_args()))
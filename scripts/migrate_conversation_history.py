@@ -0,0 +1,112 @@
+"""
+Перенос старых JSON-блобов conversation_history из таблицы Users
+в таблицу истории (одна запись на сообщение).
+
+Пример:
+    python -m scripts.migrate_conversation_history            # перенести
+    python -m scripts.migrate_conversation_history --drop-blob # перенести и удалить атрибут из Users
+    python -m scripts.migrate_conversation_history --dry-run   # только посчитать
+
+Поле timestamp старых сообщений — время event loop (asyncio loop.time()), а не Unix-время,
+поэтому ему не доверяем: порядок берётся из блоба, а ключи ставятся перед моментом миграции
+с шагом 1 мс. Момент миграции сохраняется у пользователя (conversation_migrated_at),
+и повторный запуск перезаписывает те же ключи, не создавая дубликатов.
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from src.db_manager import init_dynamodb, close_dynamodb, get_dynamodb, TABLE_NAME  # noqa: E402
+from src.conversation_store import append_messages, ensure_conversation_table, make_ts  # noqa: E402
+
+MIGRATED_AT = "conversation_migrated_at"
+STEP_US = 1000      # шаг между перенесёнными сообщениями, мкс
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logging.getLogger("botocore").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+
+async def migrate_user(user_id: str, blob: str, base_ts: int, drop_blob: bool, dry_run: bool) -> int:
+    """base_ts — момент миграции (make_ts): последнее сообщение блоба получает ключ base_ts - STEP_US."""
+    try:
+        history = json.loads(blob)
+    except json.JSONDecodeError:
+        logger.warning(f"user={user_id}: conversation_history не JSON, пропускаем")
+        history = []
+
+    if history and not dry_run:
+        # Момент миграции — до записи сообщений: при сбое посреди переноса повтор возьмёт те же ключи
+        await get_dynamodb().update_item(
+            TableName=TABLE_NAME,
+            Key={"user_id": {"S": user_id}},
+            UpdateExpression="SET #migrated = :ts",
+            ExpressionAttributeNames={"#migrated": MIGRATED_AT},
+            ExpressionAttributeValues={":ts": {"N": str(base_ts)}},
+        )
+        for idx, message in enumerate(history):
+            ts = base_ts - (len(history) - idx) * STEP_US
+            await append_messages(user_id, [{**message, "timestamp": ts // 1_000_000}], ts=ts)
+
+    if drop_blob and not dry_run:
+        await get_dynamodb().update_item(
+            TableName=TABLE_NAME,
+            Key={"user_id": {"S": user_id}},
+            UpdateExpression="REMOVE conversation_history",
+        )
+    return len(history)
+
+
+async def main(drop_blob: bool, dry_run: bool, concurrency: int) -> None:
+    await init_dynamodb()
+    try:
+        if not dry_run:
+            await ensure_conversation_table()
+
+        sem = asyncio.Semaphore(concurrency)
+        users = 0
+        messages = 0
+        started_ts = make_ts()
+
+        async def run(item):
+            # Пользователь уже переносился — те же ключи, что и в прошлый раз
+            base_ts = int(item[MIGRATED_AT]["N"]) if MIGRATED_AT in item else started_ts
+            async with sem:
+                return await migrate_user(
+                    item["user_id"]["S"], item["conversation_history"]["S"], base_ts, drop_blob, dry_run
+                )
+
+        kwargs = {
+            "TableName": TABLE_NAME,
+            "ProjectionExpression": "user_id, conversation_history, #migrated",
+            "ExpressionAttributeNames": {"#migrated": MIGRATED_AT},
+            "FilterExpression": "attribute_exists(conversation_history)",
+        }
+        while True:
+            resp = await get_dynamodb().scan(**kwargs)
+            items = resp.get("Items", [])
+            users += len(items)
+            messages += sum(await asyncio.gather(*(run(item) for item in items)))
+            last_key = resp.get("LastEvaluatedKey")
+            if not last_key:
+                break
+            kwargs["ExclusiveStartKey"] = last_key
+
+        logger.info(f"Готово: пользователей {users}, сообщений {messages}{' (dry-run)' if dry_run else ''}")
+    finally:
+        await close_dynamodb()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Миграция conversation_history в отдельную таблицу")
+    parser.add_argument("--drop-blob", action="store_true", help="удалить conversation_history из Users после переноса")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+    asyncio.run(main(args.drop_blob, args.dry_run, args.concurrency))
@@ -0,0 +1,128 @@
+"""
+Перевод scenario_history в таблице Users в компактный формат (src/scenario_state.py):
+вместо пар записей с полными текстами сообщений — переходы [ts, stepId, stepId ответа, ответ],
+не больше SCENARIO_HISTORY_LIMIT последних; текущая позиция — в атрибуте scenario_state.
+
+Пример:
+    python -m scripts.migrate_scenario_history            # перевести
+    python -m scripts.migrate_scenario_history --dry-run  # только посчитать размер до/после
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+from botocore.exceptions import ClientError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from src.db_manager import init_dynamodb, close_dynamodb, get_dynamodb, TABLE_NAME  # noqa: E402
+from src.scenario_registry import reload_scenarios, all_scenarios  # noqa: E402
+from src.scenario_state import compact_history, cap_history, make_state  # noqa: E402
+from src.user_history import parse_version  # noqa: E402
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logging.getLogger("botocore").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+
+def scenario_file_for(step_id: str):
+    for scenario in all_scenarios():
+        if scenario.get_step(step_id) is not None:
+            return scenario.file_name
+    return None
+
+
+async def migrate_user(item: dict, dry_run: bool) -> tuple[int, int]:
+    """Возвращает размер scenario_history (байт) до и после."""
+    user_id = item["user_id"]["S"]
+    blob = item["scenario_history"]["S"]
+    try:
+        history = json.loads(blob)
+    except json.JSONDecodeError:
+        logger.warning(f"user={user_id}: scenario_history не JSON, пропускаем")
+        return len(blob), len(blob)
+
+    compacted = cap_history(compact_history(history))
+    new_blob = json.dumps(compacted, separators=(",", ":"))
+    if dry_run or new_blob == blob:
+        return len(blob), len(new_blob)
+
+    names = {"#version": "version"}
+    values = {":history": {"S": new_blob}, ":v": {"N": str(parse_version(item))}}
+    update = "SET scenario_history = :history"
+    # Позицию проставляем, только если её ещё нет (её уже пишет новый код)
+    if compacted and "scenario_state" not in item:
+        step_id = compacted[-1][1]
+        update += ", scenario_state = :state"
+        values[":state"] = {"S": make_state(scenario_file_for(step_id), step_id)}
+    condition = "attribute_not_exists(#version)" if "version" not in item else "#version = :v"
+    if "version" not in item:
+        del values[":v"]
+
+    try:
+        # version не меняется: содержание истории то же, кэшированные копии профиля остаются верными
+        await get_dynamodb().update_item(
+            TableName=TABLE_NAME,
+            Key={"user_id": {"S": user_id}},
+            UpdateExpression=update,
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+        )
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        # Запись изменилась параллельно — новый код сам приведёт её к компактному виду
+        logger.info(f"user={user_id}: запись изменилась во время миграции, пропускаем")
+        return len(blob), len(blob)
+    return len(blob), len(new_blob)
+
+
+async def main(dry_run: bool, concurrency: int) -> None:
+    reload_scenarios()
+    await init_dynamodb()
+    try:
+        sem = asyncio.Semaphore(concurrency)
+        users = 0
+        before = 0
+        after = 0
+
+        async def run(item):
+            async with sem:
+                return await migrate_user(item, dry_run)
+
+        kwargs = {
+            "TableName": TABLE_NAME,
+            "ProjectionExpression": "user_id, scenario_history, scenario_state, #version",
+            "ExpressionAttributeNames": {"#version": "version"},
+            "FilterExpression": "attribute_exists(scenario_history)",
+        }
+        while True:
+            resp = await get_dynamodb().scan(**kwargs)
+            items = resp.get("Items", [])
+            users += len(items)
+            for size_before, size_after in await asyncio.gather(*(run(item) for item in items)):
+                before += size_before
+                after += size_after
+            last_key = resp.get("LastEvaluatedKey")
+            if not last_key:
+                break
+            kwargs["ExclusiveStartKey"] = last_key
+
+        logger.info(
+            f"Готово: пользователей {users}, scenario_history {before} -> {after} байт"
+            f"{' (dry-run)' if dry_run else ''}"
+        )
+    finally:
+        await close_dynamodb()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Компактный формат scenario_history")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+    asyncio.run(main(args.dry_run, args.concurrency))
@@ -0,0 +1,193 @@
+import os
+import re
+import logging
+from src.cache import TTLCache, MISSING
+from src.metrics import Counter
+from src.llm import classify_answer
+from src.llm_gateway import LLMRateLimited, check_user_rate
+
+
+logger = logging.getLogger(__name__)
+
+# Свободный текстовый ответ на шаг сценария сначала сопоставляется с possibleUserAnswers[].answerPattern
+# локально (паттерны компилируются при загрузке сценария), и только при промахе — через LLM.
+ANSWER_LLM_FALLBACK = os.getenv("ANSWER_LLM_FALLBACK", "true").lower() == "true"
+ANSWER_LLM_CACHE_SIZE = int(os.getenv("ANSWER_LLM_CACHE_SIZE", "10000"))
+ANSWER_LLM_CACHE_TTL = float(os.getenv("ANSWER_LLM_CACHE_TTL", "86400"))
+ANSWER_MAX_CHARS = int(os.getenv("ANSWER_MAX_CHARS", "500"))
+
+scenario_answers = Counter("scenario_answers_total", "Сопоставление текстовых ответов сценария", ("result",))
+answer_stats = {
+    "exact": 0, "pattern": 0, "llm": 0, "llm_cached": 0, "miss": 0,
+    "llm_errors": 0, "llm_rate_limited": 0, "negated": 0,
+}
+
+# (файл и версия сценария, stepId, нормализованный ответ) -> индекс ответа или -1 (ни один не подошёл)
+llm_match_cache = TTLCache("answer_llm", ANSWER_LLM_CACHE_SIZE, ANSWER_LLM_CACHE_TTL)
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+# Слова отрицания (после normalize_answer: «don't» -> «don t»). Если такое слово стоит вне
+# найденного варианта, ответ по подстроке не засчитывается: «not feeling great» — не «feeling great».
+NEGATION_WORDS = frozenset((
+    "не", "нет", "ни", "ничуть", "нисколько", "никак", "никогда",
+    "not", "no", "never", "nor", "cannot", "don", "doesn", "didn", "isn", "aren", "wasn", "weren",
+    "haven", "hasn", "hadn", "couldn", "wouldn", "shouldn",
+))
+
+
+def normalize_answer(text: str) -> str:
+    """Регистр, пунктуация, эмодзи и лишние пробелы не влияют на сопоставление."""
+    return _SPACES.sub(" ", _PUNCTUATION.sub(" ", text.casefold())).strip()
+
+
+class StepAnswerMatcher:
+    """
+    Все answerPattern одного шага в одном регулярном выражении.
+    Паттерн — варианты через «|», каждый вариант сравнивается как фраза (по границам слов),
+    а не как регулярное выражение. Совпадение по подстроке с отрицанием вне варианта
+    считается промахом (решит LLM).
+    """
+
+    def __init__(self, answers: list[dict]):
+        self.answers = answers
+        self.exact = {}         # нормализованный вариант -> индекс ответа
+        for idx, answer in enumerate(answers):
+            for variant in (answer.get("answerPattern") or "").split("|"):
+                variant = normalize_answer(variant)
+                if variant:
+                    self.exact.setdefault(variant, idx)
+
+        # Длинные варианты первыми: «not so great» раньше, чем «great»
+        variants = sorted(self.exact, key=len, reverse=True)
+        self.regex = (
+            re.compile(r"(?<!\w)(?:" + "|".join(re.escape(v) for v in variants) + r")(?!\w)")
+            if variants else None
+        )
+
+    def match(self, normalized: str):
+        """(индекс ответа, способ) или (None, None). Совпадения с разными ответами считаются промахом."""
+        idx = self.exact.get(normalized)
+        if idx is not None:
+            return idx, "exact"
+        if self.regex is None:
+            return None, None
+
+        matches = list(self.regex.finditer(normalized))
+        found = {self.exact[m.group(0)] for m in matches}
+        if len(found) != 1:
+            return None, None
+
+        # Слова вне найденных вариантов: отрицание среди них меняет смысл ответа
+        rest = normalized
+        for m in reversed(matches):
+            rest = rest[:m.start()] + " " + rest[m.end():]
+        if NEGATION_WORDS.intersection(rest.split()):
+            return None, "negated"
+        return found.pop(), "pattern"
+
+
+def _reaction(answers: list[dict], idx: int, matched_by: str) -> dict:
+    answer = answers[idx]
+    reaction = answer.get("assistantReaction", {})
+    return {
+        "answerIndex": idx,
+        "answerPattern": answer.get("answerPattern"),
+        "message": reaction.get("message"),
+        "actions": reaction.get("actions", []),
+        "nextStepId": reaction.get("nextStepId"),
+        "matchedBy": matched_by,
+    }
+
+
+def match_answer_locally(scenario, step_id: str, text: str):
+    """Только локальное сопоставление (без LLM): реакция шага или None."""
+    matcher = scenario.answer_matchers.get(step_id)
+    if matcher is None:
+        return None
+    idx, matched_by = matcher.match(normalize_answer(text[:ANSWER_MAX_CHARS]))
+    if matched_by == "negated":
+        answer_stats["negated"] += 1
+    if idx is None:
+        return None
+    answer_stats[matched_by] += 1
+    scenario_answers.inc(result=matched_by)
+    return _reaction(matcher.answers, idx, matched_by)
+
+
+def build_answer_prompt(step: dict, answers: list[dict], text: str) -> str:
+    # id кнопок модели ничего не говорят — в варианты идут только фразы
+    button_ids = {btn.get("id") for btn in step.get("buttons", [])}
+    options = "\n".join(
+        f"{idx + 1}. " + " / ".join(
+            variant for variant in (answer.get("answerPattern") or "").split("|") if variant not in button_ids
+        )
+        for idx, answer in enumerate(answers)
+    )
+    question = "\n".join(step.get("messages", []))
+    return (
+        f"Вопрос пользователю:\n{question}\n\n"
+        f"Варианты ответа:\n{options}\n\n"
+        f"Ответ пользователя:\n{text}"
+    )
+
+
+async def route_answer(scenario, step_id: str, text: str, user_id: str):
+    """
+    Реакция на свободный текстовый ответ: локальный матчер, затем (при промахе) LLM.
+    Запрос к LLM идёт в счёт лимита пользователя (check_user_rate); при исчерпанном лимите — промах.
+    Возвращает словарь реакции (message, actions, nextStepId, matchedBy) или None.
+    """
+    reaction = match_answer_locally(scenario, step_id, text)
+    if reaction is not None:
+        return reaction
+
+    matcher = scenario.answer_matchers.get(step_id)
+    if matcher is None or not ANSWER_LLM_FALLBACK:
+        answer_stats["miss"] += 1
+        scenario_answers.inc(result="miss")
+        return None
+
+    text = text[:ANSWER_MAX_CHARS]
+    # mtime в ключе: после правки сценария старые решения не используются
+    key = f"{scenario.file_name}\0{scenario.mtime}\0{step_id}\0{normalize_answer(text)}"
+    idx = llm_match_cache.get(key)
+    cached = idx is not MISSING
+    if not cached:
+        prompt = build_answer_prompt(scenario.get_step(step_id), matcher.answers, text)
+        try:
+            check_user_rate(user_id)
+            choice = await classify_answer(prompt)
+        except LLMRateLimited as e:
+            answer_stats["llm_rate_limited"] += 1
+            logger.warning(f"Ответ на шаг {step_id} не разобран: лимит LLM пользователя {user_id} ({e.reason})")
+            choice = None
+        except Exception as e:
+            answer_stats["llm_errors"] += 1
+            logger.error(f"Ошибка LLM при разборе ответа на шаг {step_id}: {e}")
+            # Ошибку не кэшируем: следующий такой же ответ попробует ещё раз
+            choice = None
+        idx = choice - 1 if choice is not None and 1 <= choice <= len(matcher.answers) else -1
+        if choice is not None:
+            llm_match_cache.set(key, idx)
+
+    if idx < 0:
+        answer_stats["miss"] += 1
+        scenario_answers.inc(result="miss")
+        return None
+    result = "llm_cached" if cached else "llm"
+    answer_stats[result] += 1
+    scenario_answers.inc(result=result)
+    return _reaction(matcher.answers, idx, result)
+
+
+def get_answer_router_stats() -> dict:
+    total = sum(answer_stats[key] for key in ("exact", "pattern", "llm", "llm_cached", "miss"))
+    local = answer_stats["exact"] + answer_stats["pattern"]
+    return {
+        **answer_stats,
+        "total": total,
+        "local_match_rate": round(local / total, 4) if total else 0.0,
+        "llm_cache": llm_match_cache.stats(),
+    }
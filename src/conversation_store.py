@@ -0,0 +1,102 @@
+import os
+import time
+import logging
+from botocore.exceptions import ClientError
+from src.db_manager import get_dynamodb, batch_write
+from src.metrics import track_stage
+
+
+logger = logging.getLogger(__name__)
+
+# Отдельная таблица истории диалога: одна запись на сообщение, ключ (user_id, ts)
+CONVERSATION_TABLE = os.getenv("CONVERSATION_TABLE", "ConversationHistory")
+CONVERSATION_HISTORY_LIMIT = int(os.getenv("CONVERSATION_HISTORY_LIMIT", "6"))
+CONVERSATION_ENSURE_TABLE = os.getenv("CONVERSATION_ENSURE_TABLE", "true").lower() == "true"
+
+
+def _to_item(user_id: str, ts: int, message: dict) -> dict:
+    return {
+        "user_id": {"S": user_id},
+        "ts": {"N": str(ts)},
+        "role": {"S": message.get("role", "")},
+        "message": {"S": message.get("message") or ""},
+        "timestamp": {"N": str(int(message.get("timestamp", ts // 1_000_000)))},
+    }
+
+
+def _from_item(item: dict) -> dict:
+    return {
+        "role": item.get("role", {}).get("S", ""),
+        "message": item.get("message", {}).get("S", ""),
+        "timestamp": int(item.get("timestamp", {}).get("N", "0")),
+    }
+
+
+def make_ts(timestamp: float = None) -> int:
+    """Ключ сортировки: микросекунды, чтобы сообщения одного запроса не совпадали."""
+    return int((timestamp if timestamp is not None else time.time()) * 1_000_000)
+
+
+async def append_messages(user_id: str, messages: list[dict], ts: int = None) -> None:
+    """
+    Дописывает сообщения в историю: каждое сообщение — отдельный небольшой item,
+    все вместе уходят одним BatchWriteItem.
+    """
+    base_ts = ts if ts is not None else make_ts()
+    requests = [
+        {"PutRequest": {"Item": _to_item(user_id, base_ts + idx, message)}}
+        for idx, message in enumerate(messages)
+    ]
+    with track_stage("dynamo_put_history"):
+        unprocessed = await batch_write(CONVERSATION_TABLE, requests)
+    if unprocessed:
+        raise RuntimeError(f"Не удалось сохранить {len(unprocessed)} сообщений истории user={user_id}")
+
+
+async def get_last_messages(user_id: str, limit: int = CONVERSATION_HISTORY_LIMIT) -> list[dict]:
+    """Последние limit сообщений (Query по убыванию ts с Limit), в хронологическом порядке."""
+    if limit <= 0:
+        return []
+    with track_stage("dynamo_query_history"):
+        resp = await get_dynamodb().query(
+            TableName=CONVERSATION_TABLE,
+            KeyConditionExpression="user_id = :u",
+            ExpressionAttributeValues={":u": {"S": user_id}},
+            ScanIndexForward=False,
+            Limit=limit,
+        )
+    return [_from_item(item) for item in reversed(resp.get("Items", []))]
+
+
+async def ensure_conversation_table() -> None:
+    """Создаёт таблицу истории, если её ещё нет, и ждёт, пока она станет ACTIVE."""
+    dynamodb = get_dynamodb()
+    try:
+        await dynamodb.describe_table(TableName=CONVERSATION_TABLE)
+        return
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "ResourceNotFoundException":
+            raise
+
+    try:
+        await dynamodb.create_table(
+            TableName=CONVERSATION_TABLE,
+            KeySchema=[
+                {"AttributeName": "user_id", "KeyType": "HASH"},
+                {"AttributeName": "ts", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "user_id", "AttributeType": "S"},
+                {"AttributeName": "ts", "AttributeType": "N"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        logger.info(f"Создана таблица {CONVERSATION_TABLE}")
+    except ClientError as ce:
+        # Таблицу одновременно создаёт другая реплика
+        if ce.response["Error"]["Code"] != "ResourceInUseException":
+            raise
+
+    # Пока таблица в статусе CREATING, запись в неё падает: дожидаемся ACTIVE
+    waiter = dynamodb.get_waiter("table_exists")
+    await waiter.wait(TableName=CONVERSATION_TABLE, WaiterConfig={"Delay": 2, "MaxAttempts": 60})
@@ -0,0 +1,142 @@
+import os
+import random
+import asyncio
+import itertools
+import logging
+import aioboto3
+from botocore.config import Config
+from contextlib import AsyncExitStack
+
+
+logger = logging.getLogger(__name__)
+
+# DynamoDB Configuration
+DYNAMODB_ENDPOINT = os.getenv("DYNAMODB_ENDPOINT", "http://localhost:8001")
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID", "dummy")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY", "dummy")
+AWS_REGION = os.getenv("AWS_REGION", "us-west-2")
+
+TABLE_NAME = os.getenv("TABLE_NAME", "Users")
+
+# Параметры пула соединений
+DYNAMODB_POOL_SIZE = int(os.getenv("DYNAMODB_POOL_SIZE", "1"))                    # сколько клиентов держим открытыми
+DYNAMODB_MAX_CONNECTIONS = int(os.getenv("DYNAMODB_MAX_CONNECTIONS", "50"))       # соединений на одного клиента
+DYNAMODB_TCP_KEEPALIVE = os.getenv("DYNAMODB_TCP_KEEPALIVE", "true").lower() == "true"
+DYNAMODB_CONNECT_TIMEOUT = float(os.getenv("DYNAMODB_CONNECT_TIMEOUT", "5"))
+DYNAMODB_READ_TIMEOUT = float(os.getenv("DYNAMODB_READ_TIMEOUT", "10"))
+
+# BatchWriteItem
+BATCH_WRITE_SIZE = 25                     # лимит DynamoDB на один BatchWriteItem
+BATCH_GET_SIZE = 100                      # лимит DynamoDB на один BatchGetItem
+BATCH_WRITE_CONCURRENCY = int(os.getenv("DYNAMODB_BATCH_WRITE_CONCURRENCY", "4"))
+BATCH_WRITE_MAX_RETRIES = int(os.getenv("DYNAMODB_BATCH_WRITE_MAX_RETRIES", "8"))
+BATCH_WRITE_BASE_DELAY = 0.05
+BATCH_WRITE_MAX_DELAY = 2.0
+
+_exit_stack = None
+_clients = []
+_clients_cycle = None
+
+
+async def init_dynamodb() -> None:
+    """Открывает пул долгоживущих клиентов DynamoDB (вызывается один раз при старте приложения)."""
+    global _exit_stack, _clients, _clients_cycle
+    if _clients:
+        return
+
+    config = Config(
+        max_pool_connections=DYNAMODB_MAX_CONNECTIONS,
+        tcp_keepalive=DYNAMODB_TCP_KEEPALIVE,
+        connect_timeout=DYNAMODB_CONNECT_TIMEOUT,
+        read_timeout=DYNAMODB_READ_TIMEOUT,
+    )
+    session = aioboto3.Session()
+    _exit_stack = AsyncExitStack()
+    for _ in range(max(1, DYNAMODB_POOL_SIZE)):
+        client = await _exit_stack.enter_async_context(
+            session.client(
+                "dynamodb",
+                endpoint_url=DYNAMODB_ENDPOINT,
+                region_name=AWS_REGION,
+                aws_access_key_id=AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                config=config,
+            )
+        )
+        _clients.append(client)
+    _clients_cycle = itertools.cycle(_clients)
+    logger.info(
+        f"DynamoDB: открыт пул из {len(_clients)} клиент(ов), "
+        f"max_pool_connections={DYNAMODB_MAX_CONNECTIONS}, keepalive={DYNAMODB_TCP_KEEPALIVE}"
+    )
+
+
+async def close_dynamodb() -> None:
+    """Закрывает все клиенты пула (вызывается при остановке приложения)."""
+    global _exit_stack, _clients, _clients_cycle
+    if _exit_stack is not None:
+        await _exit_stack.aclose()
+    _exit_stack = None
+    _clients = []
+    _clients_cycle = None
+
+
+def get_dynamodb():
+    """Возвращает клиента DynamoDB из пула (round-robin)."""
+    if _clients_cycle is None:
+        raise RuntimeError("DynamoDB-клиент не инициализирован: init_dynamodb() не вызывался")
+    return next(_clients_cycle)
+
+
+async def _write_chunk(table_name: str, chunk: list[dict]) -> list[dict]:
+    """Пишет до 25 запросов, повторяя UnprocessedItems с экспоненциальной задержкой и jitter."""
+    pending = chunk
+    for attempt in range(BATCH_WRITE_MAX_RETRIES + 1):
+        resp = await get_dynamodb().batch_write_item(RequestItems={table_name: pending})
+        pending = resp.get("UnprocessedItems", {}).get(table_name, [])
+        if not pending or attempt == BATCH_WRITE_MAX_RETRIES:
+            break
+        delay = min(BATCH_WRITE_MAX_DELAY, BATCH_WRITE_BASE_DELAY * (2 ** attempt))
+        await asyncio.sleep(random.uniform(0, delay))
+    return pending
+
+
+async def batch_write(table_name: str, requests: list[dict], concurrency: int = None) -> list[dict]:
+    """
+    Записывает PutRequest/DeleteRequest пачками по 25 с ограниченным параллелизмом.
+    Возвращает запросы, которые так и не удалось записать после всех повторов.
+    """
+    chunks = [requests[i:i + BATCH_WRITE_SIZE] for i in range(0, len(requests), BATCH_WRITE_SIZE)]
+    sem = asyncio.Semaphore(concurrency or BATCH_WRITE_CONCURRENCY)
+
+    async def run(chunk):
+        async with sem:
+            return await _write_chunk(table_name, chunk)
+
+    failed = []
+    for leftover in await asyncio.gather(*(run(chunk) for chunk in chunks)):
+        failed.extend(leftover)
+    return failed
+
+
+async def batch_get_keys(table_name: str, keys: list[str], key_name: str = "user_id") -> set[str]:
+    """
+    Какие из ключей уже есть в таблице: BatchGetItem пачками по 100 (только ключевой атрибут),
+    UnprocessedKeys повторяются с экспоненциальной задержкой и jitter.
+    """
+    found = set()
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        pending = {"Keys": [{key_name: {"S": key}} for key in keys[start:start + BATCH_GET_SIZE]],
+                   "ProjectionExpression": key_name}
+        for attempt in range(BATCH_WRITE_MAX_RETRIES + 1):
+            resp = await get_dynamodb().batch_get_item(RequestItems={table_name: pending})
+            for item in resp.get("Responses", {}).get(table_name, []):
+                found.add(item[key_name]["S"])
+            pending = resp.get("UnprocessedKeys", {}).get(table_name)
+            if not pending:
+                break
+            if attempt == BATCH_WRITE_MAX_RETRIES:
+                raise RuntimeError(f"{table_name}: не удалось прочитать {len(pending['Keys'])} ключей")
+            delay = min(BATCH_WRITE_MAX_DELAY, BATCH_WRITE_BASE_DELAY * (2 ** attempt))
+            await asyncio.sleep(random.uniform(0, delay))
+    return found
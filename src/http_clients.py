@@ -0,0 +1,115 @@
+import os
+import logging
+import httpx
+
+
+logger = logging.getLogger(__name__)
+
+
+def _upstream_config(prefix: str, timeout: str, max_connections: str) -> dict:
+    return {
+        "timeout": float(os.getenv(f"{prefix}_HTTP_TIMEOUT", timeout)),
+        "connect_timeout": float(os.getenv(f"{prefix}_HTTP_CONNECT_TIMEOUT", "3")),
+        "max_connections": int(os.getenv(f"{prefix}_HTTP_MAX_CONNECTIONS", max_connections)),
+        "max_keepalive": int(os.getenv(f"{prefix}_HTTP_MAX_KEEPALIVE", max_connections)),
+        "keepalive_expiry": float(os.getenv(f"{prefix}_HTTP_KEEPALIVE_EXPIRY", "30")),
+        "http2": os.getenv(f"{prefix}_HTTP2", "false").lower() == "true",
+    }
+
+
+# Настройки пулов для каждого внешнего сервиса
+UPSTREAMS = {
+    "faiss": _upstream_config("FAISS", timeout="10", max_connections="50"),
+    "messenger": _upstream_config("MESSENGER", timeout="10", max_connections="20"),
+}
+
+_clients: dict[str, httpx.AsyncClient] = {}
+_stats: dict[str, dict] = {}
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _make_trace(name: str):
+    stats = _stats[name]
+
+    async def trace(event_name: str, info: dict) -> None:
+        # Новое TCP-соединение; всё остальное — переиспользование из пула
+        if event_name == "connection.connect_tcp.complete":
+            stats["connections_opened"] += 1
+
+    return trace
+
+
+def _make_request_hook(name: str):
+    stats = _stats[name]
+    trace = _make_trace(name)
+
+    async def on_request(request: httpx.Request) -> None:
+        stats["requests"] += 1
+        request.extensions["trace"] = trace
+
+    return on_request
+
+
+async def init_http_clients() -> None:
+    """Создаёт по одному пулу httpx.AsyncClient на каждый внешний сервис."""
+    http2_ok = _http2_available()
+    for name, cfg in UPSTREAMS.items():
+        if name in _clients:
+            continue
+        http2 = cfg["http2"]
+        if http2 and not http2_ok:
+            logger.warning(f"HTTP/2 для {name} запрошен, но пакет h2 не установлен — используем HTTP/1.1")
+            http2 = False
+
+        _stats[name] = {"requests": 0, "connections_opened": 0}
+        _clients[name] = httpx.AsyncClient(
+            timeout=httpx.Timeout(cfg["timeout"], connect=cfg["connect_timeout"]),
+            limits=httpx.Limits(
+                max_connections=cfg["max_connections"],
+                max_keepalive_connections=cfg["max_keepalive"],
+                keepalive_expiry=cfg["keepalive_expiry"],
+            ),
+            http2=http2,
+            event_hooks={"request": [_make_request_hook(name)]},
+        )
+        logger.info(
+            f"HTTP-пул {name}: max_connections={cfg['max_connections']}, "
+            f"timeout={cfg['timeout']}s, http2={http2}"
+        )
+
+
+async def close_http_clients() -> None:
+    """Закрывает все пулы (вызывается при остановке приложения)."""
+    for client in _clients.values():
+        await client.aclose()
+    _clients.clear()
+
+
+def get_http_client(name: str) -> httpx.AsyncClient:
+    """Возвращает общий клиент для указанного сервиса ("faiss" или "messenger")."""
+    client = _clients.get(name)
+    if client is None:
+        raise RuntimeError(f"HTTP-клиент {name} не инициализирован: init_http_clients() не вызывался")
+    return client
+
+
+def get_http_stats() -> dict:
+    """Счётчики запросов и открытых соединений; reused показывает попадания в пул."""
+    result = {}
+    for name, stats in _stats.items():
+        requests = stats["requests"]
+        opened = stats["connections_opened"]
+        result[name] = {
+            "requests": requests,
+            "connections_opened": opened,
+            "connections_reused": max(0, requests - opened),
+            "reuse_ratio": round((requests - opened) / requests, 4) if requests else 0.0,
+        }
+    return result
@@ -0,0 +1,152 @@
+import os
+import re
+import uuid
+import logging
+from src.cache import TTLCache, MISSING
+from src.singleflight import SingleFlight
+from src.http_clients import get_http_client
+from src.shared_cache import shared_get, shared_set, shared_clear, shared_publish, shared_listen, shared_cache_enabled
+from src.metrics import track_stage, stage_errors
+from src.vector_index import search_embedded, drop_indexes, get_vector_index_stats
+
+
+logger = logging.getLogger(__name__)
+
+FAISS_SERVICE_URL = os.getenv("FAISS_SERVICE_URL", "http://172.17.0.1:8010/search")
+# remote — FAISS-сервис по FAISS_SERVICE_URL; embedded — встроенный индекс (src/vector_index.py)
+KB_BACKEND = os.getenv("KB_BACKEND", "remote").lower()
+KB_DB_NAME = "db_diseases"
+KB_TOP_K = 3
+
+KB_CACHE_SIZE = int(os.getenv("KB_CACHE_SIZE", "2048"))
+KB_CACHE_TTL = float(os.getenv("KB_CACHE_TTL", "3600"))
+
+kb_cache = TTLCache("kb", KB_CACHE_SIZE, KB_CACHE_TTL)
+kb_shared_hits = 0
+kb_flight = SingleFlight("kb")
+KB_INVALIDATION_CHANNEL = "kb_invalidate"
+kb_invalidation_stats = {"local": 0, "sent": 0, "received": 0, "stale_loads": 0}
+
+# Поколения кэша: None — сброс всей базы знаний, db_name — одной базы. Загрузка, начатая
+# до сброса, свой результат в кэш не кладёт. Баз немного, поэтому словарь не растёт.
+_generations = {}
+# Свои же сообщения из канала пропускаем
+_instance_id = uuid.uuid4().hex
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Нормализация для ключа кэша: регистр, пробелы и финальная пунктуация не важны."""
+    return _WHITESPACE.sub(" ", (query or "").strip().lower()).rstrip(" ?!.")
+
+
+def kb_cache_key(query: str, db_name: str, top_k: int) -> str:
+    return f"{db_name}:{top_k}:{normalize_query(query)}"
+
+
+async def _search_remote(query: str, db_name: str, top_k: int):
+    """Запрос в FAISS-сервис. None — ошибка (такой результат не кэшируем)."""
+    client = get_http_client("faiss")
+    with track_stage("faiss_query"):
+        response = await client.post(
+            FAISS_SERVICE_URL,
+            json={"db_name": db_name, "query": query, "top_k": top_k}
+        )
+    if response.status_code == 200:
+        return response.json().get("results", [])
+    else:
+        stage_errors.inc(stage="faiss_query")
+        logger.error(f"Ошибка запроса в faiss_service: {response.text}")
+        return None
+
+
+async def query_faiss_service(query: str, db_name: str = KB_DB_NAME, top_k: int = KB_TOP_K):
+    """
+    Поиск по базе знаний через кэш: локальный LRU/TTL → общий (Redis, если есть) →
+    FAISS-сервис или встроенный индекс (KB_BACKEND).
+    Одинаковые одновременные промахи склеиваются в один запрос (SingleFlight).
+    """
+    key = kb_cache_key(query, db_name, top_k)
+
+    cached = kb_cache.get(key)
+    if cached is not MISSING:
+        return cached
+
+    results, _ = await kb_flight.do(key, lambda: _load(key, query, db_name, top_k))
+    return results
+
+
+def _generation(db_name: str) -> tuple[int, int]:
+    return _generations.get(None, 0), _generations.get(db_name, 0)
+
+
+async def _load(key: str, query: str, db_name: str, top_k: int):
+    global kb_shared_hits
+    generation = _generation(db_name)
+    shared = await shared_get("kb", key)
+    if shared is not None and _generation(db_name) == generation:
+        kb_shared_hits += 1
+        kb_cache.set(key, shared)
+        return shared
+
+    if KB_BACKEND == "embedded":
+        results = await search_embedded(query, db_name, top_k)
+    else:
+        results = await _search_remote(query, db_name, top_k)
+    if results is None:
+        return []
+    if _generation(db_name) != generation:
+        # Результат получен до сброса кэша: отдаём ожидавшим, но не кэшируем
+        kb_invalidation_stats["stale_loads"] += 1
+        return results
+    kb_cache.set(key, results)
+    await shared_set("kb", key, results, KB_CACHE_TTL)
+    return results
+
+
+def _drop_local(db_name: str = None) -> int:
+    """Сброс в этом процессе: поколение, загрузки в полёте, открытые индексы и локальный кэш."""
+    prefix = f"{db_name}:" if db_name else None
+    _generations[db_name] = _generations.get(db_name, 0) + 1
+    kb_flight.forget_prefix(prefix)
+    # Встроенный индекс мог быть пересобран — следующий запрос откроет новые файлы
+    drop_indexes(db_name)
+    return kb_cache.clear(prefix)
+
+
+async def invalidate_kb_cache(db_name: str = None) -> dict:
+    """
+    Сброс кэша базы знаний (например, после переиндексации). db_name=None — всё.
+    Другие реплики сбрасывают свои локальные кэши по сообщению в канале Redis (если REDIS_URL задан).
+    """
+    local = _drop_local(db_name)
+    kb_invalidation_stats["local"] += 1
+    shared = await shared_clear("kb", f"{db_name}:" if db_name else "")
+    if shared_cache_enabled():
+        await shared_publish(KB_INVALIDATION_CHANNEL, {"db_name": db_name, "source": _instance_id})
+        kb_invalidation_stats["sent"] += 1
+    logger.info(f"Кэш базы знаний сброшен: локально {local}, в общем кэше {shared}")
+    return {"local": local, "shared": shared}
+
+
+def _on_invalidation(message: dict) -> None:
+    if message.get("source") == _instance_id:
+        return
+    _drop_local(message.get("db_name"))
+    kb_invalidation_stats["received"] += 1
+
+
+async def kb_invalidation_listener() -> None:
+    """Фоновая задача: сброс кэша базы знаний, инициированный другой репликой."""
+    await shared_listen(KB_INVALIDATION_CHANNEL, _on_invalidation)
+
+
+def get_kb_cache_stats() -> dict:
+    stats = {
+        **kb_cache.stats(), "shared_hits": kb_shared_hits, "singleflight": kb_flight.stats(),
+        "invalidations": dict(kb_invalidation_stats), "backend": KB_BACKEND,
+    }
+    if KB_BACKEND == "embedded":
+        stats["vector_index"] = get_vector_index_stats()
+    return stats
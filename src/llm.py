@@ -0,0 +1,257 @@
+import os
+import time
+import re
+import hashlib
+import logging
+from openai import AsyncOpenAI
+from src.prompts import SYSTEM_PROMPT, ANSWER_CLASSIFIER_PROMPT
+from src.cache import TTLCache, MISSING
+from src.singleflight import SingleFlight
+from src.shared_cache import shared_get, shared_set
+from src.metrics import track_stage, stage_seconds, llm_tokens
+from src.llm_gateway import call_llm, llm_stream
+
+
+logger = logging.getLogger(__name__)
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini-2024-07-18")
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
+# Кэш ответов: temperature=0 и одинаковый промпт дают по сути одинаковый ответ
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+
+_client = None
+
+answer_cache = TTLCache("llm", LLM_CACHE_SIZE, LLM_CACHE_TTL)
+answer_cache_savings = {"input_tokens": 0, "output_tokens": 0, "latency_seconds": 0.0}
+llm_flight = SingleFlight("llm")
+
+
+def init_llm() -> None:
+    """Создаёт единый AsyncOpenAI-клиент на всё приложение."""
+    global _client
+    if _client is None:
+        # Повторы делает src/llm_gateway.py (с общим бюджетом), а не клиент
+        _client = AsyncOpenAI(timeout=OPENAI_TIMEOUT, max_retries=0)
+
+
+async def close_llm() -> None:
+    global _client
+    if _client is not None:
+        await _client.close()
+    _client = None
+
+
+def get_llm() -> AsyncOpenAI:
+    if _client is None:
+        raise RuntimeError("OpenAI-клиент не инициализирован: init_llm() не вызывался")
+    return _client
+
+
+def build_messages(user_prompt: str) -> list[dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+    ]
+
+
+def build_metadata(user_prompt: str, input_tokens: int, output_tokens: int) -> dict:
+    return {
+        "system_prompt": SYSTEM_PROMPT,
+        "user_prompt": user_prompt,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens
+    }
+
+
+def count_tokens(metadata: dict) -> None:
+    llm_tokens.inc(metadata["input_tokens"], direction="input")
+    llm_tokens.inc(metadata["output_tokens"], direction="output")
+
+
+def answer_cache_key(user_prompt: str, model: str = None, system_prompt: str = None) -> str:
+    raw = "\0".join([model or OPENAI_MODEL, system_prompt or SYSTEM_PROMPT, user_prompt])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def _get_cached_answer(user_prompt: str):
+    """(answer, metadata) из кэша с пометкой о сэкономленных токенах, либо None."""
+    key = answer_cache_key(user_prompt)
+    entry = answer_cache.get(key)
+    if entry is MISSING:
+        entry = await shared_get("llm", key)
+        if entry is None:
+            return None
+        answer_cache.set(key, entry)
+
+    answer_cache_savings["input_tokens"] += entry["input_tokens"]
+    answer_cache_savings["output_tokens"] += entry["output_tokens"]
+    answer_cache_savings["latency_seconds"] += entry["latency"]
+
+    # Фактически токены не потрачены; сэкономленное — в metadata["cache"]
+    metadata = build_metadata(user_prompt, 0, 0)
+    metadata["cache"] = {
+        "hit": True,
+        "saved_input_tokens": entry["input_tokens"],
+        "saved_output_tokens": entry["output_tokens"],
+        "saved_latency_ms": round(entry["latency"] * 1000),
+    }
+    return entry["answer"], metadata
+
+
+async def _store_answer(user_prompt: str, answer: str, metadata: dict, latency: float) -> None:
+    entry = {
+        "answer": answer,
+        "input_tokens": metadata["input_tokens"],
+        "output_tokens": metadata["output_tokens"],
+        "latency": latency,
+    }
+    key = answer_cache_key(user_prompt)
+    answer_cache.set(key, entry)
+    await shared_set("llm", key, entry, LLM_CACHE_TTL)
+
+
+async def ask_llm(user_prompt: str, use_cache: bool = False):
+    """
+    Обычный (не потоковый) запрос к OpenAI. Возвращает (answer, metadata).
+    use_cache=True — точный кэш по (model, system prompt, user prompt);
+    для персонализированных промптов его следует выключать.
+    """
+    if not use_cache:
+        answer, metadata, _ = await _complete(user_prompt)
+        return answer, metadata
+
+    cached = await _get_cached_answer(user_prompt)
+    if cached is not None:
+        return cached
+
+    # Одинаковые одновременные промпты — один запрос в OpenAI на всех
+    (answer, metadata, latency), leader = await llm_flight.do(
+        answer_cache_key(user_prompt), lambda: _complete(user_prompt, store=True)
+    )
+    if leader:
+        return answer, {**metadata, "cache": {"hit": False}}
+
+    # Ожидавший чужого запроса токены не тратил
+    answer_cache_savings["input_tokens"] += metadata["input_tokens"]
+    answer_cache_savings["output_tokens"] += metadata["output_tokens"]
+    coalesced = build_metadata(user_prompt, 0, 0)
+    coalesced["cache"] = {
+        "hit": False,
+        "coalesced": True,
+        "saved_input_tokens": metadata["input_tokens"],
+        "saved_output_tokens": metadata["output_tokens"],
+    }
+    return answer, coalesced
+
+
+async def _complete(user_prompt: str, store: bool = False):
+    started = time.perf_counter()
+    with track_stage("llm"):
+        completion = await call_llm(lambda: get_llm().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=build_messages(user_prompt),
+            temperature=0
+        ))
+    latency = time.perf_counter() - started
+
+    answer = completion.choices[0].message.content
+    metadata = build_metadata(
+        user_prompt,
+        completion.usage.prompt_tokens,
+        completion.usage.completion_tokens
+    )
+    count_tokens(metadata)
+    if store:
+        await _store_answer(user_prompt, answer, metadata, latency)
+    return answer, metadata, latency
+
+
+async def stream_llm(user_prompt: str, use_cache: bool = False):
+    """
+    Потоковый запрос к OpenAI.
+    Отдаёт кусочки ответа ("delta", text), а в конце — ("done", (answer, metadata)).
+    Токены берутся из финального чанка usage (stream_options.include_usage).
+    При попадании в кэш ответ отдаётся одним куском.
+    """
+    if use_cache:
+        cached = await _get_cached_answer(user_prompt)
+        if cached is not None:
+            yield "delta", cached[0]
+            yield "done", cached
+            return
+
+    started = time.perf_counter()
+    parts = []
+    input_tokens = 0
+    output_tokens = 0
+    # Этап llm_stream — от запроса до последнего чанка (вместе с отдачей клиенту);
+    # слот gateway занят на весь поток (но не на паузы между повторами)
+    with track_stage("llm_stream"):
+        async with llm_stream(lambda: get_llm().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=build_messages(user_prompt),
+            temperature=0,
+            stream=True,
+            stream_options={"include_usage": True}
+        )) as stream:
+            try:
+                first_chunk = True
+                async for chunk in stream:
+                    if first_chunk:
+                        stage_seconds.observe(time.perf_counter() - started, stage="llm_first_token")
+                        first_chunk = False
+                    if chunk.usage is not None:
+                        input_tokens = chunk.usage.prompt_tokens
+                        output_tokens = chunk.usage.completion_tokens
+                    for choice in chunk.choices:
+                        delta = choice.delta.content if choice.delta else None
+                        if delta:
+                            parts.append(delta)
+                            yield "delta", delta
+            finally:
+                # При досрочном закрытии генератора (клиент ушёл) соединение с OpenAI рвём сразу
+                await stream.close()
+
+    answer = "".join(parts)
+    metadata = build_metadata(user_prompt, input_tokens, output_tokens)
+    count_tokens(metadata)
+    if use_cache:
+        metadata["cache"] = {"hit": False}
+        await _store_answer(user_prompt, answer, metadata, time.perf_counter() - started)
+    yield "done", (answer, metadata)
+
+
+async def classify_answer(user_prompt: str) -> int:
+    """Номер варианта ответа, выбранного моделью (0 — ни один не подошёл или ответ не разобран)."""
+    with track_stage("llm_answer_match"):
+        completion = await call_llm(lambda: get_llm().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": ANSWER_CLASSIFIER_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0,
+            max_tokens=5
+        ))
+    count_tokens(build_metadata(user_prompt, completion.usage.prompt_tokens, completion.usage.completion_tokens))
+    found = re.search(r"\d+", completion.choices[0].message.content or "")
+    return int(found.group(0)) if found else 0
+
+
+async def embed_texts(texts: list[str], model: str) -> list[list[float]]:
+    """Эмбеддинги текстов (в том же порядке) — для встроенного индекса базы знаний."""
+    with track_stage("embedding"):
+        response = await call_llm(lambda: get_llm().embeddings.create(model=model, input=texts))
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def get_llm_cache_stats() -> dict:
+    return {
+        **answer_cache.stats(),
+        "saved_input_tokens": answer_cache_savings["input_tokens"],
+        "saved_output_tokens": answer_cache_savings["output_tokens"],
+        "saved_latency_seconds": round(answer_cache_savings["latency_seconds"], 3),
+        "singleflight": llm_flight.stats(),
+    }
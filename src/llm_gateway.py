@@ -0,0 +1,304 @@
+import os
+import math
+import time
+import random
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, AsyncExitStack
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+from src.metrics import Counter, Histogram, register_collector
+
+
+logger = logging.getLogger(__name__)
+
+# Допуск запросов к OpenAI: не больше LLM_MAX_CONCURRENCY одновременных вызовов,
+# остальные ждут в очереди длиной LLM_QUEUE_SIZE не дольше LLM_QUEUE_TIMEOUT секунд.
+# Переполнение очереди и истёкшее ожидание — быстрый отказ (503 с Retry-After), а не бесконечное ожидание.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "64"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+
+# Лимит на пользователя (token bucket): LLM_USER_RATE_PER_MIN запросов в минуту, всплеск до LLM_USER_BURST; 0 — без лимита
+LLM_USER_RATE_PER_MIN = float(os.getenv("LLM_USER_RATE_PER_MIN", "20"))
+LLM_USER_BURST = int(os.getenv("LLM_USER_BURST", "5"))
+LLM_USER_BUCKETS = int(os.getenv("LLM_USER_BUCKETS", "100000"))
+
+# Повторы при 429/5xx/сетевых ошибках (сам клиент OpenAI не повторяет — см. src/llm.py).
+# Бюджет: каждый запрос добавляет LLM_RETRY_BUDGET_RATIO повтора, плюс LLM_RETRY_MIN_PER_SEC в секунду,
+# чтобы при массовых ошибках повторы не умножали нагрузку на OpenAI.
+LLM_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+LLM_RETRY_BUDGET_RATIO = float(os.getenv("LLM_RETRY_BUDGET_RATIO", "0.1"))
+LLM_RETRY_MIN_PER_SEC = float(os.getenv("LLM_RETRY_MIN_PER_SEC", "1"))
+
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+llm_queue_wait = Histogram("llm_queue_wait_seconds", "Ожидание слота для запроса к OpenAI")
+llm_rejected = Counter("llm_rejected_total", "Запросы к OpenAI, отклонённые до вызова", ("reason",))
+llm_retries = Counter("llm_retries_total", "Повторы запросов к OpenAI", ("reason",))
+
+
+class LLMUnavailable(Exception):
+    """Запрос к LLM не выполнен из-за перегрузки; retry_after — через сколько секунд стоит повторить."""
+
+    status_code = 503
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class LLMRateLimited(LLMUnavailable):
+    status_code = 429
+
+
+class RetryBudget:
+    def __init__(self, ratio: float, min_per_sec: float):
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.capacity = max(1.0, min_per_sec * 10)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self.exhausted = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.min_per_sec)
+        self._updated = now
+
+    def deposit(self) -> None:
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.exhausted += 1
+        return False
+
+
+class LLMGateway:
+    def __init__(self, max_concurrency: int, queue_size: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters = deque()
+        # Скользящее среднее длительности вызова — для оценки Retry-After
+        self._avg_call = 1.0
+        self.stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+
+    def retry_after(self) -> int:
+        backlog = (len(self._waiters) + 1) / max(1, self.max_concurrency)
+        return max(1, min(60, math.ceil(backlog * self._avg_call)))
+
+    def _reject(self, reason: str) -> LLMUnavailable:
+        self.stats[f"rejected_{reason}"] += 1
+        llm_rejected.inc(reason=reason)
+        return LLMUnavailable(reason, self.retry_after())
+
+    async def _acquire(self) -> None:
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            raise self._reject("queue_full")
+
+        self.stats["queued"] += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже передан нам, но ждать его мы больше не будем — отдаём следующему
+                self._release()
+            else:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise self._reject("timeout")
+
+    def _release(self) -> None:
+        # Слот переходит первому живому ожидающему, счётчик active не меняется
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        started = time.perf_counter()
+        await self._acquire()
+        llm_queue_wait.observe(time.perf_counter() - started)
+        self.stats["admitted"] += 1
+        call_started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._avg_call = 0.9 * self._avg_call + 0.1 * (time.perf_counter() - call_started)
+            self._release()
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "active": self.active,
+            "queue_depth": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "queue_size": self.queue_size,
+            "avg_call_seconds": round(self._avg_call, 3),
+        }
+
+
+class UserRateLimiter:
+    """Token bucket на пользователя; корзины давно не приходивших пользователей вытесняются (LRU)."""
+
+    def __init__(self, rate_per_min: float, burst: int, max_users: int):
+        self.rate = rate_per_min / 60
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = OrderedDict()      # user_id -> [tokens, updated_at]
+        self.limited = 0
+
+    def check(self, user_id: str) -> None:
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [float(self.burst), now]
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return
+        self.limited += 1
+        llm_rejected.inc(reason="user_rate")
+        raise LLMRateLimited("user_rate", math.ceil((1 - bucket[0]) / self.rate))
+
+
+gateway = LLMGateway(LLM_MAX_CONCURRENCY, LLM_QUEUE_SIZE, LLM_QUEUE_TIMEOUT)
+user_limiter = UserRateLimiter(LLM_USER_RATE_PER_MIN, LLM_USER_BURST, LLM_USER_BUCKETS)
+retry_budget = RetryBudget(LLM_RETRY_BUDGET_RATIO, LLM_RETRY_MIN_PER_SEC)
+
+
+def check_user_rate(user_id: str) -> None:
+    """Бросает LLMRateLimited, если пользователь исчерпал свой лимит запросов к LLM."""
+    user_limiter.check(user_id)
+
+
+def _retry_reason(error: Exception):
+    """Причина для повтора или None, если ошибку повторять бессмысленно."""
+    if isinstance(error, APITimeoutError):
+        return "timeout"
+    if isinstance(error, APIConnectionError):
+        return "connection"
+    if isinstance(error, APIStatusError) and error.status_code in RETRYABLE_STATUSES:
+        return str(error.status_code)
+    return None
+
+
+def _server_retry_after(error: Exception):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+async def with_retries(make_call):
+    """
+    make_call() -> корутина вызова OpenAI. Повторяет при 429/5xx/сетевых ошибках
+    с экспоненциальной задержкой и jitter (не меньше Retry-After сервера), пока хватает бюджета.
+    """
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        try:
+            return await make_call()
+        except Exception as e:
+            reason = _retry_reason(e)
+            if reason is None:
+                raise
+            if attempt >= LLM_MAX_RETRIES or not retry_budget.withdraw():
+                if reason in ("429", "503"):
+                    # OpenAI сам ограничивает нас или перегружен — отвечаем клиенту 503, а не 500
+                    retry_after = _server_retry_after(e) or gateway.retry_after()
+                    raise LLMUnavailable(f"upstream_{reason}", max(1, math.ceil(retry_after))) from e
+                raise
+            delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * (2 ** attempt)))
+            delay = max(delay, min(LLM_RETRY_MAX_DELAY, _server_retry_after(e) or 0))
+            attempt += 1
+            llm_retries.inc(reason=reason)
+            logger.warning(f"OpenAI: {reason}, повтор {attempt}/{LLM_MAX_RETRIES} через {delay:.2f} с")
+            await asyncio.sleep(delay)
+
+
+async def call_llm(make_call):
+    """
+    Вызов OpenAI через общий лимит конкурентности, с повторами.
+    Слот берётся на каждую попытку: паузы между повторами его не занимают.
+    """
+    async def attempt():
+        async with gateway.slot():
+            return await make_call()
+
+    return await with_retries(attempt)
+
+
+@asynccontextmanager
+async def llm_stream(make_call):
+    """
+    Потоковый вызов: async with llm_stream(make_call) as stream.
+    Слот берётся на каждую попытку открыть поток, а после успешной держится до выхода из блока.
+    """
+    async with AsyncExitStack() as held:
+        async def attempt():
+            slot = AsyncExitStack()
+            await slot.enter_async_context(gateway.slot())
+            try:
+                stream = await make_call()
+            except BaseException:
+                await slot.aclose()
+                raise
+            held.push_async_callback(slot.aclose)
+            return stream
+
+        yield await with_retries(attempt)
+
+
+def get_llm_gateway_stats() -> dict:
+    return {
+        **gateway.get_stats(),
+        "user_rate_limited": user_limiter.limited,
+        "tracked_users": len(user_limiter._buckets),
+        "retry_budget_tokens": round(retry_budget.tokens, 2),
+        "retry_budget_exhausted": retry_budget.exhausted,
+    }
+
+
+def collect_gateway_metrics() -> list:
+    return [
+        ("llm_queue_depth", "gauge", "Запросы к OpenAI в очереди за слотом", [({}, len(gateway._waiters))]),
+        ("llm_in_flight", "gauge", "Выполняющиеся запросы к OpenAI", [({}, gateway.active)]),
+    ]
+
+
+register_collector(collect_gateway_metrics)
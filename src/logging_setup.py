@@ -0,0 +1,190 @@
+import os
+import sys
+import copy
+import json
+import uuid
+import queue
+import random
+import hashlib
+import logging
+import logging.handlers
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+
+# Логи пишутся фоновым потоком: в event loop запись только кладётся в очередь,
+# форматирование и вывод — в QueueListener. Уровень и формат задаются из окружения.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()                  # json | text
+LOG_LIBRARY_LEVEL = os.getenv("LOG_LIBRARY_LEVEL", "WARNING").upper()  # botocore, httpx, openai, ...
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "256"))
+# Доля запросов, для которых в лог попадает (урезанный и обезличенный) текст промпта
+LOG_PROMPT_SAMPLE_RATE = float(os.getenv("LOG_PROMPT_SAMPLE_RATE", "0"))
+
+NOISY_LOGGERS = ("botocore", "aiobotocore", "boto3", "urllib3", "httpx", "httpcore", "openai", "asyncio")
+
+# Стандартные атрибуты LogRecord: всё остальное — поля из extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+request_id_var = ContextVar("request_id", default="-")
+
+_listener = None
+_queue_handler = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который не форматирует сообщение в вызывающем потоке
+    и не блокирует его: при переполнении очереди запись отбрасывается и считается.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        # request_id берём здесь: contextvars фонового потока о запросе не знают
+        record.request_id = request_id_var.get()
+        if record.exc_info:
+            # traceback нельзя передавать в другой поток «как есть» — рендерим сразу
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def setup_logging() -> None:
+    """Настраивает корневой логгер: очередь + фоновый поток. Повторный вызов ничего не делает."""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] [%(request_id)s] %(name)s: %(message)s"))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(LOG_LIBRARY_LEVEL)
+
+
+def stop_logging() -> None:
+    """Дописывает оставшиеся в очереди записи (вызывается при shutdown)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logging_stats() -> dict:
+    return {
+        "queued": _queue_handler.queue.qsize() if _queue_handler is not None else 0,
+        "dropped": _queue_handler.dropped if _queue_handler is not None else 0,
+    }
+
+
+# --- ограничение размера и обезличивание ---
+
+def truncate_field(text: str, limit: int = None) -> str:
+    """Строка не длиннее limit символов; от длинной остаются начало, длина и короткий хэш."""
+    limit = LOG_MAX_FIELD_CHARS if limit is None else limit
+    text = "" if text is None else str(text)
+    if len(text) <= limit:
+        return text
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+    return f"{text[:limit]}…[+{len(text) - limit} символов, sha256={digest}]"
+
+
+# Строки анамнеза в промпте — персональные данные
+_PII_PREFIXES = ("Имя:", "Дата рождения:", "Дневник здоровья:")
+
+
+def redact_prompt(prompt: str) -> str:
+    lines = []
+    in_diary = False
+    for line in prompt.splitlines():
+        if in_diary:
+            # Многострочный дневник тянется до пустой строки
+            if line:
+                continue
+            in_diary = False
+        for prefix in _PII_PREFIXES:
+            if line.startswith(prefix):
+                line = f"{prefix} <скрыто>"
+                in_diary = prefix == "Дневник здоровья:"
+                break
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def should_sample(rate: float = None) -> bool:
+    rate = LOG_PROMPT_SAMPLE_RATE if rate is None else rate
+    return rate > 0 and random.random() < rate
+
+
+class RequestIdMiddleware:
+    """
+    ASGI-middleware: request_id из заголовка X-Request-ID (или новый) для всех логов запроса;
+    тот же id возвращается в ответе.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex[:16]
+        token = request_id_var.set(request_id)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id_var.reset(token)
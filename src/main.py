@@ -1,34 +1,82 @@
-from fastapi import FastAPI, Request, HTTPException, Form, Body
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi import FastAPI, Request, HTTPException, Body
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 import os
 import logging
-import httpx
-import logging
-import aioboto3
 import uvicorn
 import asyncio
 import json
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
-from openai import OpenAI
-from src.prompts import SYSTEM_PROMPT
-import pathlib
-import time
-from datetime import datetime, timezone, timedelta
-
+from jinja2 import Environment, FileSystemLoader
 
-# Load environment variables
+# Load environment variables: до импорта src.*, модули читают настройки при импорте
 load_dotenv()
 
-# Initialize logging
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(message)s")
+from src.llm import init_llm, close_llm, ask_llm, stream_llm, get_llm_cache_stats
+from src.scenario_registry import reload_scenarios, get_scenario, scenario_reload_worker
+from src.answer_router import route_answer, get_answer_router_stats
+from src.user_ingest import ingest_users, update_user_profile
+from src.scenario_state import (
+    SCENARIO_HISTORY_LIMIT, ANSWER_PREFIX, make_entry, make_state, parse_state, compact_history, cap_history
+)
+from src.llm_gateway import LLMUnavailable, LLMRateLimited, check_user_rate, get_llm_gateway_stats
+from src.db_manager import init_dynamodb, close_dynamodb, get_dynamodb, TABLE_NAME
+from src.user_history import append_history, parse_version
+from src.user_listing import (
+    iter_users_page, parallel_scan_users, decode_cursor, USERS_PAGE_SIZE, USERS_MAX_PAGE_SIZE,
+    USERS_EXPORT_MAX_SEGMENTS
+)
+from src.conversation_store import (
+    append_messages, get_last_messages, ensure_conversation_table, make_ts,
+    CONVERSATION_HISTORY_LIMIT, CONVERSATION_ENSURE_TABLE
+)
+from src.http_clients import init_http_clients, close_http_clients, get_http_stats
+from src.welcome import put_into_welcome_queue
+from src.welcome_scheduler import welcome_worker, get_welcome_stats
+from src.precomputed_answers import (
+    request_gpt_prompt, get_precomputed_answer, precompute_worker, get_precomputed_stats, PRECOMPUTE_ANSWERS
+)
+from src.knowledge_base import (
+    query_faiss_service, invalidate_kb_cache, kb_invalidation_listener, get_kb_cache_stats, KB_BACKEND
+)
+from src.vector_index import load_indexes
+from src.shared_cache import init_shared_cache, close_shared_cache
+from src.logging_setup import (
+    setup_logging, stop_logging, get_logging_stats, RequestIdMiddleware, should_sample, truncate_field, redact_prompt
+)
+from src.metrics import (
+    MetricsMiddleware, track_stage, stage_seconds, register_collector, render_metrics
+)
+from src.prompt_builder import PromptBuilder, init_tokenizer
+from src.profile_cache import (
+    get_profile, update_profile, invalidate_profile, profile_invalidation_listener, get_profile_cache_stats
+)
+from src.write_behind import (
+    register_write_handler, enqueue_write, start_write_behind, stop_write_behind, get_write_behind_stats
+)
+import time
+
+# Initialize logging: JSON через фоновый поток, уровень из LOG_LEVEL (см. src/logging_setup.py)
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# Таймауты этапов подготовки ответа, секунды
+STAGE_TIMEOUT_PROFILE = float(os.getenv("STAGE_TIMEOUT_PROFILE", "2"))
+STAGE_TIMEOUT_HISTORY = float(os.getenv("STAGE_TIMEOUT_HISTORY", "2"))
+STAGE_TIMEOUT_KNOWLEDGE = float(os.getenv("STAGE_TIMEOUT_KNOWLEDGE", "3"))
+
 # Initialize FastAPI app
 app = FastAPI()
 
+# request_id для логов и заголовка X-Request-ID
+app.add_middleware(RequestIdMiddleware)
+
+# Длительность и статусы всех HTTP-запросов (включая отдачу потоковых ответов)
+app.add_middleware(MetricsMiddleware)
+
 # Enable CORS
 app.add_middleware(
     CORSMiddleware,
@@ -38,91 +86,99 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize templates
-templates = Jinja2Templates(directory="src/templates")
+async def timed_stream(stage: str, chunks):
+    """Оборачивает потоковое тело ответа, чтобы замерить его генерацию целиком."""
+    with track_stage(stage):
+        async for chunk in chunks:
+            yield chunk
+
+
+def collect_component_metrics():
+    """Счётчики, которые уже ведут модули (кэши, пулы, очередь записи), — в формате /metrics."""
+    caches = {"kb": get_kb_cache_stats(), "llm": get_llm_cache_stats(), "profile": get_profile_cache_stats()}
+    http = get_http_stats()
+    write_behind = get_write_behind_stats()
+    return [
+        ("cache_hits_total", "counter", "Попадания в локальные кэши",
+         [({"cache": name}, stats["hits"]) for name, stats in caches.items()]),
+        ("cache_misses_total", "counter", "Промахи локальных кэшей",
+         [({"cache": name}, stats["misses"]) for name, stats in caches.items()]),
+        ("cache_evictions_total", "counter", "Вытеснения из локальных кэшей",
+         [({"cache": name}, stats["evictions"]) for name, stats in caches.items()]),
+        ("cache_entries", "gauge", "Размер локальных кэшей",
+         [({"cache": name}, stats["size"]) for name, stats in caches.items()]),
+        ("singleflight_deduplicated_total", "counter", "Запросы, склеенные с уже выполняющимися",
+         [({"cache": name}, stats["singleflight"]["deduplicated"]) for name, stats in caches.items()]),
+        ("llm_cache_saved_tokens_total", "counter", "Токены, сэкономленные кэшем ответов",
+         [({"direction": "input"}, caches["llm"]["saved_input_tokens"]),
+          ({"direction": "output"}, caches["llm"]["saved_output_tokens"])]),
+        ("http_client_requests_total", "counter", "Запросы к внешним сервисам",
+         [({"upstream": name}, stats["requests"]) for name, stats in http.items()]),
+        ("http_client_connections_opened_total", "counter", "Новые соединения к внешним сервисам",
+         [({"upstream": name}, stats["connections_opened"]) for name, stats in http.items()]),
+        ("write_behind_queued", "gauge", "Задания в очереди отложенной записи",
+         [({}, write_behind["queued"])]),
+        ("write_behind_jobs_total", "counter", "Задания отложенной записи по исходу",
+         [({"result": key}, write_behind[key]) for key in ("written", "retries", "spooled", "replayed", "dropped")]),
+    ]
+
+
+register_collector(collect_component_metrics)
 
-# DynamoDB Configuration
-DYNAMODB_ENDPOINT = os.getenv("DYNAMODB_ENDPOINT", "http://localhost:8001")
-AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID", "dummy")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY", "dummy")
-AWS_REGION = os.getenv("AWS_REGION", "us-west-2")
 
-WELCOME_TABLE = "WelcomeQueue"
-MESSENGER_BASE_URL = os.getenv("MESSENGER_BASE_URL", "http://localhost:9000")
-WELCOME_DELAY_MIN = int(os.getenv("WELCOME_DELAY_MINUTES", "10"))
-WELCOME_CHECK_INTERVAL = int(os.getenv("WELCOME_CHECK_INTERVAL", "600"))
+# Initialize templates
+templates = Jinja2Templates(directory="src/templates")
+# Отдельное окружение для потокового (async) рендера больших страниц
+stream_templates = Environment(loader=FileSystemLoader("src/templates"), autoescape=True, enable_async=True)
 
 # TABLE_NAME = "Users"
 # FAISS_SERVICE_URL = "http://172.17.0.1:8010/search"
 # db = None
 
-TABLE_NAME = os.getenv("TABLE_NAME", "Users")
-FAISS_SERVICE_URL = os.getenv("FAISS_SERVICE_URL", "http://172.17.0.1:8010/search")
 
 # --- Utility Functions ---
 async def get_dynamodb_resource():
-    session = aioboto3.Session()
-    async with session.client(
-        "dynamodb",
-        endpoint_url=DYNAMODB_ENDPOINT,
-        region_name=AWS_REGION,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    ) as dynamodb:
-        return dynamodb
-
-
-async def query_faiss_service(query: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            FAISS_SERVICE_URL,
-            json={"db_name": "db_diseases", "query": query, "top_k": 3}
-        )
-        if response.status_code == 200:
-            return response.json().get("results", [])
-        else:
-            logger.error(f"Ошибка запроса в faiss_service: {response.text}")
-            return []
+    # Общий клиент из пула, открытого при старте приложения (см. src/db_manager.py)
+    return get_dynamodb()
+
 
 async def get_user_data_from_db(user_id: str) -> dict:
+    # Профиль читается через кэш (src/profile_cache.py); пути записи его обновляют или сбрасывают
+    return await get_profile(user_id, load_user_data_from_db)
+
+
+async def load_user_data_from_db(user_id: str) -> dict:
     try:
-        async with aioboto3.Session().client(
-            "dynamodb",
-            endpoint_url=DYNAMODB_ENDPOINT,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            region_name=AWS_REGION,
-        ) as dynamodb:
+        dynamodb = get_dynamodb()
+        # История диалога хранится в отдельной таблице (src/conversation_store.py),
+        # поэтому старый атрибут conversation_history здесь не читаем
+        with track_stage("dynamo_get_profile"):
             response = await dynamodb.get_item(
                 TableName=TABLE_NAME,
-                Key={"user_id": {"S": user_id}}
+                Key={"user_id": {"S": user_id}},
+                ProjectionExpression="user_id, #name, birthday, health_diary, scenario_history, scenario_state, #version",
+                ExpressionAttributeNames={"#name": "name", "#version": "version"}
             )
-            user_data = response.get("Item")
-            if not user_data:
-                return None
-
-            # Десериализация conversation_history
-            conversation_history_str = user_data.get("conversation_history", {}).get("S", "[]")
-            try:
-                conversation_history = json.loads(conversation_history_str)
-            except json.JSONDecodeError:
-                conversation_history = []
-
-            # Десериализация scenario_history
-            scenario_history_str = user_data.get("scenario_history", {}).get("S", "[]")
-            try:
-                scenario_history = json.loads(scenario_history_str)
-            except json.JSONDecodeError:
-                scenario_history = []
-
-            return {
-                "id": user_data.get("user_id", {}).get("S", ""),
-                "name": user_data.get("name", {}).get("S", ""),
-                "birthday": user_data.get("birthday", {}).get("S", ""),
-                "health_diary": user_data.get("health_diary", {}).get("S", ""),
-                "conversation_history": conversation_history,
-                "scenario_history": scenario_history
-            }
+        user_data = response.get("Item")
+        if not user_data:
+            return None
+
+        # Десериализация scenario_history
+        scenario_history_str = user_data.get("scenario_history", {}).get("S", "[]")
+        try:
+            scenario_history = json.loads(scenario_history_str)
+        except json.JSONDecodeError:
+            scenario_history = []
+
+        return {
+            "id": user_data.get("user_id", {}).get("S", ""),
+            "name": user_data.get("name", {}).get("S", ""),
+            "birthday": user_data.get("birthday", {}).get("S", ""),
+            "health_diary": user_data.get("health_diary", {}).get("S", ""),
+            "scenario_history": scenario_history,
+            "scenario_state": parse_state(user_data),
+            "version": parse_version(user_data)
+        }
     except ClientError as e:
         logger.error(f"Ошибка при запросе к таблице Users: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при запросе к базе данных.")
@@ -131,144 +187,74 @@ async def get_user_data_from_db(user_id: str) -> dict:
         raise HTTPException(status_code=500, detail="Общая ошибка при запросе к базе данных.")
 
 
-async def get_chat_messages(chat_id: str, user_id: str) -> list[dict]:
-    url = f"{MESSENGER_BASE_URL}/internal/messenger/last-messages-by-chat"
-    payload = {"userId": user_id, "chatIds": [chat_id]}
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, json=payload, timeout=10)
-        resp.raise_for_status()
-        # правильный ключ – "data"
-        items = resp.json().get("data", [])
-        return items[0:1]                      # вернём хотя бы один элемент, если есть
-
-
-
-async def send_welcome_message(chat_id: str, user_id: str) -> None:
-    url = f"{MESSENGER_BASE_URL}/internal/messenger"
-    now_ms = int(time.time() * 1000)
-    payload = {
-        "chatId":   chat_id,
-        "time":     now_ms,                     # ← ДОБАВИЛИ
-        "message": (
-            "Hello, beautiful! Welcome to Eshe. "
-            "This isn’t just a period tracker — Eshe is your all-in-one "
-            "wellness companion. Would you like a quick tour of what’s inside?"
-        ),
-        "type":     "SIMPLE",
-        "senderId": "support",
-        "systemAction": {
-            "id":         "welcome_buttons",
-            "text":       "Choose a topic:",
-            "answerType": "BUTTON",
-            "inputType":  "NONE",
-            "buttons": [
-                {"id": "btn_checkups",  "title": "Tell me about Check-Ups"},
-                {"id": "btn_courses",   "title": "Tell me about Mini-Courses"},
-                {"id": "btn_articles",  "title": "Tell me about Articles"},
-                {"id": "btn_calendars", "title": "Tell me about Calendars"}
-            ]
-        }
-    }
-
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, json=payload, timeout=10)
-        if resp.status_code >= 400:           # подробный лог, если снова 4xx/5xx
-            logger.error("Messenger 400-response: %s", resp.text)
-        resp.raise_for_status()
-        logger.info("Welcome-сообщение отправлено user=%s", user_id)
-
-
-
-
-async def put_into_welcome_queue(user_id: str) -> None:
-    async with aioboto3.Session().client(
-        "dynamodb",
-        endpoint_url=DYNAMODB_ENDPOINT,
-        region_name=AWS_REGION,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    ) as dynamodb:
-        try:
-            await dynamodb.put_item(
-                TableName=WELCOME_TABLE,
-                Item={
-                    "user_id": {"S": user_id},
-                    "created_at": {"N": str(int(time.time()))},
-                    "processed": {"BOOL": False},
-                    "failed_attempts": {"N": "0"},
-                },
-                ConditionExpression="attribute_not_exists(user_id)"   # <-- ключевая строка
-            )
-        except ClientError as ce:
-            # «ConditionalCheckFailed» - OK, запись уже была
-            if ce.response["Error"]["Code"] != "ConditionalCheckFailedException":
-                raise
-
-
-async def mark_processed(user_id: str) -> None:
-    async with aioboto3.Session().client(
-        "dynamodb",
-        endpoint_url=DYNAMODB_ENDPOINT,
-        region_name=AWS_REGION,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    ) as dynamodb:
-        await dynamodb.update_item(
-            TableName=WELCOME_TABLE,
-            Key={"user_id": {"S": user_id}},
-            UpdateExpression="SET processed = :p",
-            ExpressionAttributeValues={":p": {"BOOL": True}}
-        )
+# --- Endpoints ---
 
+# Ссылки на фоновые задачи, чтобы корректно остановить их при shutdown
+background_tasks = []
 
-# ─────────────────────────  фоновая задача  ──────────────────────────────────
 
-async def welcome_worker() -> None:
-    """Циклически проверяет WelcomeQueue и отправляет welcome при необходимости."""
-    while True:
-        try:
-            async with aioboto3.Session().client(
-                "dynamodb",
-                endpoint_url=DYNAMODB_ENDPOINT,
-                region_name=AWS_REGION,
-                aws_access_key_id=AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            ) as dynamodb:
-
-                scan_resp = await dynamodb.scan(TableName=WELCOME_TABLE)
-                for item in scan_resp.get("Items", []):
-                    if item.get("processed", {}).get("BOOL"):
-                        continue  # уже обработали
-
-                    user_id = item["user_id"]["S"]
-                    created_at = int(item["created_at"]["N"])
-                    if time.time() - created_at < WELCOME_DELAY_MIN * 60:
-                        continue  # ещё рано
-
-                    chat_id = f"sup:{user_id}"
-                    try:
-                        msgs = await get_chat_messages(chat_id, user_id)
-                        # проверяем, есть ли хоть одно сообщение, где senderId == user_id
-                        has_user_msg = any(m.get("lastMessage", {}).get("senderId") == user_id for m in msgs)
-                        if not has_user_msg:
-                            await send_welcome_message(chat_id, user_id)
-                        # вне зависимости, отправили или юзер уже ответил — помечаем “processed”
-                        await mark_processed(user_id)
-                    except Exception as exc:
-                        logger.error(f"Не удалось обработать user={user_id}: {exc}")
-
-        except Exception as e:
-            logger.exception(f"welcome_worker global error: {e}")
+@app.on_event("startup")
+async def startup_event():
+    await init_dynamodb()
+    await init_http_clients()
+    await init_shared_cache()
+    init_llm()
+    await init_tokenizer()
+    if CONVERSATION_ENSURE_TABLE:
+        await ensure_conversation_table()
+    if KB_BACKEND == "embedded":
+        load_indexes()
+    reload_scenarios()
+    start_write_behind()
+    background_tasks.append(asyncio.create_task(welcome_worker()))
+    background_tasks.append(asyncio.create_task(scenario_reload_worker()))
+    background_tasks.append(asyncio.create_task(profile_invalidation_listener()))
+    background_tasks.append(asyncio.create_task(kb_invalidation_listener()))
+    if PRECOMPUTE_ANSWERS:
+        background_tasks.append(asyncio.create_task(precompute_worker()))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    # Дописываем отложенные записи, пока соединение с DynamoDB ещё открыто
+    await stop_write_behind()
+    await close_llm()
+    await close_shared_cache()
+    await close_http_clients()
+    await close_dynamodb()
+    stop_logging()
+
+@app.get("/stats")
+async def get_stats():
+    """Служебные счётчики: переиспользование соединений HTTP-пулов, кэши и т.п."""
+    return JSONResponse(content={
+        "http": get_http_stats(),
+        "caches": {"kb": get_kb_cache_stats(), "llm": get_llm_cache_stats(), "profile": get_profile_cache_stats()},
+        "write_behind": get_write_behind_stats(),
+        "logging": get_logging_stats(),
+        "welcome": get_welcome_stats(),
+        "scenario_answers": get_answer_router_stats(),
+        "llm_gateway": get_llm_gateway_stats(),
+        "precomputed_answers": get_precomputed_stats()
+    })
 
-        await asyncio.sleep(WELCOME_CHECK_INTERVAL)
 
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в текстовом формате Prometheus."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
-# --- Endpoints ---
+@app.post("/internal/kb/invalidate")
+async def kb_invalidate(payload: dict = Body(default={})):
+    """Хук для сброса кэша базы знаний после переиндексации (db_name — необязательно)."""
+    removed = await invalidate_kb_cache(payload.get("db_name"))
+    return JSONResponse(content={"invalidated": removed})
 
-@app.on_event("startup")
-async def startup_event():
-    asyncio.create_task(welcome_worker())
 
 @app.get("/", response_class=HTMLResponse)
 async def home_page(request: Request):
@@ -276,44 +262,79 @@ async def home_page(request: Request):
 
 
 @app.get("/users", response_class=HTMLResponse)
-async def get_users(request: Request):
+async def get_users(request: Request, limit: int = USERS_PAGE_SIZE, cursor: str = None,
+                    include_history: bool = False):
+    """
+    Страница пользователей: постранично (cursor = LastEvaluatedKey), только поля профиля.
+    Истории читаются лишь при include_history=true. HTML отдаётся потоком.
+    """
+    limit = max(1, min(limit, USERS_MAX_PAGE_SIZE))
     try:
-        dynamodb = await get_dynamodb_resource()
-        response = await dynamodb.scan(TableName=TABLE_NAME)
-        users = response.get("Items", [])
-        if not users:
-            return RedirectResponse(url="/add_user", status_code=303)
+        start_key = decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        formatted_users = []
-        for user in users:
-            # conversation_history
-            conversation_history_str = user.get("conversation_history", {}).get("S", "[]")
-            try:
-                conversation_history = json.loads(conversation_history_str)
-            except json.JSONDecodeError:
-                conversation_history = []
-
-            # scenario_history
-            scenario_history_str = user.get("scenario_history", {}).get("S", "[]")
-            try:
-                scenario_history = json.loads(scenario_history_str)
-            except json.JSONDecodeError:
-                scenario_history = []
-
-            formatted_users.append({
-                "id": user.get("user_id", {}).get("S", ""),
-                "name": user.get("name", {}).get("S", ""),
-                "birthday": user.get("birthday", {}).get("S", ""),
-                "health_diary": user.get("health_diary", {}).get("S", ""),
-                "conversation_history": conversation_history,
-                "scenario_history": scenario_history
-            })
-
-        return templates.TemplateResponse("users_table.html", {"request": request, "users": formatted_users})
+    try:
+        page_state = {"next_cursor": None}
+        users = iter_users_page(limit, start_key, include_history, page_state)
+
+        # Первый элемент читаем заранее: пустую таблицу отправляем на форму добавления
+        first_user = await anext(users, None)
+        if first_user is None and not cursor:
+            return RedirectResponse(url="/add_user", status_code=303)
     except Exception as e:
         logger.error(f"Error retrieving users: {e}")
         raise HTTPException(status_code=500, detail="Failed to retrieve users.")
 
+    async def page_users():
+        if first_user is not None:
+            yield first_user
+        async for user in users:
+            yield user
+
+    template = stream_templates.get_template("users_table.html")
+    return StreamingResponse(
+        timed_stream("template_render_users", template.generate_async(
+            request=request,
+            users=page_users(),
+            page=page_state,
+            limit=limit,
+            include_history=include_history,
+        )),
+        media_type="text/html; charset=utf-8"
+    )
+
+
+@app.get("/users/export")
+async def export_users(segments: int = 4, include_history: bool = False):
+    """Полная выгрузка пользователей в JSON Lines параллельным scan по сегментам."""
+    segments = max(1, min(segments, USERS_EXPORT_MAX_SEGMENTS))
+
+    async def lines():
+        async for user in parallel_scan_users(segments, include_history):
+            yield json.dumps(user, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/users/bulk")
+async def bulk_add_users(request: Request):
+    """
+    Массовая загрузка пользователей: тело — JSON Lines или JSON-массив объектов
+    {"user_id", "name", "birthday", "health_diary"}, читается потоком.
+    Новые пользователи записываются BatchWriteItem и ставятся в WelcomeQueue,
+    у существующих обновляются только поля профиля. Возвращает сводку по записям.
+    """
+    try:
+        summary = await ingest_users(request.stream())
+    except Exception as e:
+        logger.error(f"Error bulk add users: {e}")
+        raise HTTPException(status_code=500, detail="Failed to add users")
+    logger.info(
+        f"Массовая загрузка: получено {summary['received']}, создано {summary['created']}, "
+        f"обновлено {summary['updated']}, ошибок {len(summary['errors'])}"
+    )
+    return JSONResponse(content=summary)
 
 
 @app.get("/add_user", response_class=HTMLResponse)
@@ -332,29 +353,9 @@ async def add_user(payload: dict):
         raise HTTPException(status_code=400, detail="Поле user_id обязательно")
 
     try:
-        dynamodb = await get_dynamodb_resource()
-
-        resp = await dynamodb.get_item(
-            TableName=TABLE_NAME,
-            Key={"user_id": {"S": user_id}}
-        )
-        current = resp.get("Item", {})
-
-        hist_raw = current.get("conversation_history", {}).get("S", "[]")
-        try:
-            conversation_history = json.loads(hist_raw)
-        except json.JSONDecodeError:
-            conversation_history = []
-
-        updated_item = {
-            "user_id": {"S": user_id},
-            "name": {"S": payload.get("name", current.get("name", {}).get("S", ""))},
-            "birthday": {"S": payload.get("birthday", current.get("birthday", {}).get("S", ""))},
-            "health_diary": {"S": payload.get("health_diary", current.get("health_diary", {}).get("S", ""))},
-            "conversation_history": {"S": json.dumps(conversation_history)},
-        }
-
-        await dynamodb.put_item(TableName=TABLE_NAME, Item=updated_item)
+        # Только поля профиля одним UpdateItem (история диалога и сценария не трогается)
+        await update_user_profile(user_id, payload)
+        await invalidate_profile(user_id)
 
         # Кладём в WelcomeQueue (если это первый визит ― условие в put_into_welcome_queue)
         try:
@@ -371,32 +372,91 @@ async def add_user(payload: dict):
 
 
 
-def process_question_sync(user_prompt):
-    # Отправляем запрос в OpenAI
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": user_prompt}
-    ]
+async def run_stage(stage: str, coro, timeout: float, timings: dict, degraded: list = None, default=None):
+    """
+    Выполняет этап подготовки ответа с таймаутом и замеряет его время.
+    degraded задан — ошибка или таймаут не фатальны: этап пропускается и попадает в degraded.
+    """
+    started = time.perf_counter()
+    try:
+        return await asyncio.wait_for(coro, timeout=timeout)
+    except Exception as e:
+        if degraded is None:
+            raise
+        logger.warning(f"Этап {stage} пропущен ({type(e).__name__}: {e}), отвечаем без него")
+        degraded.append(stage)
+        return default
+    finally:
+        timings[stage] = round((time.perf_counter() - started) * 1000, 1)
 
-    client = OpenAI()
-    completion = client.chat.completions.create(
-        model="gpt-4o-mini-2024-07-18",
-        messages=messages,
-        temperature=0
+
+async def build_user_prompt(user_id: str, question: str, use_anamnesis: bool,
+                            use_knowledge_base: bool, use_conversation_history: bool):
+    """
+    Собирает user_prompt с учётом бюджетов токенов по секциям (см. src/prompt_builder.py).
+    Профиль, история и база знаний не зависят друг от друга и читаются параллельно,
+    поэтому подготовка занимает max(этапов), а не их сумму. Медленные история и база знаний
+    отбрасываются по таймауту; без профиля при use_anamnesis ответ не формируется.
+    Возвращает (user_prompt, extra_metadata) с разбивкой токенов и временем этапов.
+    """
+    timings = {}
+    degraded = []
+
+    async def nothing(default=None):
+        return default
+
+    user_data, conversation_history, relevant_chunks = await asyncio.gather(
+        # Профиль нужен только для анамнеза
+        run_stage("profile", get_user_data_from_db(user_id), STAGE_TIMEOUT_PROFILE, timings)
+        if use_anamnesis else nothing(),
+        # Из таблицы истории читаем только последние N сообщений
+        run_stage("history", get_last_messages(user_id, CONVERSATION_HISTORY_LIMIT), STAGE_TIMEOUT_HISTORY,
+                  timings, degraded, [])
+        if use_conversation_history else nothing([]),
+        run_stage("knowledge", query_faiss_service(question), STAGE_TIMEOUT_KNOWLEDGE, timings, degraded, [])
+        if use_knowledge_base else nothing([]),
     )
 
-    answer = completion.choices[0].message.content
-    input_tokens = completion.usage.prompt_tokens
-    output_tokens = completion.usage.completion_tokens
+    builder = PromptBuilder().set_question(question)
+    if use_anamnesis and user_data:
+        builder.set_anamnesis(user_data)
+    builder.set_history(conversation_history).set_knowledge(relevant_chunks)
+
+    user_prompt, breakdown = builder.build()
+    # В лог — только размеры (постоянная стоимость); сам текст — выборочно, урезанный и без анамнеза
+    logger.info("user_prompt собран", extra={
+        "user_id": user_id,
+        "prompt_chars": len(user_prompt),
+        "prompt_tokens": breakdown["total"],
+        "truncated": breakdown["truncated"],
+        "degraded": degraded,
+    })
+    if should_sample():
+        logger.info("user_prompt (выборка)", extra={"user_id": user_id, "prompt": truncate_field(redact_prompt(user_prompt))})
+    return user_prompt, {"prompt_tokens": breakdown, "stages_ms": timings, "degraded": degraded}
 
-    metadata = {
-        "system_prompt": SYSTEM_PROMPT,
-        "user_prompt": user_prompt,
-        "input_tokens": input_tokens,
-        "output_tokens": output_tokens
-    }
 
-    return answer, metadata
+async def persist_conversation_turn(payload: dict) -> None:
+    # ts задан при постановке в очередь, поэтому повторная запись идемпотентна
+    await append_messages(payload["user_id"], payload["messages"], ts=payload["ts"])
+
+
+register_write_handler("conversation_turn", persist_conversation_turn)
+
+
+def save_conversation_turn(user_id: str, question: str, answer: str) -> None:
+    # Обновление истории диалога в базе данных (всегда), но вне критического пути ответа:
+    # по одному item на сообщение в таблице истории, запись пользователя (и кэш профиля) не трогаем
+    now = int(time.time())
+    new_entry_user = {"role": "user", "message": question, "timestamp": now}
+    new_entry_model = {"role": "model", "message": answer, "timestamp": now}
+
+    enqueue_write("conversation_turn", {
+        "user_id": user_id,
+        "messages": [new_entry_user, new_entry_model],
+        "ts": make_ts(),
+    })
+
 
 @app.get("/process_question", response_class=HTMLResponse)
 async def interact_page(request: Request):
@@ -410,83 +470,27 @@ async def process_question(request: Request, payload: dict = Body(...)):
     use_anamnesis = payload.get("use_anamnesis", False)
     use_knowledge_base = payload.get("use_knowledge_base", False)
     use_conversation_history = payload.get("use_conversation_history", False)  # Новый параметр
+    # Кэш ответов по точному промпту; для персонализированных промптов по умолчанию выключен
+    use_answer_cache = payload.get("use_answer_cache", not (use_anamnesis or use_conversation_history))
 
     if not user_id:
         raise HTTPException(status_code=400, detail="Поле user_id обязательно.")
 
     try:
-        user_prompt = ""
-
-        # Получаем данные пользователя (для истории диалога и анамнеза)
-        user_data = await get_user_data_from_db(user_id)
-        conversation_history = user_data.get("conversation_history", []) if user_data else []
-
-        # Использование анамнеза
-        if use_anamnesis and user_data:
-            user_prompt += f"Информация о пользователе:\n"
-            user_prompt += f"ID: {user_data.get('id', '')}\n"
-            user_prompt += f"Имя: {user_data.get('name', '')}\n"
-            user_prompt += f"Дата рождения: {user_data.get('birthday', '')}\n"
-            user_prompt += f"Дневник здоровья: {user_data.get('health_diary', '')}\n\n"
-
-        # Использование истории диалога в user_prompt
-        if use_conversation_history and conversation_history:
-            history_text = "\n".join(
-                [f"{msg['role']}: {msg['message']}" for msg in conversation_history]
-            )
-            user_prompt += f"История диалога:\n{history_text}\n\n"
-
-        # Использование базы знаний
-        if use_knowledge_base:
-            relevant_chunks = await query_faiss_service(question)
-            if relevant_chunks:
-                user_prompt += "\nИнформация из базы знаний:\n"
-                for idx, chunk in enumerate(relevant_chunks):
-                    user_prompt += f"{idx + 1}. {chunk['text'].strip()}\n"
-
-        # Добавление вопроса
-        user_prompt += (
-            f"\n\nВопрос: {question}. Ответь на вопрос на основе предоставленной информации и собственных "
-            f"знаний. Можно отвечать на вопросы связанные с медициной, здоровьем, врачами, лекарствами и подобной тематикой."
-        )
-
-        logger.info(f"Сформированный user_prompt для пользователя {user_id}: {user_prompt}")
-
-        # Выполнение синхронной функции
-        answer, metadata = await asyncio.to_thread(process_question_sync, user_prompt)
+        # Лимит пользователя проверяем до чтения профиля и базы знаний
+        check_user_rate(user_id)
 
-        # Обновление истории диалога в базе данных (всегда)
-        new_entry_user = {"role": "user", "message": question, "timestamp": int(asyncio.get_event_loop().time())}
-        new_entry_model = {"role": "model", "message": answer, "timestamp": int(asyncio.get_event_loop().time())}
-
-        conversation_history.append(new_entry_user)
-        conversation_history.append(new_entry_model)
-
-        # Ограничение количества хранимых сообщений (например, последние 6)
-        conversation_history = conversation_history[-6:]
+        # Профиль, история и база знаний читаются параллельно
+        user_prompt, prompt_metadata = await build_user_prompt(
+            user_id, question, use_anamnesis, use_knowledge_base, use_conversation_history
+        )
 
-        # Копирование текущих данных пользователя и обновление истории
-        updated_data = user_data.copy() if user_data else {}
-        updated_data["conversation_history"] = conversation_history
+        # Запрос к OpenAI через общий асинхронный клиент (лимит конкурентности и повторы — в llm_gateway)
+        answer, metadata = await ask_llm(user_prompt, use_cache=use_answer_cache)
+        metadata = {**metadata, **prompt_metadata}
 
-        # Сохранение обновленных данных в базе данных
-        async with aioboto3.Session().client(
-            "dynamodb",
-            endpoint_url=DYNAMODB_ENDPOINT,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            region_name=AWS_REGION,
-        ) as dynamodb:
-            await dynamodb.put_item(
-                TableName=TABLE_NAME,
-                Item={
-                    "user_id": {"S": user_id},
-                    "name": {"S": updated_data.get("name", "")},
-                    "birthday": {"S": updated_data.get("birthday", "")},
-                    "health_diary": {"S": updated_data.get("health_diary", "")},
-                    "conversation_history": {"S": json.dumps(updated_data["conversation_history"])}
-                }
-            )
+        # История пишется в фоне (src/write_behind.py), ответ её не ждёт
+        save_conversation_turn(user_id, question, answer)
 
         # Возвращаем JSON-ответ
         return JSONResponse(content={
@@ -494,6 +498,8 @@ async def process_question(request: Request, payload: dict = Body(...)):
             "metadata": metadata
         })
 
+    except LLMUnavailable as e:
+        return overloaded_response(e)
     except Exception as e:
         logger.error(f"Ошибка при обработке вопроса: {e}")
         return JSONResponse(content={
@@ -501,13 +507,101 @@ async def process_question(request: Request, payload: dict = Body(...)):
         }, status_code=500)
 
 
+def overloaded_response(e: LLMUnavailable) -> JSONResponse:
+    """429 (лимит пользователя) или 503 (перегрузка) с Retry-After — клиент может повторить позже."""
+    if isinstance(e, LLMRateLimited):
+        error = "Слишком много запросов, повторите позже"
+    else:
+        error = "Сервис перегружен, повторите запрос позже"
+    logger.warning(f"Запрос отклонён: {e.reason}, Retry-After {e.retry_after} с")
+    return JSONResponse(
+        content={"error": error, "reason": e.reason, "retry_after": e.retry_after},
+        status_code=e.status_code,
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/process_question/stream")
+async def process_question_stream(request: Request, payload: dict = Body(...)):
+    """
+    Потоковый вариант /process_question (Server-Sent Events).
+    События: "delta" — очередной кусок ответа, "done" — полный ответ и metadata,
+    "error" — ошибка. История диалога сохраняется после завершения потока.
+    """
+    user_id = payload.get("user_id")
+    question = payload.get("question")
+    use_anamnesis = payload.get("use_anamnesis", False)
+    use_knowledge_base = payload.get("use_knowledge_base", False)
+    use_conversation_history = payload.get("use_conversation_history", False)
+    # Кэш ответов по точному промпту; для персонализированных промптов по умолчанию выключен
+    use_answer_cache = payload.get("use_answer_cache", not (use_anamnesis or use_conversation_history))
+
+    if not user_id:
+        raise HTTPException(status_code=400, detail="Поле user_id обязательно.")
+
+    try:
+        check_user_rate(user_id)
+        user_prompt, prompt_metadata = await build_user_prompt(
+            user_id, question, use_anamnesis, use_knowledge_base, use_conversation_history
+        )
+        # Первое событие получаем до начала ответа: отказ gateway (очередь, лимит OpenAI)
+        # должен прийти клиенту статусом 503, а не событием "error" в уже начатом потоке
+        events = stream_llm(user_prompt, use_cache=use_answer_cache)
+        first_event = await anext(events)
+    except LLMUnavailable as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logger.error(f"Ошибка при подготовке потокового ответа: {e}")
+        return JSONResponse(content={
+            "error": "Ошибка: невозможно обработать запрос"
+        }, status_code=500)
+
+    async def all_events():
+        yield first_event
+        async for event in events:
+            yield event
+
+    async def event_stream():
+        try:
+            async for kind, value in all_events():
+                if kind == "delta":
+                    yield sse_event("delta", {"text": value})
+                else:
+                    answer, metadata = value
+                    metadata = {**metadata, **prompt_metadata}
+                    save_conversation_turn(user_id, question, answer)
+                    yield sse_event("done", {"answer": answer, "metadata": metadata})
+        except Exception as e:
+            logger.error(f"Ошибка при потоковой обработке вопроса: {e}")
+            yield sse_event("error", {"error": "Ошибка: невозможно обработать запрос"})
+        finally:
+            await close_events()
+
+    async def close_events():
+        # Закрытие stream_llm рвёт поток OpenAI и освобождает слот gateway (повторное — no-op)
+        await events.aclose()
+
+    # При отключении клиента Starlette отменяет отправку, и event_stream может остаться
+    # на yield без finally; фоновая задача ответа выполняется в любом случае и закрывает поток сразу
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(close_events)
+    )
+
+
 @app.post("/scenario/execute")
 async def execute_scenario(payload: dict = Body(...)):
     """
     Универсальный эндпоинт, который принимает:
     - scenarioFileName: название файла сценария (например, "health_ai_assistant_scenario.json")
     - metadata
-    - userAnswer
+    - userAnswer: stepId и selectedButtonId (нажатая кнопка) или text (свободный ответ)
     """
     scenario_filename = payload.get("scenarioFileName")  # Новый параметр
     metadata = payload.get("metadata", {})
@@ -516,14 +610,10 @@ async def execute_scenario(payload: dict = Body(...)):
     if not scenario_filename:
         raise HTTPException(status_code=400, detail="Поле 'scenarioFileName' обязательно")
 
-    # Загружаем сценарий из файла, который находится в папке scenarios/
-    BASE_DIR = pathlib.Path(__file__).parent
-    scenario_path = BASE_DIR / "scenarios" / scenario_filename
-    try:
-        with open(scenario_path, "r", encoding="utf-8") as f:
-            scenario = json.load(f)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Не удалось загрузить сценарий: {str(e)}")
+    # Сценарий берём из реестра, загруженного при старте (без чтения файла)
+    scenario = get_scenario(scenario_filename)
+    if scenario is None:
+        raise HTTPException(status_code=404, detail=f"Сценарий {scenario_filename} не найден")
 
     # Извлекаем ключевые поля
     user_id = metadata.get("userId")
@@ -532,11 +622,10 @@ async def execute_scenario(payload: dict = Body(...)):
     if not user_id:
         raise HTTPException(status_code=400, detail="Поле metadata.userId обязательно")
 
-    # Получаем "steps" из scenario
-    steps = scenario.get("steps", [])
-    # Например, ищем step, на который ссылается user_answer, или первый шаг
+    # Ищем step, на который ссылается user_answer, или первый шаг
     current_step_id = user_answer.get("stepId")
     selected_button_id = user_answer.get("selectedButtonId")
+    answer_text = (user_answer.get("text") or "").strip()
 
     # -- 1. Сохраняем ответ пользователя в БД (по аналогии с разговором) --
     # Загружаем из БД данные пользователя, чтобы объединить историю
@@ -544,107 +633,109 @@ async def execute_scenario(payload: dict = Body(...)):
     if not user_data:
         raise HTTPException(status_code=404, detail=f"Пользователь с ID {user_id} не найден")
 
-    # Предположим, что в user_data мы создадим/храним "scenario_history".
-    # Если нет, инициализируем пустой список.
-    scenario_history = user_data.get("scenario_history", [])
+    # Ответ пользователя для истории: id кнопки или номер распознанного свободного ответа
+    answer_id = selected_button_id
 
-    # Добавим запись о том, что пользователь ответил
+    # Свободный ответ: сначала answerPattern шага (локально), при промахе — LLM
+    reaction = None
+    if current_step_id and answer_text and not selected_button_id:
+        reaction = await route_answer(scenario, current_step_id, answer_text, user_id)
+        if reaction is not None:
+            answer_id = f"{ANSWER_PREFIX}{reaction['answerIndex']}"
+
+    # Кнопка REQUEST_GPT: ответ на её prompt одинаков для всех и готовится заранее
+    gpt_answer = None
+    gpt_prompt = None
     if current_step_id and selected_button_id:
-        scenario_history.append({
-            "role": "user",
-            "stepId": current_step_id,
-            "selectedButtonId": selected_button_id
-        })
+        gpt_prompt = request_gpt_prompt(scenario.buttons.get((current_step_id, selected_button_id)))
+    if gpt_prompt:
+        try:
+            gpt_answer = await get_precomputed_answer(gpt_prompt)
+        except Exception as e:
+            # Шаг сценария показываем и без ответа LLM
+            logger.error(f"Не удалось получить ответ REQUEST_GPT для user={user_id}: {e}")
 
     # -- 2. Определяем, какой шаг дальше показывать --
     #    Либо это первый запрос (нет ответа от пользователя),
     #    либо пользователь уже ответил и нужно перейти к следующему шагу.
+    resolve_started = time.perf_counter()
     next_step_id = None
 
     if current_step_id and selected_button_id:
-        # Ищем в scenario сам шаг current_step_id
-        for st in steps:
-            if st.get("stepId") == current_step_id:
-                # Ищем в buttons кнопку, у которой id == selected_button_id
-                buttons = st.get("buttons", [])
-                for btn in buttons:
-                    if btn.get("id") == selected_button_id:
-                        next_step_id = btn.get("nextActionId")
-                        break
-                break
+        # Переход по индексу (stepId, buttonId) -> nextActionId
+        next_step_id = scenario.next_step_id(current_step_id, selected_button_id)
+    elif current_step_id and answer_text:
+        # Ответ не распознан — показываем тот же шаг ещё раз
+        next_step_id = reaction["nextStepId"] if reaction else current_step_id
     else:
         # Если первый запрос без userAnswer, берем "первый" шаг сценария
-        # Либо если сценарий где-то явно хранит firstStepId
-        next_step_id = scenario.get("firstStepId")
-        # Или можно взять steps[0]["stepId"] для упрощения
+        next_step_id = scenario.first_step_id
 
     if not next_step_id:
         # Если у нас нет next_step_id, возможно это конец сценария
         # или ошибка логики. Пока выкинем исключение.
-        return JSONResponse(content={
+        finished_payload = {
             "message": "Сценарий завершен или не найден следующий шаг.",
             "scenarioFinished": True
-        })
+        }
+        if gpt_prompt:
+            finished_payload["gptAnswer"] = gpt_answer
+        return JSONResponse(content=finished_payload)
 
     # -- 3. Ищем шаг next_step_id и готовим ответ --
-    selected_step = None
-    for st in steps:
-        if st.get("stepId") == next_step_id:
-            selected_step = st
-            break
+    selected_step = scenario.get_step_payload(next_step_id)
+    stage_seconds.observe(time.perf_counter() - resolve_started, stage="scenario_resolve")
 
     if not selected_step:
         # Если не нашли такой шаг - сценарий завершается
-        return JSONResponse(content={
+        finished_payload = {
             "message": "Следующий шаг не найден. Сценарий завершён или содержит ошибку.",
             "scenarioFinished": True
+        }
+        if gpt_prompt:
+            finished_payload["gptAnswer"] = gpt_answer
+        return JSONResponse(content=finished_payload)
+
+    # -- 4. Обновляем scenario_history: один компактный переход (шаги и ответ, без текстов
+    #       сообщений) и текущая позиция в scenario_state
+    new_entries = [make_entry(next_step_id, current_step_id if answer_id else None, answer_id)]
+    state = make_state(scenario_filename, next_step_id)
+
+    # Сохраним в БД одним условным UpdateItem только scenario_history и scenario_state
+    current_history = compact_history(user_data.get("scenario_history", []))
+    current_version = user_data.get("version", 0)
+    new_version = await append_history(
+        user_id,
+        "scenario_history",
+        new_entries,
+        current=current_history,
+        version=current_version,
+        keep_last=SCENARIO_HISTORY_LIMIT,
+        normalize=compact_history,
+        extra={"scenario_state": {"S": state}},
+    )
+    if new_version == current_version + 1:
+        # Записали поверх того, что было в кэше, — обновляем профиль без перечитывания
+        await update_profile(user_id, {
+            "scenario_history": cap_history(current_history + new_entries),
+            "scenario_state": json.loads(state),
+            "version": new_version,
         })
-
-    # -- 4. Обновляем scenario_history, добавляя инфу о том,
-    #       какой шаг мы собираемся показать
-    scenario_history.append({
-        "role": "system",
-        "stepId": next_step_id,
-        "messages": selected_step.get("messages", [])
-    })
-
-    # Сохраним всё назад в БД
-    # (по аналогии с тем, как сохраняется conversation_history)
-    updated_data = user_data.copy()
-    updated_data["scenario_history"] = scenario_history
-
-    # Сохраняем
-    async with aioboto3.Session().client(
-        "dynamodb",
-        endpoint_url=DYNAMODB_ENDPOINT,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=AWS_REGION,
-    ) as dynamodb:
-        await dynamodb.put_item(
-            TableName=TABLE_NAME,
-            Item={
-                "user_id": {"S": user_id},
-                "name": {"S": updated_data.get("name", "")},
-                "birthday": {"S": updated_data.get("birthday", "")},
-                "health_diary": {"S": updated_data.get("health_diary", "")},
-                "conversation_history": {"S": json.dumps(updated_data.get("conversation_history", []))},
-                "scenario_history": {"S": json.dumps(updated_data["scenario_history"])}
-            }
-        )
+    else:
+        # Был конфликт версий: итоговую историю знает только БД
+        await invalidate_profile(user_id)
 
     # -- 5. Готовим ответ, чтобы фронтенд мог показать пользователю шаг --
     response_payload = {
-        "scenarioId": scenario.get("scenarioId"),
+        "scenarioId": scenario.scenario_id,
         "nextStepId": next_step_id,
-        "step": {
-            "stepId": selected_step.get("stepId"),
-            "name": selected_step.get("name"),
-            "messages": selected_step.get("messages", []),
-            "answerType": selected_step.get("answerType"),
-            "buttons": selected_step.get("buttons", [])
-        }
+        "step": selected_step
     }
+    if answer_text and not selected_button_id:
+        response_payload["answerRecognized"] = reaction is not None
+        response_payload["assistantReaction"] = reaction
+    if gpt_prompt:
+        response_payload["gptAnswer"] = gpt_answer
 
     return JSONResponse(content=response_payload)
 
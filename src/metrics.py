@@ -0,0 +1,167 @@
+import time
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# Минимальный экспорт метрик в текстовом формате Prometheus.
+# На горячем пути — только арифметика над словарями; текст собирается при запросе /metrics.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PREFIX = "med_bot"
+
+_metrics = []
+_collectors = []
+
+
+def _labels_text(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Монотонный счётчик с метками: inc(amount, **labels)."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = f"{PREFIX}_{name}"
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_labels_text(self.label_names, key)} {_number(value)}"
+                for key, value in self._values.items()]
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин: observe(value, **labels)."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = f"{PREFIX}_{name}"
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # key -> [счётчики по корзинам (+Inf последняя), сумма, количество]
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> list[str]:
+        lines = []
+        names = self.label_names + ("le",)
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels_text(names, key + (_number(bound),))} {cumulative}")
+            labels = _labels_text(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_number(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+stage_seconds = Histogram("stage_duration_seconds", "Длительность этапов обработки", ("stage",))
+stage_errors = Counter("stage_errors_total", "Ошибки этапов обработки", ("stage",))
+llm_tokens = Counter("llm_tokens_total", "Токены OpenAI", ("direction",))
+http_seconds = Histogram("http_request_duration_seconds", "Длительность HTTP-запросов", ("method", "route"))
+http_responses = Counter("http_responses_total", "HTTP-ответы по статусам", ("method", "route", "status"))
+
+
+@contextmanager
+def track_stage(stage: str):
+    """Замер этапа: время в stage_duration_seconds, исключения — в stage_errors_total."""
+    started = time.perf_counter()
+    try:
+        yield
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage)
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware: длительность и статус каждого HTTP-запроса по шаблону маршрута
+    (/users, а не /users?cursor=...), чтобы число рядов метрик не росло.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Маршрут роутер записывает в тот же scope
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            http_seconds.observe(time.perf_counter() - started, method=scope["method"], route=path)
+            http_responses.inc(method=scope["method"], route=path, status=status)
+
+
+def register_collector(collect) -> None:
+    """
+    collect() -> список (name, kind, help, [(labels_dict, value), ...]).
+    Вызывается только при запросе /metrics — для значений, которые уже считаются в модулях (кэши, пулы).
+    """
+    _collectors.append(collect)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, kind, help_text, samples in collect():
+            full_name = f"{PREFIX}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{full_name}{_labels_text(tuple(labels), tuple(labels.values()))} {_number(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,207 @@
+import os
+import time
+import asyncio
+import logging
+from botocore.exceptions import ClientError
+from src.db_manager import get_dynamodb
+from src.llm import ask_llm, answer_cache_key, OPENAI_MODEL
+from src.scenario_registry import all_scenarios, SCENARIO_RELOAD_INTERVAL
+
+
+logger = logging.getLogger(__name__)
+
+# Кнопки сценариев с onClick=REQUEST_GPT несут фиксированный prompt — ответ на него одинаков
+# для всех пользователей. Ответы считаются заранее (при старте и после перезагрузки сценариев)
+# и хранятся в таблице PRECOMPUTED_ANSWERS_TABLE по ключу answer_cache_key(prompt):
+# ключ включает модель и SYSTEM_PROMPT, поэтому ответ пересчитывается только при смене
+# prompt, модели или системного промпта.
+PRECOMPUTED_ANSWERS_TABLE = os.getenv("PRECOMPUTED_ANSWERS_TABLE", "PrecomputedAnswers")
+PRECOMPUTE_ANSWERS = os.getenv("PRECOMPUTE_ANSWERS", "true").lower() == "true"
+PRECOMPUTE_CONCURRENCY = int(os.getenv("PRECOMPUTE_CONCURRENCY", "4"))
+# Неудавшийся prompt повторяется с экспоненциальной паузой, а не на каждой проверке сценариев
+PRECOMPUTE_RETRY_BASE = float(os.getenv("PRECOMPUTE_RETRY_BASE", "30"))
+PRECOMPUTE_RETRY_MAX = float(os.getenv("PRECOMPUTE_RETRY_MAX", "3600"))
+
+REQUEST_GPT = "REQUEST_GPT"
+
+# answer_key -> ответ
+_answers: dict[str, str] = {}
+# answer_key -> (число неудач подряд, когда можно повторить)
+_failures: dict[str, tuple[int, float]] = {}
+precompute_stats = {
+    "prompts": 0, "loaded": 0, "generated": 0, "errors": 0, "hits": 0, "on_demand": 0, "pruned": 0,
+}
+
+
+def request_gpt_prompt(button: dict):
+    """prompt кнопки REQUEST_GPT или None для остальных кнопок."""
+    if button and button.get("onClick") == REQUEST_GPT and button.get("prompt"):
+        return button["prompt"]
+    return None
+
+
+def collect_prompts() -> set[str]:
+    prompts = set()
+    for scenario in all_scenarios():
+        for button in scenario.buttons.values():
+            prompt = request_gpt_prompt(button)
+            if prompt:
+                prompts.add(prompt)
+    return prompts
+
+
+async def ensure_precomputed_table() -> None:
+    """Создаёт таблицу готовых ответов, если её ещё нет."""
+    dynamodb = get_dynamodb()
+    try:
+        await dynamodb.describe_table(TableName=PRECOMPUTED_ANSWERS_TABLE)
+        return
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "ResourceNotFoundException":
+            raise
+    try:
+        await dynamodb.create_table(
+            TableName=PRECOMPUTED_ANSWERS_TABLE,
+            KeySchema=[{"AttributeName": "answer_key", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "answer_key", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        logger.info(f"Создана таблица {PRECOMPUTED_ANSWERS_TABLE}")
+    except ClientError as ce:
+        # Таблицу одновременно создаёт другая реплика
+        if ce.response["Error"]["Code"] != "ResourceInUseException":
+            raise
+
+
+async def _load(key: str):
+    resp = await get_dynamodb().get_item(
+        TableName=PRECOMPUTED_ANSWERS_TABLE,
+        Key={"answer_key": {"S": key}},
+        ProjectionExpression="answer",
+    )
+    item = resp.get("Item")
+    return item["answer"]["S"] if item else None
+
+
+async def _generate(prompt: str, key: str) -> str:
+    answer, metadata = await ask_llm(prompt, use_cache=True)
+    await get_dynamodb().put_item(
+        TableName=PRECOMPUTED_ANSWERS_TABLE,
+        Item={
+            "answer_key": {"S": key},
+            "prompt": {"S": prompt},
+            "model": {"S": OPENAI_MODEL},
+            "answer": {"S": answer},
+            "input_tokens": {"N": str(metadata["input_tokens"])},
+            "output_tokens": {"N": str(metadata["output_tokens"])},
+            "created_at": {"N": str(int(time.time()))},
+        },
+    )
+    return answer
+
+
+def _retry_due(key: str) -> bool:
+    failure = _failures.get(key)
+    return failure is None or failure[1] <= time.monotonic()
+
+
+def _record_failure(key: str) -> None:
+    count = _failures.get(key, (0, 0.0))[0] + 1
+    delay = min(PRECOMPUTE_RETRY_MAX, PRECOMPUTE_RETRY_BASE * 2 ** (count - 1))
+    _failures[key] = (count, time.monotonic() + delay)
+
+
+def prune_answers(prompts: set[str]) -> None:
+    """Оставляет ответы и счётчики неудач только для prompt из текущих сценариев."""
+    keys = {answer_cache_key(prompt) for prompt in prompts}
+    stale = [key for key in _answers if key not in keys]
+    for key in stale:
+        del _answers[key]
+    for key in [key for key in _failures if key not in keys]:
+        del _failures[key]
+    precompute_stats["pruned"] += len(stale)
+
+
+async def _warm(prompt: str) -> None:
+    key = answer_cache_key(prompt)
+    if key in _answers or not _retry_due(key):
+        return
+    try:
+        answer = await _load(key)
+        if answer is not None:
+            precompute_stats["loaded"] += 1
+        else:
+            answer = await _generate(prompt, key)
+            precompute_stats["generated"] += 1
+            logger.info(f"Подготовлен ответ REQUEST_GPT: {prompt!r}")
+        _answers[key] = answer
+        _failures.pop(key, None)
+    except Exception as e:
+        precompute_stats["errors"] += 1
+        _record_failure(key)
+        logger.error(
+            f"Не удалось подготовить ответ REQUEST_GPT {prompt!r} "
+            f"(неудача {_failures[key][0]} подряд): {e}"
+        )
+
+
+async def warm_up_answers() -> None:
+    """
+    Готовит ответы для всех REQUEST_GPT-кнопок загруженных сценариев (уже готовые и ждущие
+    повтора после неудачи не трогает) и забывает ответы на prompt, которых в сценариях больше нет.
+    """
+    prompts = collect_prompts()
+    precompute_stats["prompts"] = len(prompts)
+    prune_answers(prompts)
+    sem = asyncio.Semaphore(PRECOMPUTE_CONCURRENCY)
+
+    async def run(prompt):
+        async with sem:
+            await _warm(prompt)
+
+    await asyncio.gather(*(run(prompt) for prompt in prompts))
+
+
+async def precompute_worker() -> None:
+    """Фоновая задача: прогрев при старте, затем — при появлении новых prompt после перезагрузки сценариев."""
+    try:
+        await ensure_precomputed_table()
+    except Exception as e:
+        logger.error(f"Таблица {PRECOMPUTED_ANSWERS_TABLE} недоступна: {e}")
+        return
+
+    while True:
+        try:
+            prompts = collect_prompts()
+            prune_answers(prompts)
+            missing = [key for key in map(answer_cache_key, prompts) if key not in _answers and _retry_due(key)]
+            if missing:
+                await warm_up_answers()
+        except Exception as e:
+            logger.exception(f"precompute_worker error: {e}")
+        await asyncio.sleep(SCENARIO_RELOAD_INTERVAL)
+
+
+async def get_precomputed_answer(prompt: str) -> dict:
+    """
+    Ответ на prompt кнопки REQUEST_GPT: готовый из памяти или (если прогрев ещё не дошёл
+    до этого prompt) — запрос к LLM с сохранением для следующих нажатий.
+    """
+    key = answer_cache_key(prompt)
+    answer = _answers.get(key)
+    if answer is not None:
+        precompute_stats["hits"] += 1
+        return {"prompt": prompt, "answer": answer, "precomputed": True}
+
+    precompute_stats["on_demand"] += 1
+    answer = await _load(key)
+    if answer is None:
+        answer = await _generate(prompt, key)
+        precompute_stats["generated"] += 1
+    _answers[key] = answer
+    _failures.pop(key, None)
+    return {"prompt": prompt, "answer": answer, "precomputed": False}
+
+
+def get_precomputed_stats() -> dict:
+    return {**precompute_stats, "ready": len(_answers), "failing": len(_failures)}
@@ -0,0 +1,108 @@
+import os
+import uuid
+import logging
+from src.cache import TTLCache, MISSING
+from src.singleflight import SingleFlight
+from src.shared_cache import shared_publish, shared_listen, shared_cache_enabled
+
+
+logger = logging.getLogger(__name__)
+
+# Кэш профилей пользователей (то, что возвращает get_user_data_from_db).
+# Все пути записи в таблицу Users обновляют или сбрасывают запись; другие реплики
+# узнают о сбросе через канал Redis (если REDIS_URL задан), иначе — по истечении TTL.
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "60"))
+PROFILE_INVALIDATION_CHANNEL = "profile_invalidate"
+
+profile_cache = TTLCache("profile", PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+profile_flight = SingleFlight("profile")
+invalidation_stats = {"local": 0, "updates": 0, "sent": 0, "received": 0, "stale_loads": 0}
+
+# Поколение профиля пользователя, пока идёт его загрузка: сброс или запись во время загрузки
+# увеличивает поколение, и результат загрузки, начатой до них, в кэш не попадает.
+# Записи живут только пока есть загрузки в полёте, поэтому словари не растут.
+_generations = {}
+_loading = {}
+
+# Свои же сообщения из канала пропускаем
+_instance_id = uuid.uuid4().hex
+
+
+async def get_profile(user_id: str, loader):
+    """
+    Профиль из кэша либо loader(user_id) (одна загрузка на одновременные промахи).
+    Отсутствующего пользователя (None) не кэшируем: его вот-вот могут создать.
+    """
+    cached = profile_cache.get(user_id)
+    if cached is not MISSING:
+        return dict(cached)
+
+    profile, _ = await profile_flight.do(user_id, lambda: _load(user_id, loader))
+    return dict(profile) if profile is not None else None
+
+
+async def _load(user_id: str, loader):
+    generation = _generations.get(user_id, 0)
+    _loading[user_id] = _loading.get(user_id, 0) + 1
+    try:
+        profile = await loader(user_id)
+        if _generations.get(user_id, 0) != generation:
+            # Профиль прочитан до сброса: отдаём тем, кто его ждал, но не кэшируем
+            invalidation_stats["stale_loads"] += 1
+        elif profile is not None:
+            profile_cache.set(user_id, profile)
+        return profile
+    finally:
+        _loading[user_id] -= 1
+        if not _loading[user_id]:
+            del _loading[user_id]
+            _generations.pop(user_id, None)
+
+
+def _bump_generation(user_id: str) -> None:
+    """Профиль изменился: загрузки в полёте устарели, новые запросы не ждут их результата."""
+    if user_id in _loading:
+        _generations[user_id] = _generations.get(user_id, 0) + 1
+        profile_flight.forget(user_id)
+
+
+async def update_profile(user_id: str, changes: dict) -> None:
+    """Write-through: поправить закэшированный профиль после собственной записи."""
+    _bump_generation(user_id)
+    cached = profile_cache.peek(user_id)
+    if cached is not MISSING:
+        profile_cache.set(user_id, {**cached, **changes})
+        invalidation_stats["updates"] += 1
+    await _broadcast(user_id)
+
+
+async def invalidate_profile(user_id: str) -> None:
+    _bump_generation(user_id)
+    profile_cache.delete(user_id)
+    invalidation_stats["local"] += 1
+    await _broadcast(user_id)
+
+
+async def _broadcast(user_id: str) -> None:
+    if not shared_cache_enabled():
+        return
+    await shared_publish(PROFILE_INVALIDATION_CHANNEL, {"user_id": user_id, "source": _instance_id})
+    invalidation_stats["sent"] += 1
+
+
+def _on_invalidation(message: dict) -> None:
+    if message.get("source") == _instance_id:
+        return
+    _bump_generation(message.get("user_id"))
+    profile_cache.delete(message.get("user_id"))
+    invalidation_stats["received"] += 1
+
+
+async def profile_invalidation_listener() -> None:
+    """Фоновая задача: сброс профилей, изменённых другими репликами."""
+    await shared_listen(PROFILE_INVALIDATION_CHANNEL, _on_invalidation)
+
+
+def get_profile_cache_stats() -> dict:
+    return {**profile_cache.stats(), "invalidations": dict(invalidation_stats), "singleflight": profile_flight.stats()}
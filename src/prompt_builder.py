@@ -0,0 +1,221 @@
+import os
+import math
+import asyncio
+import logging
+
+try:
+    import tiktoken  # закреплён в requirements.txt
+except ImportError:
+    tiktoken = None
+
+
+logger = logging.getLogger(__name__)
+
+# Бюджеты токенов по секциям промпта (0 — без ограничения)
+PROMPT_BUDGET_ANAMNESIS = int(os.getenv("PROMPT_BUDGET_ANAMNESIS", "800"))
+PROMPT_BUDGET_HISTORY = int(os.getenv("PROMPT_BUDGET_HISTORY", "600"))
+PROMPT_BUDGET_KNOWLEDGE = int(os.getenv("PROMPT_BUDGET_KNOWLEDGE", "1500"))
+PROMPT_BUDGET_TOTAL = int(os.getenv("PROMPT_BUDGET_TOTAL", "3500"))
+TIKTOKEN_ENCODING = os.getenv("TIKTOKEN_ENCODING", "o200k_base")
+
+# Порядок урезания при превышении общего бюджета: сначала самое малоценное
+TRIM_ORDER = ("history", "knowledge", "anamnesis")
+
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+        except Exception as e:
+            # нет доступа к файлу словаря — считаем приблизительно
+            logger.warning(f"tiktoken недоступен ({e}), используем приблизительный подсчёт токенов")
+            _encoding_failed = True
+    return _encoding
+
+
+async def init_tokenizer() -> None:
+    """Загрузка словаря tiktoken при старте: может идти в сеть, поэтому не в event loop и не на первом запросе."""
+    await asyncio.to_thread(_get_encoding)
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # ~3 символа на токен для смеси кириллицы и латиницы
+    return math.ceil(len(text) / 3)
+
+
+def truncate_tokens(text: str, max_tokens: int, keep_tail: bool = False) -> str:
+    """Обрезает текст до max_tokens. keep_tail=True — оставить конец (самые свежие записи)."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text)
+        kept = tokens[-max_tokens:] if keep_tail else tokens[:max_tokens]
+        text = encoding.decode(kept)
+    else:
+        chars = max_tokens * 3
+        text = text[-chars:] if keep_tail else text[:chars]
+    return "…" + text if keep_tail else text + "…"
+
+
+class PromptBuilder:
+    """
+    Собирает user_prompt из секций (анамнез, история, база знаний, вопрос),
+    соблюдая бюджеты токенов. Внутри секции первым отбрасывается наименее ценное:
+    старая часть дневника, самые старые сообщения, наименее релевантные фрагменты.
+    """
+
+    def __init__(self, anamnesis_budget: int = PROMPT_BUDGET_ANAMNESIS, history_budget: int = PROMPT_BUDGET_HISTORY,
+                 knowledge_budget: int = PROMPT_BUDGET_KNOWLEDGE, total_budget: int = PROMPT_BUDGET_TOTAL):
+        self.budgets = {
+            "anamnesis": anamnesis_budget,
+            "history": history_budget,
+            "knowledge": knowledge_budget,
+        }
+        self.total_budget = total_budget
+        self.user_data = None
+        self.history = []
+        self.chunks = []
+        self.question = ""
+        self.truncated = set()
+
+    def set_anamnesis(self, user_data: dict):
+        self.user_data = user_data
+        return self
+
+    def set_history(self, messages: list[dict]):
+        self.history = list(messages or [])
+        return self
+
+    def set_knowledge(self, chunks: list[dict]):
+        # фрагменты приходят отсортированными по релевантности
+        self.chunks = [chunk["text"].strip() for chunk in (chunks or [])]
+        return self
+
+    def set_question(self, question: str):
+        self.question = question
+        return self
+
+    # --- секции ---
+
+    def _anamnesis_text(self, budget: int) -> str:
+        if not self.user_data:
+            return ""
+        head = (
+            f"Информация о пользователе:\n"
+            f"ID: {self.user_data.get('id', '')}\n"
+            f"Имя: {self.user_data.get('name', '')}\n"
+            f"Дата рождения: {self.user_data.get('birthday', '')}\n"
+        )
+        diary = self.user_data.get("health_diary", "")
+        if budget:
+            # Анкетные поля короткие и всегда остаются; дневник режем, оставляя свежие записи (конец)
+            diary_budget = max(0, budget - count_tokens(head) - count_tokens("Дневник здоровья: \n\n"))
+            cut = truncate_tokens(diary, diary_budget, keep_tail=True)
+            if cut != diary:
+                self.truncated.add("anamnesis")
+            diary = cut
+        return head + f"Дневник здоровья: {diary}\n\n"
+
+    def _history_text(self, budget: int) -> str:
+        lines = [f"{msg['role']}: {msg['message']}" for msg in self.history]
+        if not lines:
+            return ""
+        if budget:
+            kept = []
+            used = count_tokens("История диалога:\n\n\n")
+            # идём от самых свежих сообщений к старым
+            for line in reversed(lines):
+                cost = count_tokens(line + "\n")
+                if used + cost > budget:
+                    if not kept:
+                        kept.append(truncate_tokens(line, budget - used))
+                    break
+                kept.append(line)
+                used += cost
+            if len(kept) < len(lines) or (kept and kept[0] != lines[-1]):
+                self.truncated.add("history")
+            lines = list(reversed(kept))
+        history_text = "\n".join(lines)
+        return f"История диалога:\n{history_text}\n\n" if history_text else ""
+
+    def _knowledge_text(self, budget: int) -> str:
+        # Пустые фрагменты пропускаем до нумерации, чтобы в промпт не попадали пустые «N. »
+        chunks = [chunk for chunk in self.chunks if chunk]
+        if not chunks:
+            return ""
+        header = "\nИнформация из базы знаний:\n"
+        if budget:
+            kept = []
+            used = count_tokens(header)
+            for idx, chunk in enumerate(chunks):
+                line = f"{idx + 1}. {chunk}\n"
+                cost = count_tokens(line)
+                if used + cost > budget:
+                    if not kept:
+                        # самый релевантный фрагмент обрезаем, но не выбрасываем (если от него что-то осталось)
+                        trimmed = truncate_tokens(chunk, budget - used - 2)
+                        if trimmed.rstrip("…").strip():
+                            kept.append(trimmed)
+                    break
+                kept.append(chunk)
+                used += cost
+            if len(kept) < len(chunks) or (kept and kept[0] != chunks[0]):
+                self.truncated.add("knowledge")
+            chunks = kept
+        if not chunks:
+            return ""
+        return header + "".join(f"{idx + 1}. {chunk}\n" for idx, chunk in enumerate(chunks))
+
+    def _question_text(self) -> str:
+        return (
+            f"\n\nВопрос: {self.question}. Ответь на вопрос на основе предоставленной информации и собственных "
+            f"знаний. Можно отвечать на вопросы связанные с медициной, здоровьем, врачами, лекарствами и подобной тематикой."
+        )
+
+    def build(self):
+        """Возвращает (user_prompt, breakdown) — текст и разбивку токенов по секциям."""
+        budgets = dict(self.budgets)
+        render = {
+            "anamnesis": self._anamnesis_text,
+            "history": self._history_text,
+            "knowledge": self._knowledge_text,
+        }
+        sections = {name: render[name](budgets[name]) for name in render}
+        question = self._question_text()
+        tokens = {name: count_tokens(text) for name, text in sections.items()}
+        tokens["question"] = count_tokens(question)
+
+        # Общий бюджет: урезаем секции в порядке TRIM_ORDER
+        if self.total_budget:
+            for name in TRIM_ORDER:
+                overflow = sum(tokens.values()) - self.total_budget
+                if overflow <= 0:
+                    break
+                if not tokens[name]:
+                    continue
+                budgets[name] = max(0, tokens[name] - overflow)
+                sections[name] = render[name](budgets[name]) if budgets[name] else ""
+                self.truncated.add(name)
+                tokens[name] = count_tokens(sections[name])
+
+        user_prompt = sections["anamnesis"] + sections["history"] + sections["knowledge"] + question
+        breakdown = {
+            **tokens,
+            "total": sum(tokens.values()),
+            "budgets": {**self.budgets, "total": self.total_budget},
+            "truncated": sorted(self.truncated),
+            "exact": _get_encoding() is not None,
+        }
+        return user_prompt, breakdown
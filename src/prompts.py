@@ -9,3 +9,9 @@ SYSTEM_PROMPT = """
 профессиональными. 
 """
 
+
+# Разбор свободного ответа на шаг сценария, когда локальные answerPattern не подошли
+ANSWER_CLASSIFIER_PROMPT = """
+Вы определяете, какой из вариантов ответа на вопрос сценария имел в виду пользователь.
+Ответьте только номером подходящего варианта. Если ни один вариант не подходит по смыслу, ответьте 0.
+"""
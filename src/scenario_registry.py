@@ -0,0 +1,179 @@
+import os
+import json
+import asyncio
+import logging
+import pathlib
+from collections import deque
+from src.answer_router import StepAnswerMatcher
+
+
+logger = logging.getLogger(__name__)
+
+SCENARIOS_DIR = pathlib.Path(__file__).parent / "scenarios"
+SCENARIO_RELOAD_INTERVAL = float(os.getenv("SCENARIO_RELOAD_INTERVAL", "5"))
+
+# nextActionId, которые означают конец сценария, а не ссылку на шаг
+TERMINAL_ACTION_IDS = {"finish"}
+
+
+class ScenarioValidationError(Exception):
+    pass
+
+
+class CompiledScenario:
+    """
+    Сценарий, разобранный в индексы: stepId -> шаг, (stepId, buttonId) -> nextActionId
+    и stepId -> матчер текстовых ответов по possibleUserAnswers.
+    """
+
+    def __init__(self, file_name: str, data: dict, mtime: float):
+        self.file_name = file_name
+        self.mtime = mtime
+        self.scenario_id = data.get("scenarioId")
+        self.first_step_id = data.get("firstStepId")
+        self.steps = {}
+        self.buttons = {}
+        self.transitions = {}
+        self.answer_matchers = {}
+        self.warnings = []
+
+        for step in data.get("steps", []):
+            step_id = step.get("stepId")
+            if not step_id:
+                raise ScenarioValidationError(f"{file_name}: шаг без stepId")
+            if step_id in self.steps:
+                raise ScenarioValidationError(f"{file_name}: повторяющийся stepId {step_id}")
+            self.steps[step_id] = step
+            for btn in step.get("buttons", []):
+                self.buttons[(step_id, btn.get("id"))] = btn
+                self.transitions[(step_id, btn.get("id"))] = btn.get("nextActionId")
+            if step.get("possibleUserAnswers"):
+                self.answer_matchers[step_id] = StepAnswerMatcher(step["possibleUserAnswers"])
+
+        # Готовые к отдаче описания шагов (без повторной сборки на каждый запрос)
+        self.step_payloads = {
+            step_id: {
+                "stepId": step.get("stepId"),
+                "name": step.get("name"),
+                "messages": step.get("messages", []),
+                "answerType": step.get("answerType"),
+                "buttons": step.get("buttons", [])
+            }
+            for step_id, step in self.steps.items()
+        }
+
+        self._validate()
+
+    def _edges(self, step: dict) -> list[str]:
+        targets = []
+        if step.get("nextActionId"):
+            targets.append(step["nextActionId"])
+        for btn in step.get("buttons", []):
+            if btn.get("nextActionId"):
+                targets.append(btn["nextActionId"])
+        for answer in step.get("possibleUserAnswers", []):
+            next_step_id = answer.get("assistantReaction", {}).get("nextStepId")
+            if next_step_id:
+                targets.append(next_step_id)
+        return targets
+
+    def _validate(self) -> None:
+        if not self.steps:
+            raise ScenarioValidationError(f"{self.file_name}: в сценарии нет шагов")
+        if self.first_step_id not in self.steps:
+            raise ScenarioValidationError(f"{self.file_name}: firstStepId {self.first_step_id} не найден среди шагов")
+
+        dangling = []
+        for step_id, step in self.steps.items():
+            for target in self._edges(step):
+                if target not in self.steps and target not in TERMINAL_ACTION_IDS:
+                    dangling.append(f"{step_id} -> {target}")
+        if dangling:
+            raise ScenarioValidationError(
+                f"{self.file_name}: ссылки на несуществующие шаги: {', '.join(dangling)}"
+            )
+
+        # Обход от firstStepId: шаги, до которых нельзя дойти, — только предупреждение
+        reachable = {self.first_step_id}
+        queue = deque([self.first_step_id])
+        while queue:
+            for target in self._edges(self.steps[queue.popleft()]):
+                if target in self.steps and target not in reachable:
+                    reachable.add(target)
+                    queue.append(target)
+        unreachable = [step_id for step_id in self.steps if step_id not in reachable]
+        if unreachable:
+            self.warnings.append(f"недостижимые шаги: {', '.join(unreachable)}")
+
+    def get_step(self, step_id: str):
+        return self.steps.get(step_id)
+
+    def get_step_payload(self, step_id: str):
+        return self.step_payloads.get(step_id)
+
+    def next_step_id(self, step_id: str, button_id: str):
+        return self.transitions.get((step_id, button_id))
+
+
+# file_name -> CompiledScenario
+_registry: dict[str, CompiledScenario] = {}
+
+
+def _compile_file(path: pathlib.Path) -> CompiledScenario:
+    mtime = path.stat().st_mtime
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return CompiledScenario(path.name, data, mtime)
+
+
+def reload_scenarios() -> list[str]:
+    """
+    Перечитывает только изменившиеся (по mtime) файлы сценариев.
+    Если новая версия файла не проходит проверку, остаётся предыдущая.
+    Возвращает список перезагруженных файлов.
+    """
+    reloaded = []
+    seen = set()
+    for path in sorted(SCENARIOS_DIR.glob("*.json")):
+        seen.add(path.name)
+        current = _registry.get(path.name)
+        try:
+            if current is not None and current.mtime == path.stat().st_mtime:
+                continue
+            compiled = _compile_file(path)
+        except (OSError, json.JSONDecodeError, ScenarioValidationError) as e:
+            logger.error(f"Сценарий {path.name} не загружен: {e}")
+            continue
+
+        for warning in compiled.warnings:
+            logger.warning(f"Сценарий {path.name}: {warning}")
+        _registry[path.name] = compiled
+        reloaded.append(path.name)
+
+    for file_name in list(_registry):
+        if file_name not in seen:
+            del _registry[file_name]
+            reloaded.append(file_name)
+
+    if reloaded:
+        logger.info(f"Сценарии загружены/обновлены: {', '.join(reloaded)}")
+    return reloaded
+
+
+def get_scenario(file_name: str):
+    """O(1)-доступ к скомпилированному сценарию, без чтения файла."""
+    return _registry.get(file_name)
+
+
+def all_scenarios() -> list[CompiledScenario]:
+    return list(_registry.values())
+
+
+async def scenario_reload_worker() -> None:
+    """Периодически проверяет mtime файлов и подхватывает изменения сценариев."""
+    while True:
+        await asyncio.sleep(SCENARIO_RELOAD_INTERVAL)
+        try:
+            await asyncio.to_thread(reload_scenarios)
+        except Exception as e:
+            logger.exception(f"scenario_reload_worker error: {e}")
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+from src.scenario_registry import get_scenario, all_scenarios
+
+
+# Компактная история сценария в записи Users: один переход — одна запись
+# [ts, stepId показанного шага, stepId, на который ответили, ответ], без текстов сообщений —
+# они берутся из определения сценария. Ответ — id кнопки, "answer:<n>" (распознанный свободный
+# ответ, индекс в possibleUserAnswers) или null. Хранятся последние SCENARIO_HISTORY_LIMIT переходов.
+# Текущая позиция — отдельный маленький атрибут scenario_state.
+SCENARIO_HISTORY_LIMIT = int(os.getenv("SCENARIO_HISTORY_LIMIT", "50"))
+
+ANSWER_PREFIX = "answer:"
+
+
+def make_entry(step_id: str, from_step_id: str = None, answer: str = None) -> list:
+    return [int(time.time()), step_id, from_step_id, answer]
+
+
+def compact_history(history: list) -> list:
+    """
+    Приводит историю к компактному виду. Старые записи (пары {"role": "user", ...} и
+    {"role": "system", "stepId", "messages"}) сворачиваются в переходы; компактные остаются как есть.
+    """
+    compacted = []
+    pending_step = None
+    pending_answer = None
+    for record in history:
+        if isinstance(record, list):
+            compacted.append(record)
+            continue
+        if not isinstance(record, dict):
+            continue
+        if record.get("role") == "user":
+            pending_step = record.get("stepId")
+            pending_answer = record.get("selectedButtonId")
+        elif record.get("role") == "system" and record.get("stepId"):
+            compacted.append([record.get("ts", 0), record["stepId"], pending_step, pending_answer])
+            pending_step = None
+            pending_answer = None
+    return compacted
+
+
+def cap_history(history: list) -> list:
+    return history[-SCENARIO_HISTORY_LIMIT:] if SCENARIO_HISTORY_LIMIT > 0 else history
+
+
+def make_state(file_name: str, step_id: str) -> str:
+    """Значение атрибута scenario_state (JSON-строка): сценарий и шаг, на котором пользователь сейчас."""
+    return json.dumps({"file": file_name, "step": step_id, "updated_at": int(time.time())})
+
+
+def parse_state(item: dict) -> dict:
+    try:
+        return json.loads(item.get("scenario_state", {}).get("S", "{}"))
+    except json.JSONDecodeError:
+        return {}
+
+
+def _find_scenario(step_id: str, file_name: str = None):
+    """Сценарий с таким шагом: сначала текущий сценарий пользователя, затем любой загруженный."""
+    scenario = get_scenario(file_name) if file_name else None
+    if scenario is not None and scenario.get_step(step_id) is not None:
+        return scenario
+    for scenario in all_scenarios():
+        if scenario.get_step(step_id) is not None:
+            return scenario
+    return None
+
+
+def expand_history(history: list, file_name: str = None) -> list[dict]:
+    """
+    Развёрнутая история для отображения (/users, выгрузка): записи role/stepId/selectedButtonId/messages,
+    тексты шагов и распознанных ответов — из загруженных сценариев.
+    """
+    expanded = []
+    for ts, step_id, from_step_id, answer in compact_history(history):
+        if from_step_id:
+            record = {"role": "user", "stepId": from_step_id}
+            if answer and answer.startswith(ANSWER_PREFIX):
+                scenario = _find_scenario(from_step_id, file_name)
+                answers = (scenario.get_step(from_step_id) or {}).get("possibleUserAnswers", []) if scenario else []
+                idx = int(answer[len(ANSWER_PREFIX):])
+                record["matchedAnswer"] = answers[idx].get("answerPattern") if idx < len(answers) else None
+            else:
+                record["selectedButtonId"] = answer
+            expanded.append(record)
+
+        scenario = _find_scenario(step_id, file_name)
+        payload = scenario.get_step_payload(step_id) if scenario else None
+        expanded.append({
+            "role": "system",
+            "stepId": step_id,
+            "messages": payload.get("messages", []) if payload else [],
+            "ts": ts,
+        })
+    return expanded
@@ -0,0 +1,118 @@
+import os
+import json
+import asyncio
+import logging
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis — необязательная зависимость
+    aioredis = None
+
+
+logger = logging.getLogger(__name__)
+
+# Общий кэш для нескольких реплик. Пустой REDIS_URL — только локальные кэши.
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "med_bot")
+
+_redis = None
+
+
+async def init_shared_cache() -> None:
+    global _redis
+    if not REDIS_URL:
+        return
+    if aioredis is None:
+        logger.warning("REDIS_URL задан, но пакет redis не установлен — общий кэш отключён")
+        return
+    _redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+    logger.info("Общий кэш: Redis подключён")
+
+
+async def close_shared_cache() -> None:
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+    _redis = None
+
+
+def shared_cache_enabled() -> bool:
+    return _redis is not None
+
+
+def _key(namespace: str, key: str) -> str:
+    return f"{REDIS_KEY_PREFIX}:{namespace}:{key}"
+
+
+async def shared_get(namespace: str, key: str):
+    """Значение из общего кэша или None. Ошибки Redis не должны ломать запрос."""
+    if _redis is None:
+        return None
+    try:
+        raw = await _redis.get(_key(namespace, key))
+        return json.loads(raw) if raw is not None else None
+    except Exception as e:
+        logger.warning(f"Общий кэш {namespace}: ошибка чтения: {e}")
+        return None
+
+
+async def shared_set(namespace: str, key: str, value, ttl: float) -> None:
+    if _redis is None:
+        return
+    try:
+        await _redis.set(_key(namespace, key), json.dumps(value, ensure_ascii=False), ex=max(1, int(ttl)))
+    except Exception as e:
+        logger.warning(f"Общий кэш {namespace}: ошибка записи: {e}")
+
+
+async def shared_clear(namespace: str, prefix: str = "") -> int:
+    """Удаляет ключи пространства имён (SCAN + UNLINK). Используется для явной инвалидации."""
+    if _redis is None:
+        return 0
+    removed = 0
+    batch = []
+    async for redis_key in _redis.scan_iter(match=_key(namespace, prefix) + "*", count=500):
+        batch.append(redis_key)
+        if len(batch) >= 500:
+            removed += await _redis.unlink(*batch)
+            batch = []
+    if batch:
+        removed += await _redis.unlink(*batch)
+    return removed
+
+
+async def shared_publish(channel: str, message: dict) -> None:
+    """Рассылка сообщения другим репликам (Redis pub/sub). Без Redis — ничего не делает."""
+    if _redis is None:
+        return
+    try:
+        await _redis.publish(_key("channel", channel), json.dumps(message, ensure_ascii=False))
+    except Exception as e:
+        logger.warning(f"Общий кэш: ошибка публикации в {channel}: {e}")
+
+
+async def shared_listen(channel: str, handler) -> None:
+    """
+    Фоновая задача: вызывает handler(message) на каждое сообщение канала.
+    При обрыве соединения переподписывается.
+    """
+    if _redis is None:
+        return
+    while True:
+        pubsub = _redis.pubsub()
+        try:
+            await pubsub.subscribe(_key("channel", channel))
+            async for raw in pubsub.listen():
+                if raw.get("type") != "message":
+                    continue
+                try:
+                    handler(json.loads(raw["data"]))
+                except Exception as e:
+                    logger.warning(f"Общий кэш: ошибка обработки сообщения {channel}: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Общий кэш: подписка на {channel} прервана: {e}, переподключаемся")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
@@ -0,0 +1,57 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Склейка одинаковых одновременных запросов: пока вызов по ключу выполняется,
+    остальные ждут его результата вместо собственного вызова.
+
+    Общий вызов идёт отдельной задачей и защищён asyncio.shield, поэтому отмена
+    одного ожидающего (клиент отключился) не отменяет вызов для остальных.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight = {}
+        self.calls = 0
+        self.deduplicated = 0
+
+    def _on_done(self, key, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Если все ожидающие ушли, исключение некому забрать — помечаем как полученное
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, fn):
+        """
+        Выполняет fn() (корутинная функция) один раз на ключ.
+        Возвращает (результат, leader): leader=True у того, кто инициировал вызов.
+        """
+        task = self._inflight.get(key)
+        leader = task is None
+        if leader:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_done(key, t))
+        else:
+            self.deduplicated += 1
+        return await asyncio.shield(task), leader
+
+    def forget(self, key) -> None:
+        """Следующий do(key) начнёт новый вызов; уже ожидающие получат результат текущего."""
+        self._inflight.pop(key, None)
+
+    def forget_prefix(self, prefix: str = None) -> None:
+        """forget() для всех строковых ключей с префиксом prefix (None — для всех ключей)."""
+        for key in list(self._inflight):
+            if prefix is None or (isinstance(key, str) and key.startswith(prefix)):
+                del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "deduplicated": self.deduplicated,
+            "inflight": len(self._inflight),
+        }
@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from botocore.exceptions import ClientError
+from src.db_manager import get_dynamodb, TABLE_NAME
+from src.metrics import Counter, stage_seconds, stage_errors
+
+
+logger = logging.getLogger(__name__)
+
+HISTORY_MAX_RETRIES = int(os.getenv("HISTORY_MAX_RETRIES", "10"))
+HISTORY_RETRY_MAX_DELAY = 0.5
+
+
+history_conflicts = Counter("history_version_conflicts_total", "Конфликты версий при записи истории", ("attribute",))
+
+
+class HistoryConflictError(Exception):
+    """Не удалось записать историю: запись пользователя постоянно меняется параллельно."""
+    pass
+
+
+def parse_version(item: dict) -> int:
+    return int(item.get("version", {}).get("N", "0"))
+
+
+async def _read_history(user_id: str, attribute: str):
+    """Свежие значение атрибута истории и version (только эти два поля)."""
+    resp = await get_dynamodb().get_item(
+        TableName=TABLE_NAME,
+        Key={"user_id": {"S": user_id}},
+        ProjectionExpression="#attr, #version",
+        ExpressionAttributeNames={"#attr": attribute, "#version": "version"},
+        ConsistentRead=True,
+    )
+    item = resp.get("Item", {})
+    try:
+        history = json.loads(item.get(attribute, {}).get("S", "[]"))
+    except json.JSONDecodeError:
+        history = []
+    return history, parse_version(item)
+
+
+async def append_history(user_id: str, attribute: str, entries: list, current: list,
+                         version: int, keep_last: int = None, normalize=None, extra: dict = None) -> int:
+    """
+    Дописывает entries в JSON-атрибут истории (conversation_history / scenario_history)
+    одним условным UpdateItem. Остальные атрибуты записи не трогаются.
+
+    current/version — уже прочитанные ранее история и версия записи. Если запись успела
+    измениться (version не совпал), история перечитывается и запись повторяется.
+    normalize(history) — приведение прочитанной истории (например, старого формата) перед дописыванием;
+    extra — дополнительные атрибуты ({имя: значение DynamoDB}), записываемые тем же UpdateItem.
+    Возвращает новую версию.
+    """
+    history = list(current)
+    extra = extra or {}
+    set_extra = "".join(f", #extra{idx} = :extra{idx}" for idx in range(len(extra)))
+    extra_names = {f"#extra{idx}": name for idx, name in enumerate(extra)}
+    extra_values = {f":extra{idx}": value for idx, value in enumerate(extra.values())}
+    for attempt in range(HISTORY_MAX_RETRIES):
+        if normalize is not None:
+            history = normalize(history)
+        updated = history + entries
+        if keep_last:
+            updated = updated[-keep_last:]
+
+        if version == 0:
+            condition = "attribute_not_exists(#version) OR #version = :v"
+        else:
+            condition = "#version = :v"
+
+        try:
+            started = time.perf_counter()
+            await get_dynamodb().update_item(
+                TableName=TABLE_NAME,
+                Key={"user_id": {"S": user_id}},
+                UpdateExpression="SET #attr = :history, #version = :next" + set_extra,
+                ConditionExpression=condition,
+                ExpressionAttributeNames={"#attr": attribute, "#version": "version", **extra_names},
+                ExpressionAttributeValues={
+                    ":history": {"S": json.dumps(updated, separators=(",", ":"))},
+                    ":v": {"N": str(version)},
+                    ":next": {"N": str(version + 1)},
+                    **extra_values,
+                },
+            )
+            stage_seconds.observe(time.perf_counter() - started, stage=f"dynamo_update_{attribute}")
+            return version + 1
+        except ClientError as ce:
+            if ce.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                stage_errors.inc(stage=f"dynamo_update_{attribute}")
+                raise
+            history_conflicts.inc(attribute=attribute)
+            logger.info(f"Конфликт версии {attribute} для user={user_id}, перечитываем")
+            await asyncio.sleep(random.uniform(0, min(HISTORY_RETRY_MAX_DELAY, 0.01 * (2 ** attempt))))
+            history, version = await _read_history(user_id, attribute)
+
+    raise HistoryConflictError(f"Не удалось дописать {attribute} для user={user_id}")
@@ -0,0 +1,324 @@
+import os
+import re
+import json
+import codecs
+import asyncio
+import logging
+from botocore.exceptions import ClientError
+from src.db_manager import get_dynamodb, batch_get_keys, TABLE_NAME
+from src.metrics import track_stage
+from src.profile_cache import invalidate_profile
+from src.welcome import put_many_into_welcome_queue
+
+
+logger = logging.getLogger(__name__)
+
+# Массовая загрузка пользователей: тело запроса читается потоком (JSON Lines или JSON-массив),
+# записи обрабатываются пачками — проверка существования BatchGetItem, новые пользователи —
+# условный PutItem (attribute_not_exists: созданного тем временем через /add_user не перезаписываем),
+# их WelcomeQueue — BatchWriteItem по 25, уже существующие — UpdateItem только полей профиля.
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "500"))              # записей в одной пачке
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))              # пачек одновременно
+INGEST_WRITE_CONCURRENCY = int(os.getenv("INGEST_WRITE_CONCURRENCY", "25"))  # PutItem/UpdateItem на пачку
+INGEST_MAX_RECORD_BYTES = int(os.getenv("INGEST_MAX_RECORD_BYTES", "65536"))
+INGEST_MAX_ERRORS = int(os.getenv("INGEST_MAX_ERRORS", "1000"))             # сколько ошибок вернуть в ответе
+
+PROFILE_FIELDS = ("name", "birthday", "health_diary")
+
+
+class IngestFormatError(Exception):
+    pass
+
+
+async def update_user_profile(user_id: str, payload: dict) -> None:
+    """
+    Обновляет только поля профиля одним UpdateItem: история диалога и сценария
+    не перезаписываются. Не переданные поля сохраняют текущее значение.
+    """
+    set_parts = []
+    values = {}
+    names = {}
+    for field in PROFILE_FIELDS:
+        names[f"#{field}"] = field
+        if field in payload:
+            set_parts.append(f"#{field} = :{field}")
+            values[f":{field}"] = {"S": payload.get(field) or ""}
+        else:
+            set_parts.append(f"#{field} = if_not_exists(#{field}, :empty)")
+            # Неиспользованное значение DynamoDB отклоняет (ValidationException)
+            values[":empty"] = {"S": ""}
+
+    with track_stage("dynamo_update_user"):
+        await get_dynamodb().update_item(
+            TableName=TABLE_NAME,
+            Key={"user_id": {"S": user_id}},
+            UpdateExpression="SET " + ", ".join(set_parts),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+        )
+
+
+# ─────────────────────────  разбор потока  ──────────────────────────────────
+
+async def _iter_jsonl(chunks, buffer: bytes):
+    index = 0
+    while True:
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            index += 1
+            if line.strip():
+                yield index, _parse_line(line)
+        if len(buffer) > INGEST_MAX_RECORD_BYTES:
+            raise IngestFormatError(f"строка {index + 1} длиннее {INGEST_MAX_RECORD_BYTES} байт")
+        chunk = await anext(chunks, None)
+        if chunk is None:
+            break
+        buffer += chunk
+    if buffer.strip():
+        yield index + 1, _parse_line(buffer)
+
+
+def _parse_line(line: bytes):
+    try:
+        return json.loads(line)
+    except (ValueError, UnicodeDecodeError) as e:
+        return IngestFormatError(f"некорректный JSON: {e}")
+
+
+_WHITESPACE = re.compile(r"\s*")
+
+
+async def _iter_json_array(chunks, buffer: bytes):
+    """
+    Элементы JSON-массива по одному, не дожидаясь конца тела запроса.
+    Между элементами — ровно одна запятая; пропущенная или лишняя запятая — ошибка формата.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    text = text_decoder.decode(buffer)
+    pos = text.index("[") + 1
+    exhausted = False
+    index = 0
+    need_value = True       # после «[» или «,» ждём элемент, после элемента — «,» или «]»
+
+    async def more() -> None:
+        nonlocal text, pos, exhausted
+        chunk = await anext(chunks, None)
+        if chunk is None:
+            exhausted = True
+            return
+        # Разобранное начало отбрасываем только при дочитывании, а не после каждой записи
+        text = text[pos:] + text_decoder.decode(chunk)
+        pos = 0
+
+    while True:
+        pos = _WHITESPACE.match(text, pos).end()
+        if pos == len(text):
+            if exhausted:
+                raise IngestFormatError("JSON-массив не закрыт")
+            await more()
+            continue
+        if not need_value:
+            if text[pos] == "]":
+                return
+            if text[pos] != ",":
+                raise IngestFormatError(f"после элемента {index} ожидалась «,» или «]»")
+            pos += 1
+            need_value = True
+            continue
+        if text[pos] == "]":
+            if index:
+                raise IngestFormatError(f"лишняя «,» после элемента {index}")
+            return
+        if text[pos] == ",":
+            raise IngestFormatError(f"элемент {index + 1}: лишняя «,»")
+        try:
+            record, end = decoder.raw_decode(text, pos)
+        except ValueError as e:
+            # Элемент ещё не дочитан — или тело действительно битое
+            if exhausted or len(text) - pos > INGEST_MAX_RECORD_BYTES:
+                raise IngestFormatError(f"элемент {index + 1}: некорректный JSON: {e}")
+            await more()
+            continue
+        # Число или литерал, обрезанные границей чанка, разбираются «успешно» — дочитываем
+        if end == len(text) and not exhausted and not isinstance(record, (dict, list, str)):
+            await more()
+            continue
+        index += 1
+        pos = end
+        need_value = False
+        yield index, record
+
+
+async def iter_records(stream):
+    """(номер записи, dict | исключение) из потока байт: JSON-массив или JSON Lines."""
+    chunks = stream.__aiter__()
+    buffer = b""
+    while not buffer.strip():
+        chunk = await anext(chunks, None)
+        if chunk is None:
+            return
+        buffer += chunk
+
+    records = _iter_json_array(chunks, buffer) if buffer.lstrip()[:1] == b"[" else _iter_jsonl(chunks, buffer)
+    async for index, record in records:
+        yield index, record
+
+
+def _validate(record) -> dict:
+    if isinstance(record, Exception):
+        raise record
+    if not isinstance(record, dict):
+        raise IngestFormatError("запись должна быть JSON-объектом")
+    user_id = record.get("user_id")
+    if not isinstance(user_id, str) or not user_id.strip():
+        raise IngestFormatError("поле user_id обязательно")
+    user = {"user_id": user_id}
+    for field in PROFILE_FIELDS:
+        if field in record:
+            value = record[field]
+            user[field] = "" if value is None else str(value)
+    return user
+
+
+# ─────────────────────────  запись  ──────────────────────────────────
+
+def _user_item(user: dict) -> dict:
+    item = {"user_id": {"S": user["user_id"]}}
+    for field in PROFILE_FIELDS:
+        item[field] = {"S": user.get(field, "")}
+    return item
+
+
+class _Ingest:
+    def __init__(self):
+        self.summary = {
+            "received": 0, "created": 0, "updated": 0, "duplicates": 0,
+            "invalid": 0, "failed": 0, "welcome_failed": 0,
+        }
+        self.errors = []
+
+    def error(self, index: int, user_id, kind: str, message: str) -> None:
+        self.summary[kind] += 1
+        if len(self.errors) < INGEST_MAX_ERRORS:
+            self.errors.append({"index": index, "user_id": user_id, "result": kind, "error": message})
+
+    async def write_chunk(self, batch: list[tuple[int, dict]]) -> None:
+        try:
+            with track_stage("ingest_chunk"):
+                existing = await batch_get_keys(TABLE_NAME, [user["user_id"] for _, user in batch])
+                new = [(index, user) for index, user in batch if user["user_id"] not in existing]
+                old = [(index, user) for index, user in batch if user["user_id"] in existing]
+                sem = asyncio.Semaphore(INGEST_WRITE_CONCURRENCY)
+                await asyncio.gather(self._create(new, sem), self._update(old, sem))
+        except Exception as e:
+            logger.error(f"Массовая загрузка: пачка из {len(batch)} записей не записана: {e}")
+            for index, user in batch:
+                self.error(index, user["user_id"], "failed", str(e))
+
+    async def _create(self, new: list[tuple[int, dict]], sem: asyncio.Semaphore) -> None:
+        async def create(index: int, user: dict) -> bool:
+            """True — пользователь создан этой загрузкой."""
+            async with sem:
+                try:
+                    await get_dynamodb().put_item(
+                        TableName=TABLE_NAME,
+                        Item=_user_item(user),
+                        ConditionExpression="attribute_not_exists(user_id)",
+                    )
+                    return True
+                except ClientError as ce:
+                    if ce.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                        self.error(index, user["user_id"], "failed", str(ce))
+                        return False
+                except Exception as e:
+                    self.error(index, user["user_id"], "failed", str(e))
+                    return False
+            # Пользователя создали после batch_get_keys (например, /add_user): только поля профиля
+            await self._update_one(index, user, sem)
+            return False
+
+        results = await asyncio.gather(*(create(index, user) for index, user in new))
+        created = [(index, user["user_id"]) for (index, user), ok in zip(new, results) if ok]
+        self.summary["created"] += len(created)
+        if not created:
+            return
+
+        # Новым пользователям — welcome, как и при /add_user
+        user_ids = [user_id for _, user_id in created]
+        try:
+            welcome_failed = set(await put_many_into_welcome_queue(user_ids))
+        except Exception as e:
+            logger.error(f"Массовая загрузка: WelcomeQueue не записана для {len(user_ids)} пользователей: {e}")
+            welcome_failed = set(user_ids)
+        for index, user_id in created:
+            if user_id in welcome_failed:
+                self.error(index, user_id, "welcome_failed", "не поставлен в WelcomeQueue")
+
+    async def _update_one(self, index: int, user: dict, sem: asyncio.Semaphore) -> None:
+        async with sem:
+            try:
+                await update_user_profile(user["user_id"], user)
+                await invalidate_profile(user["user_id"])
+                self.summary["updated"] += 1
+            except Exception as e:
+                self.error(index, user["user_id"], "failed", str(e))
+
+    async def _update(self, old: list[tuple[int, dict]], sem: asyncio.Semaphore) -> None:
+        await asyncio.gather(*(self._update_one(index, user, sem) for index, user in old))
+
+
+async def ingest_users(stream) -> dict:
+    """
+    Загружает пользователей из потока байт (JSON Lines или JSON-массив объектов с user_id,
+    name, birthday, health_diary). Возвращает сводку по записям и список ошибок (не более INGEST_MAX_ERRORS).
+    Ошибка формата посреди потока прерывает чтение; уже прочитанные записи при этом записываются.
+    """
+    ingest = _Ingest()
+    seen = set()
+    sem = asyncio.Semaphore(INGEST_CONCURRENCY)
+    tasks = []
+    batch = []
+
+    async def run(chunk):
+        try:
+            await ingest.write_chunk(chunk)
+        finally:
+            sem.release()
+
+    async def flush():
+        nonlocal batch
+        # Не читаем дальше, пока в работе INGEST_CONCURRENCY пачек
+        await sem.acquire()
+        tasks.append(asyncio.create_task(run(batch)))
+        batch = []
+
+    aborted = None
+    try:
+        async for index, record in iter_records(stream):
+            ingest.summary["received"] += 1
+            try:
+                user = _validate(record)
+            except IngestFormatError as e:
+                ingest.error(index, record.get("user_id") if isinstance(record, dict) else None, "invalid", str(e))
+                continue
+            # Повтор user_id в одном BatchWriteItem DynamoDB отклоняет целиком
+            if user["user_id"] in seen:
+                ingest.error(index, user["user_id"], "duplicates", "user_id уже встречался в этой загрузке")
+                continue
+            seen.add(user["user_id"])
+            batch.append((index, user))
+            if len(batch) >= INGEST_CHUNK_SIZE:
+                await flush()
+    except IngestFormatError as e:
+        aborted = str(e)
+    finally:
+        if batch:
+            await flush()
+        await asyncio.gather(*tasks)
+
+    result = {**ingest.summary, "errors": ingest.errors}
+    if aborted:
+        result["aborted"] = aborted
+    return result
@@ -0,0 +1,148 @@
+import os
+import json
+import base64
+import asyncio
+import logging
+from src.db_manager import get_dynamodb, TABLE_NAME
+from src.metrics import track_stage
+from src.conversation_store import get_last_messages
+from src.scenario_state import expand_history, parse_state
+
+
+logger = logging.getLogger(__name__)
+
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "50"))
+USERS_MAX_PAGE_SIZE = int(os.getenv("USERS_MAX_PAGE_SIZE", "500"))
+USERS_EXPORT_MAX_SEGMENTS = int(os.getenv("USERS_EXPORT_MAX_SEGMENTS", "16"))
+
+# Поля профиля; истории читаем только по запросу
+PROFILE_PROJECTION = "user_id, #name, birthday, health_diary"
+HISTORY_PROJECTION = PROFILE_PROJECTION + ", scenario_history, scenario_state"
+PROJECTION_NAMES = {"#name": "name"}
+
+
+def encode_cursor(last_key: dict) -> str:
+    if not last_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_key).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> dict:
+    """Курсор — это LastEvaluatedKey предыдущей страницы в base64(JSON)."""
+    if not cursor:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Некорректный cursor")
+
+
+def format_user(user: dict, conversation_history: list = None) -> dict:
+    formatted = {
+        "id": user.get("user_id", {}).get("S", ""),
+        "name": user.get("name", {}).get("S", ""),
+        "birthday": user.get("birthday", {}).get("S", ""),
+        "health_diary": user.get("health_diary", {}).get("S", ""),
+    }
+    if conversation_history is not None:
+        scenario_history_str = user.get("scenario_history", {}).get("S", "[]")
+        try:
+            scenario_history = json.loads(scenario_history_str)
+        except json.JSONDecodeError:
+            scenario_history = []
+        formatted["conversation_history"] = conversation_history
+        # В записи — компактные переходы; тексты шагов подставляются из сценариев
+        formatted["scenario_history"] = expand_history(scenario_history, parse_state(user).get("file"))
+    return formatted
+
+
+async def _format_batch(items: list[dict], include_history: bool) -> list[dict]:
+    if not include_history:
+        return [format_user(item) for item in items]
+    histories = await asyncio.gather(*(
+        get_last_messages(item.get("user_id", {}).get("S", "")) for item in items
+    ))
+    return [format_user(item, history) for item, history in zip(items, histories)]
+
+
+async def iter_users_page(limit: int, start_key: dict, include_history: bool, page_state: dict):
+    """
+    Отдаёт пользователей одной страницы по мере чтения из DynamoDB.
+    После завершения кладёт в page_state["next_cursor"] курсор следующей страницы.
+    """
+    kwargs = {
+        "TableName": TABLE_NAME,
+        "ProjectionExpression": HISTORY_PROJECTION if include_history else PROFILE_PROJECTION,
+        "ExpressionAttributeNames": PROJECTION_NAMES,
+    }
+    if start_key:
+        kwargs["ExclusiveStartKey"] = start_key
+
+    remaining = limit
+    last_key = None
+    while remaining > 0:
+        with track_stage("dynamo_scan_users"):
+            resp = await get_dynamodb().scan(Limit=remaining, **kwargs)
+        items = resp.get("Items", [])
+        for user in await _format_batch(items, include_history):
+            yield user
+        remaining -= len(items)
+        last_key = resp.get("LastEvaluatedKey")
+        if not last_key:
+            break
+        # scan может вернуть меньше limit из-за лимита 1 МБ — дочитываем
+        kwargs["ExclusiveStartKey"] = last_key
+
+    page_state["next_cursor"] = encode_cursor(last_key)
+
+
+async def parallel_scan_users(segments: int, include_history: bool, queue_size: int = 1000):
+    """
+    Полная выгрузка таблицы параллельным scan по сегментам (Segment/TotalSegments).
+    Отдаёт пользователей по мере поступления; очередь ограничена, чтобы не держать всё в памяти.
+    """
+    queue = asyncio.Queue(maxsize=queue_size)
+    done = object()
+
+    async def scan_segment(segment: int):
+        kwargs = {
+            "TableName": TABLE_NAME,
+            "ProjectionExpression": HISTORY_PROJECTION if include_history else PROFILE_PROJECTION,
+            "ExpressionAttributeNames": PROJECTION_NAMES,
+            "Segment": segment,
+            "TotalSegments": segments,
+        }
+        try:
+            while True:
+                resp = await get_dynamodb().scan(**kwargs)
+                for user in await _format_batch(resp.get("Items", []), include_history):
+                    await queue.put(user)
+                last_key = resp.get("LastEvaluatedKey")
+                if not last_key:
+                    break
+                kwargs["ExclusiveStartKey"] = last_key
+        except asyncio.CancelledError:
+            # Потребитель ушёл: маркер никто не прочитает, а put в полную очередь завис бы
+            raise
+        except Exception:
+            await queue.put(done)
+            raise
+        await queue.put(done)
+
+    tasks = [asyncio.create_task(scan_segment(segment)) for segment in range(segments)]
+    try:
+        finished = 0
+        while finished < segments:
+            item = await queue.get()
+            if item is done:
+                finished += 1
+                continue
+            yield item
+        # пробрасываем ошибки сегментов, если были
+        for task in tasks:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Дожидаемся отмены, чтобы scan-задачи не пережили выгрузку
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,215 @@
+import os
+import json
+import shutil
+import asyncio
+import logging
+import numpy as np
+from src.llm import embed_texts
+from src.metrics import track_stage
+
+
+logger = logging.getLogger(__name__)
+
+# Встроенный индекс базы знаний: вместо запроса в FAISS-сервис — поиск в процессе.
+# Каталог KB_INDEX_DIR/<db_name>/ собирается командой scripts/build_kb_index.py:
+#   embeddings.npy — float32 [n, dim], векторы нормированы (скор — косинусная близость);
+#   offsets.npy    — int64 [n + 1], границы текстов в texts.bin;
+#   texts.bin      — тексты фрагментов подряд, UTF-8;
+#   meta.json      — модель эмбеддингов, размерность, число фрагментов.
+# Файлы открываются через mmap (только чтение): воркеры одного хоста делят страницы
+# в page cache ОС, а не держат по копии матрицы.
+KB_INDEX_DIR = os.getenv("KB_INDEX_DIR", "kb_index")
+KB_EMBEDDING_MODEL = os.getenv("KB_EMBEDDING_MODEL", "text-embedding-3-small")
+# Сколько строк матрицы перемножается за раз (ограничивает временную память на запрос)
+KB_SEARCH_BLOCK = int(os.getenv("KB_SEARCH_BLOCK", "65536"))
+KB_SEARCH_MAX_BATCH = int(os.getenv("KB_SEARCH_MAX_BATCH", "64"))
+
+_indexes: dict = {}
+index_stats = {"searches": 0, "errors": 0, "batches": 0, "batched_queries": 0}
+
+
+class VectorIndex:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.model = self.meta["model"]
+        self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.texts = np.memmap(os.path.join(path, "texts.bin"), dtype=np.uint8, mode="r") \
+            if self.offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        if self.embeddings.shape[0] + 1 != self.offsets.shape[0]:
+            raise ValueError(f"{path}: число векторов и текстов не совпадает")
+        self._pending = []
+        self._drainer = None
+
+    @property
+    def size(self) -> int:
+        return self.embeddings.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.embeddings.shape[1]
+
+    def text(self, idx: int) -> str:
+        return self.texts[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def search(self, vector, top_k: int) -> list[dict]:
+        """Top-k фрагментов по косинусной близости: [{"text", "score"}], лучшие первыми."""
+        return self.search_many([vector], top_k)[0]
+
+    def search_many(self, vectors, top_k: int) -> list[list[dict]]:
+        """
+        Top-k для нескольких запросов за один проход по матрице: поиск упирается в чтение
+        памяти, и умножение блока на матрицу запросов почти не дороже умножения на один вектор.
+        """
+        queries = np.asarray(vectors, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != self.dim:
+            raise ValueError(f"Размерность запросов {queries.shape} не совпадает с индексом ({self.dim})")
+        norms = np.linalg.norm(queries, axis=1)
+        if self.size == 0 or top_k <= 0:
+            return [[] for _ in range(len(queries))]
+        queries = queries / np.where(norms == 0, 1, norms)[:, None]
+
+        # best_* — [k, число запросов]: кандидаты, накопленные по уже просмотренным блокам
+        best_idx = np.empty((0, len(queries)), dtype=np.int64)
+        best_scores = np.empty((0, len(queries)), dtype=np.float32)
+        for start in range(0, self.size, KB_SEARCH_BLOCK):
+            scores = self.embeddings[start:start + KB_SEARCH_BLOCK] @ queries.T
+            k = min(top_k, scores.shape[0])
+            top = np.argpartition(scores, -k, axis=0)[-k:]
+            best_idx = np.concatenate([best_idx, top + start])
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=0)])
+            if best_idx.shape[0] > top_k:
+                keep = np.argpartition(best_scores, -top_k, axis=0)[-top_k:]
+                best_idx = np.take_along_axis(best_idx, keep, axis=0)
+                best_scores = np.take_along_axis(best_scores, keep, axis=0)
+
+        order = np.argsort(-best_scores, axis=0)
+        results = []
+        for q in range(len(queries)):
+            if norms[q] == 0:
+                results.append([])
+                continue
+            results.append([
+                {"text": self.text(int(best_idx[i, q])), "score": round(float(best_scores[i, q]), 6)}
+                for i in order[:, q]
+            ])
+        return results
+
+    async def search_async(self, vector, top_k: int) -> list[dict]:
+        """
+        Поиск в пуле потоков. Запросы, пришедшие, пока идёт предыдущий проход,
+        склеиваются в один следующий проход (не больше KB_SEARCH_MAX_BATCH).
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((vector, top_k, future))
+        if self._drainer is None:
+            self._drainer = asyncio.create_task(self._drain())
+        return await future
+
+    async def _drain(self) -> None:
+        try:
+            while self._pending:
+                batch = self._pending[:KB_SEARCH_MAX_BATCH]
+                del self._pending[:KB_SEARCH_MAX_BATCH]
+                top_k = max(k for _, k, _ in batch)
+                index_stats["batches"] += 1
+                index_stats["batched_queries"] += len(batch)
+                try:
+                    results = await asyncio.to_thread(self.search_many, [v for v, _, _ in batch], top_k)
+                except Exception as e:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, k, future), found in zip(batch, results):
+                    if not future.done():
+                        future.set_result(found[:k])
+        finally:
+            self._drainer = None
+
+
+def write_index(path: str, embeddings, texts: list[str], model: str) -> None:
+    """Записывает индекс в каталог path (через временный каталог — читатели не увидят половину)."""
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.ndim != 2 or matrix.shape[0] != len(texts):
+        raise ValueError(f"Ожидалась матрица [{len(texts)}, dim], получено {matrix.shape}")
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix = matrix / norms
+
+    encoded = [text.encode("utf-8") for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(chunk) for chunk in encoded], out=offsets[1:])
+
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "embeddings.npy"), matrix)
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+    with open(os.path.join(tmp_path, "texts.bin"), "wb") as f:
+        for chunk in encoded:
+            f.write(chunk)
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"model": model, "dim": int(matrix.shape[1]), "count": len(texts)}, f)
+
+    old_path = f"{path}.old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def get_index(db_name: str) -> VectorIndex:
+    """Индекс базы db_name (открывается при первом обращении)."""
+    index = _indexes.get(db_name)
+    if index is None:
+        index = _indexes[db_name] = VectorIndex(os.path.join(KB_INDEX_DIR, db_name))
+        logger.info(f"Открыт индекс {db_name}: {index.size} фрагментов, dim={index.dim}, модель {index.model}")
+    return index
+
+
+def load_indexes() -> None:
+    """Открывает все индексы из KB_INDEX_DIR при старте, чтобы ошибки сборки были видны сразу."""
+    if not os.path.isdir(KB_INDEX_DIR):
+        logger.error(f"Каталог индексов {KB_INDEX_DIR} не найден")
+        return
+    for db_name in sorted(os.listdir(KB_INDEX_DIR)):
+        if not db_name.endswith((".tmp", ".old")) and os.path.isfile(os.path.join(KB_INDEX_DIR, db_name, "meta.json")):
+            try:
+                get_index(db_name)
+            except Exception as e:
+                logger.error(f"Не удалось открыть индекс {db_name}: {e}")
+
+
+def drop_indexes(db_name: str = None) -> None:
+    """Закрывает открытые индексы (после пересборки); следующий запрос откроет новые файлы."""
+    if db_name:
+        _indexes.pop(db_name, None)
+    else:
+        _indexes.clear()
+
+
+async def search_embedded(query: str, db_name: str, top_k: int):
+    """Поиск во встроенном индексе. None — ошибка (такой результат не кэшируем)."""
+    try:
+        index = get_index(db_name)
+        vector = (await embed_texts([query], index.model))[0]
+        with track_stage("kb_vector_search"):
+            results = await index.search_async(vector, top_k)
+        index_stats["searches"] += 1
+        return results
+    except Exception as e:
+        index_stats["errors"] += 1
+        logger.error(f"Ошибка поиска во встроенном индексе {db_name}: {e}")
+        return None
+
+
+def get_vector_index_stats() -> dict:
+    return {
+        **index_stats,
+        "indexes": {name: {"size": index.size, "dim": index.dim, "model": index.model}
+                    for name, index in _indexes.items()},
+    }
@@ -0,0 +1,372 @@
+import os
+import time
+import zlib
+import asyncio
+import logging
+from botocore.exceptions import ClientError
+from src.db_manager import get_dynamodb, batch_write
+from src.http_clients import get_http_client
+
+
+logger = logging.getLogger(__name__)
+
+WELCOME_TABLE = "WelcomeQueue"
+MESSENGER_BASE_URL = os.getenv("MESSENGER_BASE_URL", "http://localhost:9000")
+WELCOME_DELAY_MIN = int(os.getenv("WELCOME_DELAY_MINUTES", "10"))
+WELCOME_CHECK_INTERVAL = int(os.getenv("WELCOME_CHECK_INTERVAL", "600"))
+
+# Разреженный GSI: атрибут pending есть только у необработанных записей,
+# поэтому в индекс попадают лишь те, кому ещё нужно отправить welcome.
+# Значение pending — номер шарда ("1".."WELCOME_SHARDS"): шарды раздаются репликам по аренде
+# (src/welcome_scheduler.py). Записи, созданные до шардирования, имеют pending="1" — это шард 1.
+WELCOME_PENDING_INDEX = os.getenv("WELCOME_PENDING_INDEX", "pending-created_at-index")
+# Уменьшать без миграции нельзя: записи шардов с большими номерами никто не прочитает
+WELCOME_SHARDS = int(os.getenv("WELCOME_SHARDS", "8"))
+WELCOME_ENSURE_INDEX = os.getenv("WELCOME_ENSURE_INDEX", "true").lower() == "true"
+
+# Пакетная обработка очереди
+MESSENGER_BATCH_SIZE = int(os.getenv("MESSENGER_BATCH_SIZE", "50"))               # chatIds в одном запросе
+# От чьего имени запрашивать сразу много чатов; пусто — по одному чату от имени его пользователя
+MESSENGER_BATCH_USER_ID = os.getenv("MESSENGER_BATCH_USER_ID", "")
+WELCOME_SEND_CONCURRENCY = int(os.getenv("WELCOME_SEND_CONCURRENCY", "20"))
+WELCOME_MAX_ATTEMPTS = int(os.getenv("WELCOME_MAX_ATTEMPTS", "5"))
+WELCOME_RETRY_BASE_SECONDS = int(os.getenv("WELCOME_RETRY_BASE_SECONDS", "60"))
+WELCOME_RETRY_MAX_SECONDS = int(os.getenv("WELCOME_RETRY_MAX_SECONDS", "3600"))
+
+
+# Захват записи репликой перед отправкой (src/welcome_scheduler.py) — в обработанную запись не переносится
+CLAIM_ATTRIBUTES = ("claimed_by", "claim_expires")
+
+# Сколько пачек пришлось перечитать по одному чату (в ответе не было chatId)
+batch_fallbacks = {"count": 0}
+
+# Уведомление планировщика о новой записи этой реплики: fn(user_id, created_at)
+_enqueue_listener = None
+
+
+def shard_for(user_id: str) -> str:
+    return str(zlib.crc32(user_id.encode("utf-8")) % WELCOME_SHARDS + 1)
+
+
+def all_shards() -> list[str]:
+    return [str(shard) for shard in range(1, WELCOME_SHARDS + 1)]
+
+
+def set_enqueue_listener(listener) -> None:
+    global _enqueue_listener
+    _enqueue_listener = listener
+
+
+async def get_chat_messages(chat_id: str, user_id: str) -> list[dict]:
+    url = f"{MESSENGER_BASE_URL}/internal/messenger/last-messages-by-chat"
+    payload = {"userId": user_id, "chatIds": [chat_id]}
+    client = get_http_client("messenger")
+    resp = await client.post(url, json=payload)
+    resp.raise_for_status()
+    # правильный ключ – "data"
+    items = resp.json().get("data", [])
+    return items[0:1]                      # вернём хотя бы один элемент, если есть
+
+
+async def get_chat_messages_batch(chats: dict[str, str]) -> dict[str, list[dict]]:
+    """
+    Последние сообщения сразу для многих чатов: chats — chatId -> user_id владельца.
+    Возвращает chatId -> список элементов ответа.
+
+    С MESSENGER_BATCH_USER_ID chatIds уходят пачками по MESSENGER_BATCH_SIZE от имени этого
+    пользователя, ответ раскладывается по полю chatId. Если хоть один элемент пачки нельзя отнести
+    к чату, пачка перечитывается по одному чату от имени самого пользователя: иначе пользователь,
+    который уже ответил, выглядел бы молчащим и получил бы welcome.
+    Без MESSENGER_BATCH_USER_ID — сразу по одному чату (не больше WELCOME_SEND_CONCURRENCY одновременно).
+    """
+    url = f"{MESSENGER_BASE_URL}/internal/messenger/last-messages-by-chat"
+    client = get_http_client("messenger")
+    result = {chat_id: [] for chat_id in chats}
+    sem = asyncio.Semaphore(WELCOME_SEND_CONCURRENCY)
+
+    async def fetch_one(chat_id: str) -> None:
+        async with sem:
+            result[chat_id] = await get_chat_messages(chat_id, chats[chat_id])
+
+    async def fetch(batch: list[str]) -> None:
+        resp = await client.post(url, json={"userId": MESSENGER_BATCH_USER_ID, "chatIds": batch})
+        resp.raise_for_status()
+        items = resp.json().get("data", [])
+        if any(item.get("chatId") not in chats for item in items):
+            batch_fallbacks["count"] += 1
+            logger.warning(f"Ответ мессенджера без chatId, перечитываем {len(batch)} чатов по одному")
+            await asyncio.gather(*(fetch_one(chat_id) for chat_id in batch))
+            return
+        for item in items:
+            result[item["chatId"]].append(item)
+
+    chat_ids = list(chats)
+    if not MESSENGER_BATCH_USER_ID:
+        await asyncio.gather(*(fetch_one(chat_id) for chat_id in chat_ids))
+        return result
+
+    batches = [chat_ids[i:i + MESSENGER_BATCH_SIZE] for i in range(0, len(chat_ids), MESSENGER_BATCH_SIZE)]
+    await asyncio.gather(*(fetch(batch) for batch in batches))
+    return result
+
+
+async def send_welcome_message(chat_id: str, user_id: str) -> None:
+    url = f"{MESSENGER_BASE_URL}/internal/messenger"
+    now_ms = int(time.time() * 1000)
+    payload = {
+        "chatId":   chat_id,
+        "time":     now_ms,                     # ← ДОБАВИЛИ
+        "message": (
+            "Hello, beautiful! Welcome to Eshe. "
+            "This isn’t just a period tracker — Eshe is your all-in-one "
+            "wellness companion. Would you like a quick tour of what’s inside?"
+        ),
+        "type":     "SIMPLE",
+        "senderId": "support",
+        "systemAction": {
+            "id":         "welcome_buttons",
+            "text":       "Choose a topic:",
+            "answerType": "BUTTON",
+            "inputType":  "NONE",
+            "buttons": [
+                {"id": "btn_checkups",  "title": "Tell me about Check-Ups"},
+                {"id": "btn_courses",   "title": "Tell me about Mini-Courses"},
+                {"id": "btn_articles",  "title": "Tell me about Articles"},
+                {"id": "btn_calendars", "title": "Tell me about Calendars"}
+            ]
+        }
+    }
+
+    client = get_http_client("messenger")
+    resp = await client.post(url, json=payload)
+    if resp.status_code >= 400:           # подробный лог, если снова 4xx/5xx
+        logger.error("Messenger 400-response: %s", resp.text)
+    resp.raise_for_status()
+    logger.info("Welcome-сообщение отправлено user=%s", user_id)
+
+
+
+
+def welcome_queue_item(user_id: str, created_at: int) -> dict:
+    return {
+        "user_id": {"S": user_id},
+        "created_at": {"N": str(created_at)},
+        "processed": {"BOOL": False},
+        "failed_attempts": {"N": "0"},
+        "pending": {"S": shard_for(user_id)},
+    }
+
+
+async def put_into_welcome_queue(user_id: str) -> None:
+    dynamodb = get_dynamodb()
+    created_at = int(time.time())
+    try:
+        await dynamodb.put_item(
+            TableName=WELCOME_TABLE,
+            Item=welcome_queue_item(user_id, created_at),
+            ConditionExpression="attribute_not_exists(user_id)"   # <-- ключевая строка
+        )
+    except ClientError as ce:
+        # «ConditionalCheckFailed» - OK, запись уже была
+        if ce.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return
+
+    if _enqueue_listener is not None:
+        _enqueue_listener(user_id, created_at)
+
+
+async def put_many_into_welcome_queue(user_ids: list[str]) -> list[str]:
+    """
+    Пакетная постановка новых пользователей в очередь (BatchWriteItem, без условия —
+    вызывающий передаёт только тех, кого ещё нет в Users). Возвращает user_id, которые записать не удалось.
+    """
+    created_at = int(time.time())
+    failed = await batch_write(WELCOME_TABLE, [
+        {"PutRequest": {"Item": welcome_queue_item(user_id, created_at)}} for user_id in user_ids
+    ])
+    failed_ids = [request["PutRequest"]["Item"]["user_id"]["S"] for request in failed]
+    if _enqueue_listener is not None:
+        skip = set(failed_ids)
+        for user_id in user_ids:
+            if user_id not in skip:
+                _enqueue_listener(user_id, created_at)
+    return failed_ids
+
+
+async def mark_processed(user_id: str) -> None:
+    dynamodb = get_dynamodb()
+    await dynamodb.update_item(
+        TableName=WELCOME_TABLE,
+        Key={"user_id": {"S": user_id}},
+        # REMOVE pending — запись выпадает из разреженного индекса
+        UpdateExpression="SET #processed = :p REMOVE #pending",
+        # processed — зарезервированное слово DynamoDB, нужен алиас
+        ExpressionAttributeNames={"#processed": "processed", "#pending": "pending"},
+        ExpressionAttributeValues={":p": {"BOOL": True}}
+    )
+
+
+async def query_shard_items(dynamodb, shard: str, cutoff: int, retry_before: int = None) -> list[dict]:
+    """
+    Читает из GSI необработанные записи шарда с created_at <= cutoff (со всеми страницами).
+    retry_before — граница next_attempt_at для записей с неудачной попыткой (по умолчанию — сейчас).
+    """
+    items = []
+    kwargs = {
+        "TableName": WELCOME_TABLE,
+        "IndexName": WELCOME_PENDING_INDEX,
+        "KeyConditionExpression": "#pending = :p AND created_at <= :cutoff",
+        # записи с неудачной попыткой ждут next_attempt_at (backoff)
+        "FilterExpression": "attribute_not_exists(next_attempt_at) OR next_attempt_at <= :now",
+        "ExpressionAttributeNames": {"#pending": "pending"},
+        "ExpressionAttributeValues": {
+            ":p": {"S": shard},
+            ":cutoff": {"N": str(cutoff)},
+            ":now": {"N": str(retry_before if retry_before is not None else int(time.time()))},
+        },
+    }
+    while True:
+        resp = await dynamodb.query(**kwargs)
+        items.extend(resp.get("Items", []))
+        last_key = resp.get("LastEvaluatedKey")
+        if not last_key:
+            return items
+        kwargs["ExclusiveStartKey"] = last_key
+
+
+async def scan_due_items(dynamodb, cutoff: int, retry_before: int = None) -> list[dict]:
+    """
+    Запасной путь, пока индекс не создан или строится: постраничный scan с фильтром на стороне DynamoDB.
+    Параметры — как у query_shard_items, но записи всех шардов.
+    """
+    items = []
+    kwargs = {
+        "TableName": WELCOME_TABLE,
+        "FilterExpression": (
+            "#processed = :f AND created_at <= :cutoff AND "
+            "(attribute_not_exists(next_attempt_at) OR next_attempt_at <= :now)"
+        ),
+        "ExpressionAttributeNames": {"#processed": "processed"},
+        "ExpressionAttributeValues": {
+            ":f": {"BOOL": False},
+            ":cutoff": {"N": str(cutoff)},
+            ":now": {"N": str(retry_before if retry_before is not None else int(time.time()))},
+        },
+    }
+    while True:
+        resp = await dynamodb.scan(**kwargs)
+        items.extend(resp.get("Items", []))
+        last_key = resp.get("LastEvaluatedKey")
+        if not last_key:
+            return items
+        kwargs["ExclusiveStartKey"] = last_key
+
+
+def item_shard(item: dict) -> str:
+    """Шард записи: значение pending, а у старых записей без pending — по user_id."""
+    return item.get("pending", {}).get("S") or shard_for(item["user_id"]["S"])
+
+
+async def ensure_welcome_index() -> None:
+    """
+    Создаёт разреженный GSI для WelcomeQueue, если его нет (одно DescribeTable при старте).
+    Старым записям без pending атрибут проставляет разовая миграция
+    scripts/backfill_welcome_pending.py — без неё они в индекс не попадут.
+    """
+    dynamodb = get_dynamodb()
+    table = (await dynamodb.describe_table(TableName=WELCOME_TABLE))["Table"]
+    indexes = [gsi["IndexName"] for gsi in table.get("GlobalSecondaryIndexes", [])]
+
+    if WELCOME_PENDING_INDEX not in indexes:
+        index = {
+            "IndexName": WELCOME_PENDING_INDEX,
+            "KeySchema": [
+                {"AttributeName": "pending", "KeyType": "HASH"},
+                {"AttributeName": "created_at", "KeyType": "RANGE"},
+            ],
+            "Projection": {"ProjectionType": "ALL"},
+        }
+        if table.get("BillingModeSummary", {}).get("BillingMode") != "PAY_PER_REQUEST":
+            index["ProvisionedThroughput"] = {"ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
+
+        await dynamodb.update_table(
+            TableName=WELCOME_TABLE,
+            AttributeDefinitions=[
+                {"AttributeName": "pending", "AttributeType": "S"},
+                {"AttributeName": "created_at", "AttributeType": "N"},
+            ],
+            GlobalSecondaryIndexUpdates=[{"Create": index}],
+        )
+        logger.info(f"Создаётся индекс {WELCOME_PENDING_INDEX} для {WELCOME_TABLE}")
+
+
+def _processed_item(item: dict, failed: bool = False) -> dict:
+    """Полная копия записи очереди, помеченная processed (без pending — выпадает из индекса)."""
+    updated = {k: v for k, v in item.items() if k not in ("pending", "next_attempt_at", *CLAIM_ATTRIBUTES)}
+    updated["processed"] = {"BOOL": True}
+    if failed:
+        updated["failed"] = {"BOOL": True}
+    return updated
+
+
+def _retry_item(item: dict) -> dict:
+    """Копия записи с увеличенным failed_attempts и временем следующей попытки."""
+    attempts = int(item.get("failed_attempts", {}).get("N", "0")) + 1
+    if attempts >= WELCOME_MAX_ATTEMPTS:
+        logger.error(f"welcome для user={item['user_id']['S']} не отправлен за {attempts} попыток, сдаёмся")
+        return _processed_item({**item, "failed_attempts": {"N": str(attempts)}}, failed=True)
+
+    delay = min(WELCOME_RETRY_MAX_SECONDS, WELCOME_RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+    updated = {k: v for k, v in item.items() if k not in CLAIM_ATTRIBUTES}
+    updated["failed_attempts"] = {"N": str(attempts)}
+    updated["next_attempt_at"] = {"N": str(int(time.time()) + delay)}
+    return updated
+
+
+async def process_due_items(items: list[dict]) -> dict:
+    """
+    Обрабатывает пачку записей очереди:
+    1) одним-несколькими запросами получает последние сообщения всех чатов;
+    2) параллельно (не более WELCOME_SEND_CONCURRENCY) отправляет welcome;
+    3) одной серией BatchWriteItem помечает processed / планирует повтор.
+    """
+    stats = {"due": len(items), "sent": 0, "skipped": 0, "failed": 0}
+    if not items:
+        return stats
+
+    by_chat = {f"sup:{item['user_id']['S']}": item for item in items}
+    try:
+        chats = await get_chat_messages_batch({chat_id: item["user_id"]["S"] for chat_id, item in by_chat.items()})
+    except Exception as exc:
+        # Мессенджер недоступен — повторим всю пачку позже
+        logger.error(f"Не удалось получить сообщения чатов: {exc}")
+        stats["failed"] = len(items)
+        await batch_write(WELCOME_TABLE, [{"PutRequest": {"Item": _retry_item(item)}} for item in items])
+        return stats
+
+    sem = asyncio.Semaphore(WELCOME_SEND_CONCURRENCY)
+
+    async def handle(chat_id: str, item: dict) -> dict:
+        user_id = item["user_id"]["S"]
+        # проверяем, есть ли хоть одно сообщение, где senderId == user_id
+        has_user_msg = any(m.get("lastMessage", {}).get("senderId") == user_id for m in chats.get(chat_id, []))
+        if has_user_msg:
+            stats["skipped"] += 1
+            return _processed_item(item)
+        try:
+            async with sem:
+                await send_welcome_message(chat_id, user_id)
+            stats["sent"] += 1
+            return _processed_item(item)
+        except Exception as exc:
+            logger.error(f"Не удалось обработать user={user_id}: {exc}")
+            stats["failed"] += 1
+            return _retry_item(item)
+
+    updated = await asyncio.gather(*(handle(chat_id, item) for chat_id, item in by_chat.items()))
+    unprocessed = await batch_write(WELCOME_TABLE, [{"PutRequest": {"Item": item}} for item in updated])
+    if unprocessed:
+        # не критично: записи останутся в индексе и будут обработаны в следующем цикле
+        logger.error(f"WelcomeQueue: не удалось обновить {len(unprocessed)} записей")
+    return stats
@@ -0,0 +1,420 @@
+import os
+import math
+import time
+import heapq
+import uuid
+import socket
+import asyncio
+import logging
+from botocore.exceptions import ClientError
+from src.db_manager import get_dynamodb
+from src.metrics import Counter, stage_seconds, track_stage
+from src.welcome import (
+    WELCOME_TABLE, WELCOME_DELAY_MIN, WELCOME_CHECK_INTERVAL, WELCOME_ENSURE_INDEX, WELCOME_PENDING_INDEX,
+    MESSENGER_BATCH_SIZE, ensure_welcome_index, query_shard_items, scan_due_items, item_shard, process_due_items,
+    all_shards, shard_for, set_enqueue_listener, batch_fallbacks,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Планировщик welcome для нескольких реплик.
+# Очередь разбита на шарды; каждый шард в любой момент принадлежит одной реплике по аренде
+# (запись в WELCOME_LEASE_TABLE с владельцем и сроком, продлевается heartbeat'ом).
+# Реплики видят друг друга по записям member#... и делят шарды поровну.
+# Записи своих шардов реплика держит в куче таймеров и отправляет ровно в
+# created_at + WELCOME_DELAY_MINUTES, предварительно захватив запись условным UpdateItem.
+WELCOME_LEASE_TABLE = os.getenv("WELCOME_LEASE_TABLE", "WelcomeLeases")
+WELCOME_LEASE_TTL = float(os.getenv("WELCOME_LEASE_TTL", "30"))
+WELCOME_HEARTBEAT_INTERVAL = float(os.getenv("WELCOME_HEARTBEAT_INTERVAL", "10"))
+WELCOME_CLAIM_TTL = int(os.getenv("WELCOME_CLAIM_TTL", "120"))
+WELCOME_CLAIM_CONCURRENCY = int(os.getenv("WELCOME_CLAIM_CONCURRENCY", "20"))
+# Записи подгружаются в кучу заранее: всё, что станет due в ближайшие WELCOME_LOOKAHEAD секунд
+WELCOME_LOOKAHEAD = int(os.getenv("WELCOME_LOOKAHEAD", str(2 * WELCOME_CHECK_INTERVAL)))
+# Записи, которые станут due в пределах этого окна, отправляются одной пачкой
+WELCOME_FIRE_WINDOW = float(os.getenv("WELCOME_FIRE_WINDOW", "0.5"))
+# Пауза между попытками подготовить таблицы при старте (удваивается до максимума)
+WELCOME_STARTUP_RETRY_DELAY = float(os.getenv("WELCOME_STARTUP_RETRY_DELAY", "1"))
+WELCOME_STARTUP_RETRY_MAX_DELAY = float(os.getenv("WELCOME_STARTUP_RETRY_MAX_DELAY", "60"))
+
+SHARD_PREFIX = "shard#"
+MEMBER_PREFIX = "member#"
+
+welcome_items = Counter("welcome_items_total", "Записи WelcomeQueue, обработанные воркером", ("result",))
+welcome_claims = Counter("welcome_claims_total", "Попытки захвата записей WelcomeQueue", ("result",))
+
+
+def _lease_key(lease_id: str) -> dict:
+    return {"lease_id": {"S": lease_id}}
+
+
+def _due_at(item: dict) -> int:
+    """Когда отправлять: created_at + задержка, а после неудачной попытки — next_attempt_at."""
+    due = int(item["created_at"]["N"]) + WELCOME_DELAY_MIN * 60
+    if "next_attempt_at" in item:
+        due = max(due, int(item["next_attempt_at"]["N"]))
+    return due
+
+
+class WelcomeScheduler:
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.shards = set()         # шарды, аренда которых у этой реплики
+        self.members = 1
+        self._heap = []             # (due_at, user_id, shard)
+        self._scheduled = {}        # user_id -> due_at (без дублей в куче)
+        self._inflight = set()      # user_id, которые сейчас отправляются (опрос мог снова их прочитать)
+        self._wakeup = asyncio.Event()
+        self._poll_now = asyncio.Event()
+        self.stats = {"fired": 0, "claimed": 0, "claim_conflicts": 0, "leases_acquired": 0, "leases_lost": 0,
+                      "scan_fallbacks": 0}
+
+    # --- аренда шардов ---
+
+    async def _put_lease(self, lease_id: str, expires_at: float, condition: str = None, values: dict = None) -> bool:
+        kwargs = {
+            "TableName": WELCOME_LEASE_TABLE,
+            "Key": _lease_key(lease_id),
+            "UpdateExpression": "SET #owner = :me, expires_at = :exp",
+            "ExpressionAttributeNames": {"#owner": "owner"},
+            "ExpressionAttributeValues": {":me": {"S": self.owner}, ":exp": {"N": str(expires_at)}, **(values or {})},
+        }
+        if condition:
+            kwargs["ConditionExpression"] = condition
+        try:
+            await get_dynamodb().update_item(**kwargs)
+            return True
+        except ClientError as ce:
+            if ce.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+
+    async def _acquire(self, shard: str, now: float) -> bool:
+        # Свободна, истекла или уже наша
+        return await self._put_lease(
+            SHARD_PREFIX + shard, now + WELCOME_LEASE_TTL,
+            condition="attribute_not_exists(lease_id) OR expires_at < :now OR #owner = :me",
+            values={":now": {"N": str(now)}},
+        )
+
+    async def _renew(self, shard: str, now: float) -> bool:
+        return await self._put_lease(SHARD_PREFIX + shard, now + WELCOME_LEASE_TTL, condition="#owner = :me")
+
+    async def _release(self, shard: str) -> None:
+        # expires_at = 0 — шард сразу свободен для других
+        await self._put_lease(SHARD_PREFIX + shard, 0, condition="#owner = :me")
+
+    async def _read_leases(self) -> list[dict]:
+        items = []
+        kwargs = {"TableName": WELCOME_LEASE_TABLE, "ConsistentRead": True}
+        while True:
+            resp = await get_dynamodb().scan(**kwargs)
+            items.extend(resp.get("Items", []))
+            if not resp.get("LastEvaluatedKey"):
+                return items
+            kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+    async def heartbeat(self) -> None:
+        """Продление своих аренд и выравнивание числа шардов по живым репликам."""
+        now = time.time()
+        await self._put_lease(MEMBER_PREFIX + self.owner, now + WELCOME_LEASE_TTL)
+
+        leases = await self._read_leases()
+        live = {
+            item["lease_id"]["S"]: item["owner"]["S"]
+            for item in leases
+            if float(item.get("expires_at", {}).get("N", "0")) > now and "owner" in item
+        }
+        self.members = max(1, sum(1 for lease_id in live if lease_id.startswith(MEMBER_PREFIX)))
+        fair_share = math.ceil(len(all_shards()) / self.members)
+
+        for shard in sorted(self.shards):
+            if not await self._renew(shard, now):
+                logger.warning(f"Аренда шарда {shard} потеряна")
+                self._drop_shard(shard)
+
+        # Лишние шарды отдаём: их подхватят новые реплики
+        while len(self.shards) > fair_share:
+            shard = max(self.shards)
+            await self._release(shard)
+            self._drop_shard(shard)
+            logger.info(f"Шард {shard} отдан (реплик: {self.members})")
+
+        for shard in all_shards():
+            if len(self.shards) >= fair_share:
+                break
+            if shard in self.shards or live.get(SHARD_PREFIX + shard, self.owner) != self.owner:
+                continue
+            if await self._acquire(shard, now):
+                self.shards.add(shard)
+                self.stats["leases_acquired"] += 1
+                self._poll_now.set()
+                logger.info(f"Шард {shard} получен (реплик: {self.members})")
+
+    def _drop_shard(self, shard: str) -> None:
+        self.shards.discard(shard)
+        self.stats["leases_lost"] += 1
+        # Записи шарда остаются в куче, но при срабатывании будут пропущены
+
+    async def release_all(self) -> None:
+        for shard in list(self.shards):
+            try:
+                await self._release(shard)
+            except Exception as e:
+                logger.warning(f"Не удалось освободить шард {shard}: {e}")
+        self.shards.clear()
+        try:
+            await get_dynamodb().delete_item(TableName=WELCOME_LEASE_TABLE, Key=_lease_key(MEMBER_PREFIX + self.owner))
+        except Exception as e:
+            logger.warning(f"Не удалось удалить запись реплики: {e}")
+
+    # --- куча таймеров ---
+
+    def schedule(self, user_id: str, shard: str, due_at: int) -> None:
+        if user_id in self._inflight or self._scheduled.get(user_id) == due_at:
+            return
+        self._scheduled[user_id] = due_at
+        heapq.heappush(self._heap, (due_at, user_id, shard))
+        if self._heap[0][1] == user_id:
+            self._wakeup.set()
+
+    def on_enqueued(self, user_id: str, created_at: int) -> None:
+        """Новая запись этой реплики: если шард наш, ставим таймер сразу, без ожидания опроса."""
+        shard = shard_for(user_id)
+        if shard in self.shards:
+            self.schedule(user_id, shard, created_at + WELCOME_DELAY_MIN * 60)
+
+    async def poll(self) -> None:
+        """Подгружает в кучу записи своих шардов, которые станут due в ближайшие WELCOME_LOOKAHEAD секунд."""
+        horizon = int(time.time()) + WELCOME_LOOKAHEAD
+        cutoff = horizon - WELCOME_DELAY_MIN * 60
+        dynamodb = get_dynamodb()
+        shards = sorted(self.shards)
+        try:
+            items = []
+            for shard in shards:
+                items.extend(await query_shard_items(dynamodb, shard, cutoff, retry_before=horizon))
+        except ClientError as ce:
+            # Индекс ещё не создан или строится — читаем через scan и берём записи своих шардов
+            if ce.response["Error"]["Code"] not in ("ValidationException", "ResourceNotFoundException"):
+                raise
+            logger.warning(f"Индекс {WELCOME_PENDING_INDEX} недоступен ({ce}), используем scan")
+            self.stats["scan_fallbacks"] += 1
+            items = [item for item in await scan_due_items(dynamodb, cutoff, retry_before=horizon)
+                     if item_shard(item) in self.shards]
+        for item in items:
+            self.schedule(item["user_id"]["S"], item_shard(item), _due_at(item))
+
+    def _pop_due(self) -> list[tuple]:
+        limit = time.time() + WELCOME_FIRE_WINDOW
+        fired = []
+        while self._heap and self._heap[0][0] <= limit and len(fired) < MESSENGER_BATCH_SIZE:
+            due_at, user_id, shard = heapq.heappop(self._heap)
+            # Устаревший дубль (таймер переставлен) или шард уже не наш
+            if self._scheduled.get(user_id) != due_at:
+                continue
+            del self._scheduled[user_id]
+            if shard in self.shards:
+                fired.append((due_at, user_id))
+        return fired
+
+    async def claim(self, user_id: str) -> dict:
+        """
+        Условный захват записи перед отправкой: запись ещё не обработана (в том числе старая,
+        без pending), её срок наступил
+        и никто другой её не держит. Возвращает свежую запись или None.
+        """
+        now = int(time.time())
+        try:
+            resp = await get_dynamodb().update_item(
+                TableName=WELCOME_TABLE,
+                Key={"user_id": {"S": user_id}},
+                UpdateExpression="SET claimed_by = :me, claim_expires = :exp",
+                ConditionExpression=(
+                    "#processed = :f "
+                    "AND (attribute_not_exists(claim_expires) OR claim_expires < :now OR claimed_by = :me) "
+                    "AND (attribute_not_exists(next_attempt_at) OR next_attempt_at <= :now)"
+                ),
+                ExpressionAttributeNames={"#processed": "processed"},
+                ExpressionAttributeValues={
+                    ":f": {"BOOL": False},
+                    ":me": {"S": self.owner},
+                    ":now": {"N": str(now)},
+                    ":exp": {"N": str(now + WELCOME_CLAIM_TTL)},
+                },
+                ReturnValues="ALL_NEW",
+            )
+        except ClientError as ce:
+            if ce.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            self.stats["claim_conflicts"] += 1
+            welcome_claims.inc(result="conflict")
+            return None
+        self.stats["claimed"] += 1
+        welcome_claims.inc(result="claimed")
+        return resp["Attributes"]
+
+    async def fire(self, due: list[tuple]) -> dict:
+        now = time.time()
+        for due_at, _ in due:
+            stage_seconds.observe(max(0.0, now - due_at), stage="welcome_fire_lag")
+        self.stats["fired"] += len(due)
+
+        sem = asyncio.Semaphore(WELCOME_CLAIM_CONCURRENCY)
+
+        async def claim(user_id: str):
+            async with sem:
+                return await self.claim(user_id)
+
+        user_ids = [user_id for _, user_id in due]
+        self._inflight.update(user_ids)
+        try:
+            claimed = [item for item in await asyncio.gather(*(claim(user_id) for user_id in user_ids)) if item]
+            if not claimed:
+                return {"due": 0, "sent": 0, "skipped": 0, "failed": 0}
+            with track_stage("welcome_cycle"):
+                stats = await process_due_items(claimed)
+        finally:
+            self._inflight.difference_update(user_ids)
+        for key in ("sent", "skipped", "failed"):
+            if stats.get(key):
+                welcome_items.inc(stats[key], result=key)
+        logger.info(f"welcome: {stats}")
+        # Неудачные попытки вернутся в кучу при следующем опросе (по next_attempt_at)
+        return stats
+
+    async def fire_due(self):
+        """Отправляет записи, срок которых наступил (одна пачка). None — отправлять нечего."""
+        due = self._pop_due()
+        if not due:
+            return None
+        return await self.fire(due)
+
+    # --- фоновые циклы ---
+
+    async def lease_loop(self) -> None:
+        while True:
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error(f"welcome: ошибка heartbeat: {e}")
+            await asyncio.sleep(WELCOME_HEARTBEAT_INTERVAL)
+
+    async def poll_loop(self) -> None:
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error(f"welcome: ошибка опроса очереди: {e}")
+            self._poll_now.clear()
+            try:
+                await asyncio.wait_for(self._poll_now.wait(), timeout=WELCOME_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def timer_loop(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                if await self.fire_due() is not None:
+                    continue
+            except Exception as e:
+                logger.exception(f"welcome: ошибка отправки: {e}")
+                continue
+
+            timeout = self._heap[0][0] - time.time() if self._heap else WELCOME_CHECK_INTERVAL
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, timeout))
+            except asyncio.TimeoutError:
+                pass
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "owner": self.owner,
+            "members": self.members,
+            "shards": sorted(self.shards, key=int),
+            "scheduled": len(self._scheduled),
+            "next_due_in": round(self._heap[0][0] - time.time(), 1) if self._heap else None,
+            "messenger_batch_fallbacks": batch_fallbacks["count"],
+        }
+
+
+async def ensure_lease_table() -> None:
+    """Создаёт таблицу аренд, если её ещё нет, и ждёт, пока она станет ACTIVE."""
+    dynamodb = get_dynamodb()
+    try:
+        await dynamodb.describe_table(TableName=WELCOME_LEASE_TABLE)
+        return
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "ResourceNotFoundException":
+            raise
+    try:
+        await dynamodb.create_table(
+            TableName=WELCOME_LEASE_TABLE,
+            KeySchema=[{"AttributeName": "lease_id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "lease_id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        logger.info(f"Создана таблица {WELCOME_LEASE_TABLE}")
+    except ClientError as ce:
+        # Таблицу одновременно создаёт другая реплика
+        if ce.response["Error"]["Code"] != "ResourceInUseException":
+            raise
+
+    # Пока таблица в статусе CREATING, аренды в неё не записать: дожидаемся ACTIVE
+    waiter = dynamodb.get_waiter("table_exists")
+    await waiter.wait(TableName=WELCOME_LEASE_TABLE, WaiterConfig={"Delay": 2, "MaxAttempts": 60})
+
+
+scheduler = None
+
+
+async def prepare_tables() -> None:
+    """
+    Индекс pending и таблица аренд. Временная ошибка DynamoDB при старте не останавливает
+    воркер: попытки повторяются с растущей паузой. Без индекса опрос работает через scan,
+    поэтому ждём только таблицу аренд.
+    """
+    index_ready = not WELCOME_ENSURE_INDEX
+    delay = WELCOME_STARTUP_RETRY_DELAY
+    while True:
+        if not index_ready:
+            try:
+                await ensure_welcome_index()
+                index_ready = True
+            except Exception as e:
+                logger.error(f"Не удалось подготовить индекс {WELCOME_PENDING_INDEX}: {e}")
+        try:
+            await ensure_lease_table()
+            return
+        except Exception as e:
+            logger.error(f"Таблица {WELCOME_LEASE_TABLE} недоступна: {e}, повтор через {delay:.0f} с")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, WELCOME_STARTUP_RETRY_MAX_DELAY)
+
+
+async def welcome_worker() -> None:
+    """Фоновая задача приложения: аренда шардов, опрос своих шардов и таймеры отправки."""
+    global scheduler
+    await prepare_tables()
+
+    scheduler = WelcomeScheduler()
+    set_enqueue_listener(scheduler.on_enqueued)
+    tasks = [
+        asyncio.create_task(scheduler.lease_loop()),
+        asyncio.create_task(scheduler.poll_loop()),
+        asyncio.create_task(scheduler.timer_loop()),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        set_enqueue_listener(None)
+        await scheduler.release_all()
+
+
+def get_welcome_stats() -> dict:
+    return scheduler.get_stats() if scheduler is not None else {}
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import fcntl
+import random
+import asyncio
+import logging
+from contextlib import contextmanager
+from src.metrics import track_stage
+
+
+logger = logging.getLogger(__name__)
+
+# Отложенная запись (write-behind): ответ пользователю не ждёт записи в DynamoDB.
+# Задания выполняются фоновыми воркерами; то, что не удалось записать, попадает
+# в файл-спул (JSON Lines) и переотправляется, в том числе после перезапуска.
+# Спул общий для всех воркеров uvicorn: дозапись и забор файла на переотправку идут под
+# блокировкой <спул>.lock, а переотправкой в каждый момент занят только один процесс (<спул>.replay.lock).
+WRITE_BEHIND_SPOOL = os.getenv("WRITE_BEHIND_SPOOL", "var/write_behind.jsonl")
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+WRITE_BEHIND_WORKERS = int(os.getenv("WRITE_BEHIND_WORKERS", "4"))
+WRITE_BEHIND_ATTEMPTS = int(os.getenv("WRITE_BEHIND_ATTEMPTS", "3"))
+WRITE_BEHIND_RETRY_INTERVAL = float(os.getenv("WRITE_BEHIND_RETRY_INTERVAL", "30"))
+WRITE_BEHIND_MAX_AGE = float(os.getenv("WRITE_BEHIND_MAX_AGE", str(7 * 24 * 3600)))
+WRITE_BEHIND_DRAIN_TIMEOUT = float(os.getenv("WRITE_BEHIND_DRAIN_TIMEOUT", "10"))
+
+_handlers = {}
+_queue = None
+_tasks = []
+_spool_tasks = set()
+
+write_behind_stats = {"enqueued": 0, "written": 0, "retries": 0, "spooled": 0, "replayed": 0, "dropped": 0}
+
+
+def register_write_handler(kind: str, handler) -> None:
+    """handler(payload) — корутинная функция; должна быть идемпотентной (задание может повториться)."""
+    _handlers[kind] = handler
+
+
+def enqueue_write(kind: str, payload: dict) -> None:
+    """Ставит запись в очередь и сразу возвращает управление."""
+    job = {"kind": kind, "payload": payload, "created_at": time.time(), "attempts": 0}
+    write_behind_stats["enqueued"] += 1
+    if _queue is None:
+        # Воркеры не запущены (например, скрипт без startup) — сохраняем в спул
+        _spool_sync([job])
+        return
+    try:
+        _queue.put_nowait(job)
+    except asyncio.QueueFull:
+        logger.warning(f"Очередь отложенной записи переполнена, задание {kind} уходит в спул")
+        task = asyncio.get_running_loop().create_task(_spool([job]))
+        _spool_tasks.add(task)
+        task.add_done_callback(_spool_tasks.discard)
+
+
+@contextmanager
+def _file_lock(path: str, blocking: bool = True):
+    """Межпроцессная блокировка flock; с blocking=False отдаёт False, если файл занят другим процессом."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _spool_sync(jobs: list[dict]) -> None:
+    if not jobs:
+        return
+    with _file_lock(WRITE_BEHIND_SPOOL + ".lock"):
+        with open(WRITE_BEHIND_SPOOL, "a", encoding="utf-8") as f:
+            for job in jobs:
+                f.write(json.dumps(job, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    write_behind_stats["spooled"] += len(jobs)
+
+
+async def _spool(jobs: list[dict]) -> None:
+    # Блокировка и fsync — в пуле потоков, чтобы не останавливать event loop
+    if jobs:
+        await asyncio.to_thread(_spool_sync, jobs)
+
+
+async def _run(job: dict) -> bool:
+    handler = _handlers.get(job["kind"])
+    if handler is None:
+        logger.error(f"Нет обработчика для отложенной записи {job['kind']}")
+        return False
+    job["attempts"] += 1
+    try:
+        with track_stage(f"write_behind_{job['kind']}"):
+            await handler(job["payload"])
+        write_behind_stats["written"] += 1
+        return True
+    except Exception as e:
+        logger.warning(f"Отложенная запись {job['kind']} не удалась (попытка {job['attempts']}): {e}")
+        return False
+
+
+async def _worker() -> None:
+    while True:
+        job = await _queue.get()
+        try:
+            for attempt in range(WRITE_BEHIND_ATTEMPTS):
+                if await _run(job):
+                    break
+                write_behind_stats["retries"] += 1
+                if attempt < WRITE_BEHIND_ATTEMPTS - 1:
+                    await asyncio.sleep(min(5.0, 0.2 * 2 ** attempt) * random.uniform(0.5, 1.0))
+            else:
+                await _spool([job])
+        except asyncio.CancelledError:
+            # Остановка посреди записи: задание не должно потеряться (синхронно — задача уже отменена)
+            _spool_sync([job])
+            raise
+        finally:
+            _queue.task_done()
+
+
+def _take_spool(replay_path: str):
+    """Забирает спул на переотправку: задания из файла replay_path (остаток прерванного прохода или текущий спул)."""
+    if not os.path.exists(replay_path):
+        # Переименование под той же блокировкой, что и дозапись: ни одна строка не попадёт в уже забранный файл
+        with _file_lock(WRITE_BEHIND_SPOOL + ".lock"):
+            if not os.path.exists(WRITE_BEHIND_SPOOL):
+                return None
+            os.replace(WRITE_BEHIND_SPOOL, replay_path)
+
+    jobs = []
+    with open(replay_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                jobs.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.error(f"Повреждённая строка в спуле отложенной записи: {line[:200]}")
+    return jobs
+
+
+async def replay_spool() -> dict:
+    """Переотправляет задания из спула. Неудавшиеся возвращаются обратно в спул."""
+    result = {"replayed": 0, "failed": 0, "dropped": 0}
+    if not os.path.exists(WRITE_BEHIND_SPOOL) and not os.path.exists(WRITE_BEHIND_SPOOL + ".replay"):
+        return result
+
+    with _file_lock(WRITE_BEHIND_SPOOL + ".replay.lock", blocking=False) as locked:
+        if not locked:
+            # Спул сейчас переотправляет другой процесс
+            return result
+        # Забираем текущий файл целиком: новые сбои пишутся уже в свежий спул.
+        # Файл .replay остаётся до конца прохода — после падения его дочитает следующий проход.
+        replay_path = WRITE_BEHIND_SPOOL + ".replay"
+        jobs = await asyncio.to_thread(_take_spool, replay_path)
+        if jobs is None:
+            return result
+
+        replayed, failed, dropped = 0, [], 0
+        now = time.time()
+        for job in jobs:
+            if now - job.get("created_at", now) > WRITE_BEHIND_MAX_AGE:
+                logger.error(f"Отложенная запись {job['kind']} старше WRITE_BEHIND_MAX_AGE, отбрасываем: {job}")
+                dropped += 1
+                continue
+            if await _run(job):
+                replayed += 1
+            else:
+                failed.append(job)
+
+        await _spool(failed)
+        os.remove(replay_path)
+
+    write_behind_stats["replayed"] += replayed
+    write_behind_stats["dropped"] += dropped
+    if jobs:
+        logger.info(f"Спул отложенной записи: записано {replayed}, снова отложено {len(failed)}, отброшено {dropped}")
+    return {"replayed": replayed, "failed": len(failed), "dropped": dropped}
+
+
+async def spool_retry_worker() -> None:
+    while True:
+        try:
+            await replay_spool()
+        except Exception as e:
+            logger.error(f"Ошибка при переотправке спула: {e}")
+        await asyncio.sleep(WRITE_BEHIND_RETRY_INTERVAL)
+
+
+def start_write_behind() -> None:
+    """Запуск воркеров; первый проход spool_retry_worker дописывает оставшееся с прошлого запуска."""
+    global _queue
+    _queue = asyncio.Queue(maxsize=WRITE_BEHIND_QUEUE_SIZE)
+    for _ in range(WRITE_BEHIND_WORKERS):
+        _tasks.append(asyncio.create_task(_worker()))
+    _tasks.append(asyncio.create_task(spool_retry_worker()))
+
+
+async def stop_write_behind() -> None:
+    """Дожидается очереди (не дольше WRITE_BEHIND_DRAIN_TIMEOUT), остаток сохраняет в спул."""
+    global _queue
+    if _queue is None:
+        return
+    try:
+        await asyncio.wait_for(_queue.join(), timeout=WRITE_BEHIND_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Очередь отложенной записи не успела опустеть: {_queue.qsize()} заданий уходят в спул")
+
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+
+    leftover = []
+    while not _queue.empty():
+        leftover.append(_queue.get_nowait())
+    await _spool(leftover)
+    if _spool_tasks:
+        await asyncio.gather(*_spool_tasks, return_exceptions=True)
+    _queue = None
+
+
+def get_write_behind_stats() -> dict:
+    return {
+        **write_behind_stats,
+        "queued": _queue.qsize() if _queue is not None else 0,
+        "spool_exists": os.path.exists(WRITE_BEHIND_SPOOL),
+    }
@@ -0,0 +1,59 @@
+import os
+import socket
+import pytest
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Модули src читают настройки при импорте: окружение задаётся до первого импорта src.*
+MOTO_PORT = _free_port()
+os.environ["DYNAMODB_ENDPOINT"] = f"http://127.0.0.1:{MOTO_PORT}"
+os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+os.environ["OPENAI_API_KEY"] = "sk-test"
+os.environ["REDIS_URL"] = ""
+os.environ["DYNAMODB_BATCH_WRITE_MAX_RETRIES"] = "2"
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+def moto_server():
+    """DynamoDB на moto в отдельном потоке (aioboto3 ходит к нему по HTTP, как к DynamoDB Local)."""
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=MOTO_PORT, verbose=False)
+    server.start()
+    yield
+    server.stop()
+
+
+@pytest.fixture
+async def dynamodb(moto_server):
+    """Пул клиентов src.db_manager и пустая таблица Users на время теста."""
+    from src.db_manager import init_dynamodb, close_dynamodb, get_dynamodb, TABLE_NAME
+
+    await init_dynamodb()
+    client = get_dynamodb()
+    await client.create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{"AttributeName": "user_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "user_id", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    try:
+        yield client
+    finally:
+        # Скрипты из scripts/ закрывают пул сами — для очистки открываем заново
+        await init_dynamodb()
+        client = get_dynamodb()
+        for table in (await client.list_tables())["TableNames"]:
+            await client.delete_table(TableName=table)
+        await close_dynamodb()
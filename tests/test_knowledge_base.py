@@ -0,0 +1,60 @@
+import asyncio
+import pytest
+
+import src.knowledge_base as kb
+
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def remote(monkeypatch):
+    """Поиск в FAISS-сервисе: отвечает текущей «версией» индекса, пока его не отпустят."""
+    state = {"version": 1, "calls": 0, "release": asyncio.Event()}
+
+    async def search(query, db_name, top_k):
+        version = state["version"]
+        state["calls"] += 1
+        await state["release"].wait()
+        return [{"text": f"v{version}"}]
+
+    monkeypatch.setattr(kb, "KB_BACKEND", "remote")
+    monkeypatch.setattr(kb, "_search_remote", search)
+    kb.kb_cache.clear()
+    return state
+
+
+async def wait_calls(remote, count: int) -> None:
+    for _ in range(100):
+        if remote["calls"] >= count:
+            return
+        await asyncio.sleep(0)
+    pytest.fail(f"ожидалось {count} запросов в FAISS, было {remote['calls']}")
+
+
+async def test_load_started_before_invalidation_is_not_cached(remote):
+    first = asyncio.create_task(kb.query_faiss_service("pain"))
+    await wait_calls(remote, 1)
+
+    remote["version"] = 2
+    await kb.invalidate_kb_cache(kb.KB_DB_NAME)
+    second = asyncio.create_task(kb.query_faiss_service("pain"))
+    await wait_calls(remote, 2)
+    remote["release"].set()
+
+    assert await first == [{"text": "v1"}]
+    # Запрос после сброса не ждёт старую загрузку
+    assert await second == [{"text": "v2"}]
+    assert await kb.query_faiss_service("pain") == [{"text": "v2"}]
+    assert remote["calls"] == 2
+
+
+async def test_invalidation_from_other_replica_clears_local_cache(remote):
+    remote["release"].set()
+    assert await kb.query_faiss_service("pain") == [{"text": "v1"}]
+    remote["version"] = 2
+    assert await kb.query_faiss_service("pain") == [{"text": "v1"}]
+
+    kb._on_invalidation({"db_name": kb.KB_DB_NAME, "source": "other-replica"})
+
+    assert await kb.query_faiss_service("pain") == [{"text": "v2"}]
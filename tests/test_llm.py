@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+import pytest
+
+import src.llm as llm
+from src.llm_gateway import gateway
+
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeStream:
+    """Поток чанков в формате OpenAI chat.completions (stream=True)."""
+
+    def __init__(self, parts: list[str]):
+        self.parts = parts
+        self.closed = False
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        for part in self.parts:
+            delta = SimpleNamespace(content=part)
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    streams = []
+
+    async def create(**kwargs):
+        streams.append(FakeStream(["a", "b", "c"]))
+        return streams[-1]
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(llm, "_client", client)
+    return streams
+
+
+async def test_stream_closed_early_releases_slot_and_upstream(fake_openai):
+    events = llm.stream_llm("вопрос")
+    assert await anext(events) == ("delta", "a")
+    assert gateway.active == 1
+
+    # Клиент отключился: генератор закрывают, не дочитав
+    await events.aclose()
+
+    assert gateway.active == 0
+    assert fake_openai[0].closed
+
+
+async def test_stream_to_the_end(fake_openai):
+    events = [event async for event in llm.stream_llm("вопрос")]
+
+    assert [value for kind, value in events if kind == "delta"] == ["a", "b", "c"]
+    assert events[-1][0] == "done" and events[-1][1][0] == "abc"
+    assert gateway.active == 0
+    assert fake_openai[0].closed
@@ -0,0 +1,179 @@
+import asyncio
+import httpx
+import openai
+import pytest
+
+import src.llm_gateway as llm_gateway
+from src.llm_gateway import LLMGateway, LLMUnavailable, RetryBudget, with_retries
+
+
+pytestmark = pytest.mark.anyio
+
+
+def status_error(cls, status: int, retry_after: str = None):
+    """Ошибка OpenAI SDK с HTTP-ответом, как её бросает клиент."""
+    headers = {"retry-after": retry_after} if retry_after is not None else {}
+    response = httpx.Response(status, headers=headers, request=httpx.Request("POST", "http://openai.test/v1/chat"))
+    return cls(f"status {status}", response=response, body=None)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+# ─────────────────────────  очередь gateway  ──────────────────────────────────
+
+async def test_acquire_up_to_concurrency_then_queue_full():
+    gateway = LLMGateway(max_concurrency=2, queue_size=1, queue_timeout=5)
+    await gateway._acquire()
+    await gateway._acquire()
+    waiting = asyncio.create_task(gateway._acquire())
+    await settle()
+
+    with pytest.raises(LLMUnavailable) as e:
+        await gateway._acquire()
+    assert e.value.reason == "queue_full"
+    assert gateway.stats["rejected_queue_full"] == 1
+
+    gateway._release()
+    await waiting
+    # Слот передан ожидающему, число активных не изменилось
+    assert gateway.active == 2
+    gateway._release()
+    gateway._release()
+    assert gateway.active == 0
+
+
+async def test_release_hands_slots_to_waiters_in_order():
+    gateway = LLMGateway(max_concurrency=1, queue_size=10, queue_timeout=5)
+    await gateway._acquire()
+    order = []
+
+    async def worker(name):
+        await gateway._acquire()
+        order.append(name)
+
+    tasks = [asyncio.create_task(worker(name)) for name in ("a", "b", "c")]
+    await settle()
+    for _ in tasks:
+        gateway._release()
+        await settle()
+
+    assert order == ["a", "b", "c"]
+    assert gateway.active == 1
+    gateway._release()
+    assert gateway.active == 0
+
+
+async def test_queue_timeout_rejects_and_forgets_waiter():
+    gateway = LLMGateway(max_concurrency=1, queue_size=10, queue_timeout=0.01)
+    await gateway._acquire()
+
+    with pytest.raises(LLMUnavailable) as e:
+        await gateway._acquire()
+
+    assert e.value.reason == "timeout"
+    assert not gateway._waiters
+    gateway._release()
+    assert gateway.active == 0
+
+
+async def test_cancelled_waiter_leaves_queue():
+    gateway = LLMGateway(max_concurrency=1, queue_size=10, queue_timeout=5)
+    await gateway._acquire()
+    waiting = asyncio.create_task(gateway._acquire())
+    await settle()
+
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+
+    assert not gateway._waiters
+    gateway._release()
+    assert gateway.active == 0
+
+
+async def test_waiter_cancelled_after_handoff_does_not_leak_slot():
+    gateway = LLMGateway(max_concurrency=1, queue_size=10, queue_timeout=5)
+    await gateway._acquire()
+    waiting = asyncio.create_task(gateway._acquire())
+    await settle()
+
+    # Слот уже передан ожидающему, и тут же его отменяют
+    gateway._release()
+    waiting.cancel()
+    result = (await asyncio.gather(waiting, return_exceptions=True))[0]
+
+    if isinstance(result, asyncio.CancelledError):
+        # Отказавшийся вернул слот
+        assert gateway.active == 0
+    else:
+        # wait_for успел вернуть результат: слот у задачи, и она его освободит
+        assert gateway.active == 1
+        gateway._release()
+        assert gateway.active == 0
+    assert not gateway._waiters
+
+
+# ─────────────────────────  повторы  ──────────────────────────────────
+
+@pytest.fixture
+def retries(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "LLM_MAX_RETRIES", 2)
+    monkeypatch.setattr(llm_gateway, "LLM_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(llm_gateway, "LLM_RETRY_MAX_DELAY", 0.01)
+    budget = RetryBudget(ratio=0.1, min_per_sec=1)
+    monkeypatch.setattr(llm_gateway, "retry_budget", budget)
+    return budget
+
+
+def failing(errors: list, result="ok"):
+    calls = []
+
+    async def make_call():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return make_call, calls
+
+
+async def test_with_retries_retries_transient_errors(retries):
+    connection_error = openai.APIConnectionError(request=httpx.Request("POST", "http://openai.test"))
+    make_call, calls = failing([status_error(openai.RateLimitError, 429, "0"), connection_error])
+
+    assert await with_retries(make_call) == "ok"
+    assert len(calls) == 3
+
+
+async def test_with_retries_does_not_retry_client_errors(retries):
+    make_call, calls = failing([status_error(openai.BadRequestError, 400)])
+
+    with pytest.raises(openai.BadRequestError):
+        await with_retries(make_call)
+    assert len(calls) == 1
+
+
+async def test_with_retries_gives_up_with_upstream_retry_after(retries):
+    errors = [status_error(openai.RateLimitError, 429, "0")] * 2 + [status_error(openai.RateLimitError, 429, "7")]
+    make_call, calls = failing(errors)
+
+    with pytest.raises(LLMUnavailable) as e:
+        await with_retries(make_call)
+
+    assert len(calls) == 3
+    assert e.value.reason == "upstream_429"
+    assert e.value.retry_after == 7
+
+
+async def test_with_retries_stops_when_budget_is_exhausted(retries):
+    retries.tokens = 0
+    make_call, calls = failing([status_error(openai.InternalServerError, 500)])
+
+    with pytest.raises(openai.InternalServerError):
+        await with_retries(make_call)
+
+    assert len(calls) == 1
+    assert retries.exhausted == 1
@@ -0,0 +1,47 @@
+import json
+import pytest
+
+from scripts import migrate_conversation_history
+from src.conversation_store import CONVERSATION_TABLE, make_ts
+from src.db_manager import TABLE_NAME, init_dynamodb, get_dynamodb
+
+
+pytestmark = pytest.mark.anyio
+
+
+async def history_keys(user_id: str) -> list[tuple[int, str, int]]:
+    resp = await get_dynamodb().query(
+        TableName=CONVERSATION_TABLE,
+        KeyConditionExpression="user_id = :u",
+        ExpressionAttributeValues={":u": {"S": user_id}},
+    )
+    return [(int(item["ts"]["N"]), item["message"]["S"], int(item["timestamp"]["N"])) for item in resp["Items"]]
+
+
+async def test_migration_orders_by_blob_and_ignores_loop_time(dynamodb):
+    # Старый код писал в timestamp время event loop (секунды с загрузки системы)
+    blob = [
+        {"role": "user", "message": "first", "timestamp": 9000},
+        {"role": "model", "message": "second", "timestamp": 12},
+        {"role": "user", "message": "third", "timestamp": 5000},
+    ]
+    await dynamodb.put_item(TableName=TABLE_NAME, Item={
+        "user_id": {"S": "u1"}, "conversation_history": {"S": json.dumps(blob)},
+    })
+    started = make_ts()
+
+    await migrate_conversation_history.main(drop_blob=False, dry_run=False, concurrency=2)
+    await init_dynamodb()
+    keys = await history_keys("u1")
+
+    assert [message for _, message, _ in keys] == ["first", "second", "third"]
+    # Перенесённые сообщения — непосредственно перед миграцией, а не в 1970 году
+    assert all(started - 10_000_000 < ts < started + 10_000_000 for ts, _, _ in keys)
+    assert all(abs(timestamp - started // 1_000_000) <= 10 for _, _, timestamp in keys)
+
+    # Повторный запуск переносит в те же ключи
+    await migrate_conversation_history.main(drop_blob=True, dry_run=False, concurrency=2)
+    await init_dynamodb()
+    assert await history_keys("u1") == keys
+    user = (await get_dynamodb().get_item(TableName=TABLE_NAME, Key={"user_id": {"S": "u1"}}))["Item"]
+    assert "conversation_history" not in user
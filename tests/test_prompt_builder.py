@@ -0,0 +1,20 @@
+from src.prompt_builder import PromptBuilder, count_tokens
+
+
+def knowledge(builder: PromptBuilder, budget: int) -> str:
+    return builder._knowledge_text(budget)
+
+
+def test_knowledge_skips_empty_chunks_before_numbering():
+    builder = PromptBuilder().set_knowledge([{"text": "  "}, {"text": "Аспирин"}, {"text": ""}, {"text": "Ибупрофен"}])
+
+    assert knowledge(builder, 0) == "\nИнформация из базы знаний:\n1. Аспирин\n2. Ибупрофен\n"
+
+
+def test_knowledge_drops_chunk_trimmed_to_nothing():
+    builder = PromptBuilder().set_knowledge([{"text": "Очень длинный фрагмент базы знаний " * 20}])
+    # Бюджета хватает только на заголовок: от фрагмента ничего не остаётся
+    budget = count_tokens("\nИнформация из базы знаний:\n") + 2
+
+    assert knowledge(builder, budget) == ""
+    assert "knowledge" in builder.truncated
@@ -0,0 +1,161 @@
+import json
+import pytest
+
+import src.user_ingest as user_ingest
+from src.db_manager import TABLE_NAME
+from src.user_ingest import update_user_profile, ingest_users, iter_records, IngestFormatError
+from src.welcome import WELCOME_TABLE
+
+
+pytestmark = pytest.mark.anyio
+
+
+async def get_user(dynamodb, user_id: str) -> dict:
+    resp = await dynamodb.get_item(TableName=TABLE_NAME, Key={"user_id": {"S": user_id}})
+    return resp.get("Item")
+
+
+@pytest.fixture
+async def welcome_table(dynamodb):
+    await dynamodb.create_table(
+        TableName=WELCOME_TABLE,
+        KeySchema=[{"AttributeName": "user_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "user_id", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+async def body(records: list[dict]):
+    yield "\n".join(json.dumps(record) for record in records).encode()
+
+
+async def chunked(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def read_records(data: bytes, size: int) -> list:
+    return [(index, record) async for index, record in iter_records(chunked(data, size))]
+
+
+# ─────────────────────────  разбор потока  ──────────────────────────────────
+
+ARRAY = '[{"user_id": "a", "name": "Анна"}, {"user_id": "b"},\n {"user_id": "c", "n": 12345}]'.encode()
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, len(ARRAY)])
+async def test_iter_records_json_array_across_chunk_boundaries(size):
+    # Границы чанков режут многобайтовые символы, числа и разделители
+    records = await read_records(ARRAY, size)
+
+    assert records == [
+        (1, {"user_id": "a", "name": "Анна"}),
+        (2, {"user_id": "b"}),
+        (3, {"user_id": "c", "n": 12345}),
+    ]
+
+
+@pytest.mark.parametrize("data", [
+    b'[{"user_id": "a"} {"user_id": "b"}]',
+    b'[{"user_id": "a"},, {"user_id": "b"}]',
+    b'[{"user_id": "a"},]',
+    b'[, {"user_id": "a"}]',
+    b'[{"user_id": "a"}',
+    b'[{"user_id": "a"}, {"user_id": ',
+])
+@pytest.mark.parametrize("size", [1, 1024])
+async def test_iter_records_rejects_broken_array_framing(data, size):
+    with pytest.raises(IngestFormatError):
+        await read_records(data, size)
+
+
+async def test_iter_records_empty_array_and_body():
+    assert await read_records(b" [ ] ", 1) == []
+    assert await read_records(b"", 1) == []
+
+
+async def test_iter_records_json_lines_keeps_going_after_bad_line():
+    data = b'{"user_id": "a"}\n\nnot json\n{"user_id": "b"}'
+
+    records = await read_records(data, 5)
+
+    assert [index for index, _ in records] == [1, 3, 4]
+    assert records[0][1] == {"user_id": "a"}
+    assert isinstance(records[1][1], IngestFormatError)
+    assert records[2][1] == {"user_id": "b"}
+
+
+# ─────────────────────────  запись  ──────────────────────────────────
+
+
+async def test_update_user_profile_full_payload(dynamodb):
+    await dynamodb.put_item(TableName=TABLE_NAME, Item={
+        "user_id": {"S": "u1"}, "name": {"S": "old"}, "version": {"N": "3"},
+    })
+
+    await update_user_profile("u1", {"name": "Anna", "birthday": "1990-01-01", "health_diary": "ok"})
+
+    item = await get_user(dynamodb, "u1")
+    assert item["name"]["S"] == "Anna"
+    assert item["birthday"]["S"] == "1990-01-01"
+    assert item["health_diary"]["S"] == "ok"
+    # Поля вне профиля не трогаются
+    assert item["version"]["N"] == "3"
+
+
+async def test_update_user_profile_partial_payload_keeps_other_fields(dynamodb):
+    await dynamodb.put_item(TableName=TABLE_NAME, Item={
+        "user_id": {"S": "u1"}, "name": {"S": "Anna"}, "birthday": {"S": "1990-01-01"},
+    })
+
+    await update_user_profile("u1", {"health_diary": "headache"})
+
+    item = await get_user(dynamodb, "u1")
+    assert item["name"]["S"] == "Anna"
+    assert item["birthday"]["S"] == "1990-01-01"
+    assert item["health_diary"]["S"] == "headache"
+
+
+async def test_update_user_profile_creates_missing_user(dynamodb):
+    await update_user_profile("u2", {"name": "Ivan"})
+
+    item = await get_user(dynamodb, "u2")
+    assert item["name"]["S"] == "Ivan"
+    assert item["birthday"]["S"] == ""
+    assert item["health_diary"]["S"] == ""
+
+
+async def test_ingest_creates_new_and_updates_existing_full_profiles(dynamodb, welcome_table):
+    await dynamodb.put_item(TableName=TABLE_NAME, Item={"user_id": {"S": "old"}, "name": {"S": "x"}})
+    full = {"name": "N", "birthday": "2000-01-01", "health_diary": "d"}
+
+    result = await ingest_users(body([{"user_id": "old", **full}, {"user_id": "new", **full}]))
+
+    assert (result["created"], result["updated"], result["failed"]) == (1, 1, 0), result["errors"]
+    assert (await get_user(dynamodb, "old"))["name"]["S"] == "N"
+    assert (await get_user(dynamodb, "new"))["birthday"]["S"] == "2000-01-01"
+    welcome = await dynamodb.get_item(TableName=WELCOME_TABLE, Key={"user_id": {"S": "new"}})
+    assert "Item" in welcome
+
+
+async def test_ingest_does_not_overwrite_user_created_after_existence_check(dynamodb, welcome_table, monkeypatch):
+    # Пользователь появился через /add_user между batch_get_keys и записью пачки
+    await dynamodb.put_item(TableName=TABLE_NAME, Item={
+        "user_id": {"S": "u1"}, "name": {"S": "old"}, "version": {"N": "2"},
+        "scenario_history": {"L": [{"S": "step"}]},
+    })
+
+    async def nothing_exists(table_name, keys):
+        return set()
+
+    monkeypatch.setattr(user_ingest, "batch_get_keys", nothing_exists)
+    result = await ingest_users(body([{"user_id": "u1", "name": "new"}]))
+
+    assert (result["created"], result["updated"], result["failed"]) == (0, 1, 0), result["errors"]
+    item = await get_user(dynamodb, "u1")
+    assert item["name"]["S"] == "new"
+    assert item["version"]["N"] == "2"
+    assert item["scenario_history"]["L"] == [{"S": "step"}]
+    # Welcome ставит тот, кто создал пользователя, а не загрузка
+    welcome = await dynamodb.get_item(TableName=WELCOME_TABLE, Key={"user_id": {"S": "u1"}})
+    assert "Item" not in welcome
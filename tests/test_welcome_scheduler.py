@@ -0,0 +1,28 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import src.welcome_scheduler as welcome_scheduler
+
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_prepare_tables_retries_transient_errors(dynamodb, monkeypatch):
+    real_ensure = welcome_scheduler.ensure_lease_table
+    attempts = []
+
+    async def flaky_ensure():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ClientError({"Error": {"Code": "InternalServerError", "Message": "boom"}}, "DescribeTable")
+        await real_ensure()
+
+    monkeypatch.setattr(welcome_scheduler, "WELCOME_ENSURE_INDEX", False)
+    monkeypatch.setattr(welcome_scheduler, "WELCOME_STARTUP_RETRY_DELAY", 0)
+    monkeypatch.setattr(welcome_scheduler, "ensure_lease_table", flaky_ensure)
+
+    await welcome_scheduler.prepare_tables()
+
+    assert len(attempts) == 2
+    table = await dynamodb.describe_table(TableName=welcome_scheduler.WELCOME_LEASE_TABLE)
+    assert table["Table"]["TableStatus"] == "ACTIVE"